@@ -0,0 +1,72 @@
+'''
+Benchmark of the chunked console storage, not part of the test suite.
+
+Appends a log of the given size (MB, default 200) in 4 KB chunks to the
+console table and measures a full read, a tail read by byte offset and by
+sequence number and concatenating the chunks in the database (as the
+scheduler does when it moves the output of a finished job into the job). With --old the previous read (all rows concatenated
+in python) is measured as well.
+
+    python console_benchmark.py [size] [--old]
+'''
+import sys
+import time
+import uuid
+
+from pyinfraboxutils import console
+from pyinfraboxutils.db import connect_db, DB
+
+CHUNK = ('x' * 79 + '\n') * 50
+
+def _timed(name, fn):
+    start = time.time()
+    result = fn()
+    print('%-20s %8.3fs' % (name, time.time() - start))
+    return result
+
+def _old_read(db, job_id):
+    output = ''
+    for r in db.execute_many('SELECT output FROM console WHERE job_id = %s ORDER BY date', [job_id]):
+        output += r[0]
+
+    return output
+
+def _append(db, job_id, chunks):
+    for i in range(chunks):
+        db.execute('INSERT INTO console (job_id, output) VALUES (%s, %s)', [job_id, CHUNK])
+
+        if i % 500 == 0:
+            db.commit()
+
+    db.commit()
+
+def _aggregate(db, job_id):
+    return db.execute_one('''
+        SELECT octet_length(string_agg(output, '' ORDER BY seq))
+        FROM console
+        WHERE job_id = %s
+    ''', [job_id])
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    size = int(args[0]) if args else 200
+    chunks = size * 10 ** 6 // len(CHUNK)
+
+    db = DB(connect_db())
+    job_id = str(uuid.uuid4())
+
+    try:
+        _timed('append %s MB' % size, lambda: _append(db, job_id, chunks))
+        _, seq, offset = _timed('full read', lambda: console.read(db, job_id))
+        _timed('tail by offset', lambda: console.read(db, job_id, 0, offset - 64 * 1024))
+        _timed('tail by seq', lambda: console.read(db, job_id, seq - 16))
+        _timed('aggregate', lambda: _aggregate(db, job_id))
+
+        if '--old' in sys.argv:
+            _timed('old full read', lambda: _old_read(db, job_id))
+    finally:
+        db.execute('DELETE FROM console WHERE job_id = %s', [job_id])
+        db.commit()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+'''
+Load test of the console ingest, not part of the test suite.
+
+Replays a recorded fluent-bit stream against /internal/api/job/consoleupdate
+of a running API. A recording has one batch per line, exactly the JSON body
+fluent-bit posted (e.g. captured with the stdout output of the fluent-bit
+daemonset in debug mode). Every job found in the recording is mapped to a new
+scheduled job in the database, so the output is appended and the jobs are
+switched to running like in the cluster.
+
+    python console_ingest_load.py record <file> [jobs] [batches] [lines]
+    python console_ingest_load.py replay <file> [api_url] [concurrency]
+
+record writes a synthetic recording of the given number of concurrently
+logging jobs (default 200), batches (default 500) and log lines per job and
+batch (default 10).
+'''
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+
+from queue import Queue, Empty
+
+import requests
+
+from pyinfraboxutils.db import connect_db, DB
+
+def record(path, jobs=200, batches=500, lines=10):
+    job_names = ['%s-%03d' % (uuid.uuid4(), random.randint(0, 999)) for _ in range(jobs)]
+    date = time.time()
+
+    with open(path, 'w') as f:
+        for _ in range(batches):
+            batch = []
+            for _ in range(lines):
+                for job_name in job_names:
+                    date += 0.0001
+                    batch.append({
+                        'date': date,
+                        'log': 'Step %s: RUN make -j8 all' % random.randint(0, 1000),
+                        'stream': 'stdout',
+                        'kubernetes': {'labels': {'job-name': job_name}}
+                    })
+
+            f.write(json.dumps(batch) + '\n')
+
+def _create_jobs(db, job_ids):
+    project_id = str(uuid.uuid4())
+    build_id = str(uuid.uuid4())
+
+    db.execute("INSERT INTO project (id, name, type) VALUES (%s, %s, 'upload')",
+               [project_id, 'load-%s' % project_id])
+    db.execute("INSERT INTO build (id, project_id, build_number) VALUES (%s, %s, 1)",
+               [build_id, project_id])
+
+    for job_id in job_ids:
+        db.execute('''
+            INSERT INTO job (id, state, build_id, type, name, project_id, dockerfile, cluster_name, definition)
+            VALUES (%s, 'scheduled', %s, 'run_project_container', %s, %s, '', 'master', '{}')
+        ''', [job_id, build_id, job_id, project_id])
+
+    db.commit()
+    return project_id
+
+def _delete_jobs(db, project_id):
+    db.execute('''
+        DELETE FROM console WHERE job_id IN (SELECT id FROM job WHERE project_id = %s)
+    ''', [project_id])
+    db.execute('DELETE FROM job WHERE project_id = %s', [project_id])
+    db.execute('DELETE FROM build WHERE project_id = %s', [project_id])
+    db.execute('DELETE FROM project WHERE id = %s', [project_id])
+    db.commit()
+
+def _load(path):
+    with open(path) as f:
+        batches = [json.loads(l) for l in f if l.strip()]
+
+    # Map the jobs of the recording to new jobs
+    jobs = {}
+    for batch in batches:
+        for r in batch:
+            if 'kubernetes' not in r:
+                continue
+
+            job_name = r['kubernetes']['labels']['job-name']
+            if job_name not in jobs:
+                jobs[job_name] = str(uuid.uuid4())
+
+            r['kubernetes']['labels']['job-name'] = jobs[job_name] + job_name[-4:]
+
+    return [json.dumps(b) for b in batches], list(jobs.values())
+
+def replay(path, api_url='http://localhost:8080', concurrency=8):
+    batches, job_ids = _load(path)
+    records = sum(b.count('"kubernetes"') for b in batches)
+
+    db = DB(connect_db())
+    project_id = _create_jobs(db, job_ids)
+
+    queue = Queue()
+    for b in batches:
+        queue.put(b)
+
+    latencies = []
+    errors = []
+
+    def _worker():
+        session = requests.Session()
+        while True:
+            try:
+                body = queue.get_nowait()
+            except Empty:
+                return
+
+            start = time.time()
+            r = session.post(api_url + '/internal/api/job/consoleupdate', data=body,
+                             headers={'Content-Type': 'application/json'})
+            latencies.append(time.time() - start)
+
+            if r.status_code != 200:
+                errors.append(r.status_code)
+
+    try:
+        start = time.time()
+        workers = [threading.Thread(target=_worker) for _ in range(concurrency)]
+        for w in workers:
+            w.start()
+
+        for w in workers:
+            w.join()
+
+        duration = time.time() - start
+
+        latencies.sort()
+        print('%s batches, %s records, %s jobs, %s errors' % (len(batches), records, len(job_ids), len(errors)))
+        print('%-20s %8.3fs' % ('duration', duration))
+        print('%-20s %8.1f/s' % ('batches', len(batches) / duration))
+        print('%-20s %8.1f/s' % ('records', records / duration))
+        print('%-20s %8.3fs' % ('latency p50', latencies[len(latencies) // 2]))
+        print('%-20s %8.3fs' % ('latency p99', latencies[int(len(latencies) * 0.99)]))
+
+        r = db.execute_one('''
+            SELECT count(*), count(DISTINCT c.job_id)
+            FROM console c
+            JOIN job j ON j.id = c.job_id
+            WHERE j.project_id = %s
+        ''', [project_id])
+        print('%-20s %8s' % ('console rows', r[0]))
+        print('%-20s %8s' % ('jobs with output', r[1]))
+    finally:
+        _delete_jobs(db, project_id)
+
+def main():
+    if len(sys.argv) < 3 or sys.argv[1] not in ('record', 'replay'):
+        print(__doc__)
+        sys.exit(1)
+
+    if sys.argv[1] == 'record':
+        record(sys.argv[2], *[int(a) for a in sys.argv[3:6]])
+    else:
+        args = sys.argv[3:5]
+        if len(args) > 1:
+            args[1] = int(args[1])
+
+        replay(sys.argv[2], *args)
+
+if __name__ == '__main__':
+    main()
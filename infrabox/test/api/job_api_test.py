@@ -1,6 +1,9 @@
-from os import getcwd, stat, remove
+from os import getcwd, stat, remove, urandom
 
 import json
+import zlib
+import hashlib
+from io import BytesIO
 
 from pyinfraboxutils.storage import storage
 from temp_tools import TestClient, TestUtils
@@ -64,6 +67,77 @@ class JobApiTest(ApiTestTemplate):
 
         # Ensure downloaded and uploaded file sizes are equal
         self.assertEqual(received_cache_size, actual_cache_size)
+        self.assertEqual(r.headers['Content-Length'], str(actual_cache_size))
+
+    def test_cache_range(self):
+        filename = 'cache.tar.snappy'
+
+        file_path = getcwd() + '/' + filename
+
+        with open(file_path, 'rb') as f:
+            data = f.read()
+
+        storage.upload_cache(BytesIO(data), 'project_%s_job_%s_%s' % (self.project_id, self.job_name, filename))
+
+        headers = dict(self.job_headers)
+        headers['Range'] = 'bytes=10-19'
+        r = TestClient.get(self.url_ns + '/cache?filename=%s' % filename, headers=headers)
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.data, data[10:20])
+        self.assertEqual(r.headers['Content-Range'], 'bytes 10-19/%s' % len(data))
+
+        headers['Range'] = 'bytes=%s-' % (len(data) + 1)
+        r = TestClient.get(self.url_ns + '/cache?filename=%s' % filename, headers=headers)
+        self.assertEqual(r.status_code, 416)
+
+    def test_cache_parts(self):
+        # Larger than the part size of the test setup (5 MB)
+        data = urandom(11 * 1024 * 1024)
+        filename = 'large.tar.snappy'
+
+        storage.upload_cache(BytesIO(data), 'project_%s_job_%s_%s' % (self.project_id, self.job_name, filename))
+
+        r = TestClient.get(self.url_ns + '/cache?filename=%s' % filename, headers=self.job_headers)
+        self.assertEqual(r.headers['Content-Length'], str(len(data)))
+        self.assertEqual(r.data, data)
+
+    def test_cache_chunks(self):
+        data = b'chunk of a cache'
+        chunk_id = hashlib.sha256(data).hexdigest()
+        other_id = hashlib.sha256(b'other chunk').hexdigest()
+
+        r = TestClient.post(self.url_ns + '/cache/chunks', {'chunks': [chunk_id, other_id]}, self.job_headers)
+        self.assertEqual(r, {'missing': [chunk_id, other_id]})
+
+        # Not stored yet
+        r = TestClient.post(self.url_ns + '/cache/manifest', {'chunks': [chunk_id]}, self.job_headers)
+        self.assertEqual(r['message'], 'Chunks not stored: %s' % chunk_id)
+
+        r = TestClient.post(self.url_ns + '/cache/chunks/%s' % other_id, zlib.compress(data),
+                            self.job_headers, content_type='application/octet-stream')
+        self.assertEqual(r['message'], 'Chunk does not match its id')
+
+        r = TestClient.post(self.url_ns + '/cache/chunks/%s' % chunk_id, zlib.compress(data),
+                            self.job_headers, content_type='application/octet-stream')
+        self.assertEqual(r, {})
+
+        r = TestClient.post(self.url_ns + '/cache/chunks', {'chunks': [chunk_id, other_id]}, self.job_headers)
+        self.assertEqual(r, {'missing': [other_id]})
+
+        r = TestClient.post(self.url_ns + '/cache/manifest', {'chunks': [chunk_id, chunk_id]}, self.job_headers)
+        self.assertEqual(r, {})
+
+        r = TestClient.get(self.url_ns + '/cache/manifest', self.job_headers)
+        self.assertEqual(r, {'chunks': [chunk_id, chunk_id]})
+
+        r = TestClient.get(self.url_ns + '/cache/chunks/%s' % chunk_id, self.job_headers)
+        self.assertEqual(zlib.decompress(r.data), data)
+
+        # Expands to more than a chunk may have
+        data = b'\0' * (8 * 1024 * 1024 + 1)
+        r = TestClient.post(self.url_ns + '/cache/chunks/%s' % hashlib.sha256(data).hexdigest(), zlib.compress(data),
+                            self.job_headers, content_type='application/octet-stream')
+        self.assertEqual(r['message'], 'Chunk too large')
 
     def test_output(self):
         filename = 'output.tar.snappy'
@@ -0,0 +1,154 @@
+'''
+Benchmark of the job event enrichment, not part of the test suite.
+
+Creates a github project with a build of the given number of jobs (default
+300), restarts the build (all jobs are set back to queued) and reads the
+job_update notifications. Every event is then enriched with the previous
+sequence of queries per event and by the job listener (one joined query,
+cached commit and pull request), and the events per second are printed.
+With --no-clients the listener skips the events because no client is in
+the build or project room.
+
+    python job_events_benchmark.py [jobs] [--no-clients]
+'''
+import json
+import select
+import sys
+import time
+import uuid
+
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from pyinfraboxutils.db import connect_db, DB
+
+import listeners.job
+
+def _timed(name, events, fn):
+    start = time.time()
+    fn()
+    duration = time.time() - start
+    print('%-20s %8.3fs %10.1f events/s' % (name, duration, len(events) / duration))
+
+def _create_build(db, jobs):
+    project_id = str(uuid.uuid4())
+    build_id = str(uuid.uuid4())
+    commit_id = str(uuid.uuid4())
+    repo_id = str(uuid.uuid4())
+
+    db.execute("INSERT INTO project (id, name, type) VALUES (%s, %s, 'github')",
+               [project_id, 'bench-%s' % project_id])
+    db.execute('''
+        INSERT INTO pull_request (id, project_id, github_pull_request_id, title, url)
+        VALUES (%s, %s, 1, 'Benchmark', 'http://localhost')
+    ''', [build_id, project_id])
+    db.execute('''
+        INSERT INTO commit (id, message, repository_id, timestamp, author_name, author_email,
+                            author_username, committer_name, committer_email, committer_username,
+                            url, branch, project_id, tag, pull_request_id, github_status_url)
+        VALUES (%s, 'Benchmark', %s, now(), 'a', 'a', 'a', 'a', 'a', 'a', 'http://localhost', 'master', %s, null, %s, '')
+    ''', [commit_id, repo_id, project_id, build_id])
+    db.execute('''
+        INSERT INTO build (id, project_id, build_number, commit_id)
+        VALUES (%s, %s, 1, %s)
+    ''', [build_id, project_id, commit_id])
+
+    for i in range(jobs):
+        db.execute('''
+            INSERT INTO job (id, state, build_id, type, name, project_id, dockerfile, cluster_name, definition)
+            VALUES (%s, 'finished', %s, 'run_project_container', %s, %s, '', 'master', '{}')
+        ''', [str(uuid.uuid4()), build_id, 'job-%s' % i, project_id])
+
+    db.commit()
+    return project_id, build_id
+
+def _delete_build(db, project_id):
+    for table in ('job', 'build', 'commit', 'pull_request'):
+        db.execute('DELETE FROM %s WHERE project_id = %%s' % table, [project_id])
+
+    db.execute('DELETE FROM project WHERE id = %s', [project_id])
+    db.commit()
+
+def _restart(db, build_id, jobs):
+    conn = connect_db()
+    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    conn.cursor().execute('LISTEN job_update')
+
+    db.execute('''
+        UPDATE build SET restart_counter = restart_counter + 1 WHERE id = %s;
+        UPDATE job SET state = 'queued' WHERE build_id = %s;
+    ''', [build_id, build_id])
+    db.commit()
+
+    events = []
+    while len(events) < jobs and select.select([conn], [], [], 5)[0]:
+        conn.poll()
+        while conn.notifies:
+            events.append(json.loads(conn.notifies.pop(0).payload))
+
+    conn.close()
+    return events
+
+def _old_handle_event(db, event):
+    job = db.execute_one_dict('''
+        SELECT id, state, to_char(start_date, 'YYYY-MM-DD HH24:MI:SS') start_date, type, dockerfile,
+               to_char(end_date, 'YYYY-MM-DD HH24:MI:SS') end_date,
+               name, dependencies, to_char(created_at, 'YYYY-MM-DD HH24:MI:SS') created_at, message,
+               project_id, build_id, node_name, avg_cpu, definition, restarted
+        FROM job
+        WHERE id = %s
+    ''', [event['job_id']])
+    project = db.execute_one_dict('SELECT id, name, type FROM project WHERE id = %s', [job['project_id']])
+    build = db.execute_one_dict('''
+        SELECT id, build_number, restart_counter, commit_id, is_cronjob FROM build WHERE id = %s
+    ''', [job['build_id']])
+    commit = db.execute_one_dict('''
+        SELECT c.id, split_part(c.message, '\n', 1) as message, c.author_name, c.author_email,
+               c.author_username, c.committer_name, c.committer_email, c.committer_username,
+               c.url, c.branch, c.pull_request_id
+        FROM commit c
+        WHERE c.id = %s AND c.project_id = %s
+    ''', [build['commit_id'], job['project_id']])
+    pr = db.execute_one_dict('''
+        SELECT title, url FROM pull_request WHERE id = %s AND project_id = %s
+    ''', [commit['pull_request_id'], job['project_id']])
+
+    return json.dumps({'job': job, 'project': project, 'build': build, 'commit': commit, 'pull_request': pr})
+
+class _SocketIO(object):
+    def __init__(self):
+        self.emitted = 0
+
+    def emit(self, event, msg, room):
+        json.dumps(msg)
+        self.emitted += 1
+
+class _ClientManager(object):
+    def __init__(self, clients):
+        self.clients = clients
+
+    def has_clients(self, room):
+        return self.clients
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    jobs = int(args[0]) if args else 300
+
+    db = DB(connect_db())
+    project_id, build_id = _create_build(db, jobs)
+    handle_event = vars(listeners.job)['__handle_event']
+
+    try:
+        events = _restart(db, build_id, jobs)
+        print('%s events' % len(events))
+
+        _timed('old', events, lambda: [_old_handle_event(db, e) for e in events])
+
+        sio = _SocketIO()
+        cm = _ClientManager('--no-clients' not in sys.argv)
+        _timed('listener', events, lambda: [handle_event(e, sio, cm) for e in events])
+        print('%s messages emitted' % sio.emitted)
+    finally:
+        _delete_build(db, project_id)
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 from os import stat, remove
 
+import gzip
 import json
 
 from temp_tools import TestClient
@@ -16,3 +17,107 @@ class JobTest(ApiTestTemplate):
         r = TestClient.get('/api/v1/projects/%s/jobs/%s/manifest' % (self.project_id, self.job_id),
                            TestClient.get_project_authorization(self.token_id, self.project_id))
         self.assertEqual(r['id'], self.job_id)
+
+    def test_get_job_console(self):
+        for output in ['first\n', 'second\n', 'third\n']:
+            TestClient.execute('''
+                INSERT INTO console (job_id, output) VALUES (%s, %s)
+            ''', [self.job_id, output])
+
+        url = '/api/v1/projects/%s/jobs/%s/console' % (self.project_id, self.job_id)
+        headers = TestClient.get_project_authorization(self.token_id, self.project_id)
+
+        r = TestClient.get(url, headers)
+        self.assertEqual(r.data, b'first\nsecond\nthird\n')
+        self.assertEqual(r.headers['Infrabox-Console-Offset'], '19')
+        self.assertEqual(r.headers['Infrabox-Console-Seq'], '3')
+
+        r = TestClient.get(url + '?offset=8', headers)
+        self.assertEqual(r.data, b'cond\nthird\n')
+
+        r = TestClient.get(url + '?seq=2', headers)
+        self.assertEqual(r.data, b'third\n')
+
+        r = TestClient.get(url + '?seq=3&offset=19', headers)
+        self.assertEqual(r.data, b'')
+        self.assertEqual(r.headers['Infrabox-Console-Offset'], '19')
+
+    def test_get_job_console_finished(self):
+        TestClient.execute('''
+            UPDATE job SET console = 'first\nsecond\n' WHERE id = %s
+        ''', [self.job_id])
+
+        url = '/api/v1/projects/%s/jobs/%s/console' % (self.project_id, self.job_id)
+        headers = TestClient.get_project_authorization(self.token_id, self.project_id)
+
+        r = TestClient.get(url + '?offset=6', headers)
+        self.assertEqual(r.data, b'second\n')
+        self.assertEqual(r.headers['Infrabox-Console-Offset'], '13')
+
+    def test_get_job_console_range(self):
+        for output in ['first\n', 'second\n', 'third\n']:
+            TestClient.execute('''
+                INSERT INTO console (job_id, output) VALUES (%s, %s)
+            ''', [self.job_id, output])
+
+        url = '/api/v1/projects/%s/jobs/%s/console' % (self.project_id, self.job_id)
+        headers = TestClient.get_project_authorization(self.token_id, self.project_id)
+
+        headers['Range'] = 'bytes=-6'
+        r = TestClient.get(url, headers)
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.data, b'third\n')
+        self.assertEqual(r.headers['Content-Range'], 'bytes 13-18/19')
+
+        headers['Range'] = 'bytes=2-8'
+        r = TestClient.get(url, headers)
+        self.assertEqual(r.data, b'rst\nsec')
+
+        headers['Range'] = 'bytes=30-'
+        r = TestClient.get(url, headers)
+        self.assertEqual(r.status_code, 416)
+
+    def test_get_job_console_gzip(self):
+        TestClient.execute('''
+            INSERT INTO console (job_id, output) VALUES (%s, %s)
+        ''', [self.job_id, 'first\n' * 1000])
+
+        url = '/api/v1/projects/%s/jobs/%s/console' % (self.project_id, self.job_id)
+        headers = TestClient.get_project_authorization(self.token_id, self.project_id)
+        headers['Accept-Encoding'] = 'gzip'
+
+        r = TestClient.get(url, headers)
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(r.data), b'first\n' * 1000)
+
+    def test_console_update(self):
+        TestClient.execute("UPDATE job SET state = 'scheduled' WHERE id = %s", [self.job_id])
+
+        def record(job_id, log, date):
+            return {'date': date, 'log': log, 'kubernetes': {'labels': {'job-name': job_id + '-abc'}}}
+
+        records = [
+            record(self.job_id, 'first', 1500000000.0),
+            record(self.job_id_running, 'running', 1500000001.0),
+            record(self.job_id, 'second', 1500000002.0),
+            record(self.job_id_2, 'queued', 1500000003.0),
+            record('not-a-job-abcd', 'invalid', 1500000004.0),
+            {'date': 1500000005.0, 'log': 'no kubernetes'}
+        ]
+
+        r = TestClient.app.post('/internal/api/job/consoleupdate',
+                                data=json.dumps(records),
+                                content_type='application/json')
+        self.assertEqual(r.status_code, 200)
+
+        rows = TestClient.execute_many('''
+            SELECT job_id::text, output FROM console
+        ''')
+        output = {r['job_id']: r['output'] for r in rows}
+        self.assertEqual(len(rows), 2)
+        self.assertRegex(output[self.job_id], r'^\d\d:\d\d:\d\d\|first\n\d\d:\d\d:\d\d\|second\n$')
+        self.assertRegex(output[self.job_id_running], r'^\d\d:\d\d:\d\d\|running\n$')
+
+        r = TestClient.execute_one("SELECT state, start_date FROM job WHERE id = %s", [self.job_id])
+        self.assertEqual(r['state'], 'running')
+        self.assertIsNotNone(r['start_date'])
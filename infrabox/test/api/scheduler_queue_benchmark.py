@@ -0,0 +1,108 @@
+'''
+Benchmark of resolving the dependencies of queued jobs, not part of the
+test suite.
+
+Creates a build with the given number of queued jobs (default 10000), each
+depending on a parent which is finished, running or failed, so a third of
+them is runnable, blocked and skipped. Then the parent states are resolved
+once with a query per queued job (like the scheduler did before) and once
+with the single queued_jobs statement of the scheduler. Needs
+src/scheduler/kubernetes in the PYTHONPATH.
+
+    python scheduler_queue_benchmark.py [jobs]
+'''
+import sys
+import time
+import uuid
+
+from pyinfraboxutils.db import connect_db, DB
+
+from scheduler import STATEMENTS
+
+def _timed(name, jobs, fn):
+    start = time.time()
+    result = fn()
+    duration = time.time() - start
+    print('%-20s %8.3fs %10.1f jobs/s' % (name, duration, jobs / duration))
+    return result
+
+def _create_build(db, jobs):
+    project_id = str(uuid.uuid4())
+    build_id = str(uuid.uuid4())
+
+    db.execute("INSERT INTO project (id, name, type) VALUES (%s, %s, 'upload')",
+               [project_id, 'bench-%s' % project_id])
+    db.execute('''
+        INSERT INTO build (id, project_id, build_number)
+        VALUES (%s, %s, 1)
+    ''', [build_id, project_id])
+
+    db.execute('''
+        INSERT INTO job (state, build_id, type, name, project_id, dockerfile, cluster_name, definition)
+        SELECT (ARRAY['finished', 'running', 'failure'])[mod(i, 3) + 1]::job_state, %s, 'run_project_container',
+               'parent-' || i, %s, '', 'master', '{}'
+        FROM generate_series(0, %s - 1) i
+    ''', [build_id, project_id, jobs])
+    db.execute('''
+        INSERT INTO job (state, build_id, type, name, project_id, dockerfile, cluster_name, definition,
+                         dependencies)
+        SELECT 'queued', p.build_id, 'run_project_container', 'job-' || p.name, p.project_id, '', 'master', '{}',
+               jsonb_build_array(jsonb_build_object('job-id', p.id, 'on', jsonb_build_array('finished')))
+        FROM job p
+        WHERE p.build_id = %s
+    ''', [build_id])
+
+    db.commit()
+    return project_id
+
+def _delete_build(db, project_id):
+    for table in ('job', 'build'):
+        db.execute('DELETE FROM %s WHERE project_id = %%s' % table, [project_id])
+
+    db.execute('DELETE FROM project WHERE id = %s', [project_id])
+    db.commit()
+
+def _old_resolve(db):
+    jobs = db.execute_many('''
+        SELECT j.id, j.type, j.dependencies, j.definition
+        FROM job j
+        WHERE j.state = 'queued' and cluster_name = 'master'
+        ORDER BY j.created_at ASC
+    ''')
+
+    for j in jobs:
+        db.execute_many('''
+            SELECT id, state
+            FROM job
+            WHERE id IN (
+                SELECT (deps->>'job-id')::uuid
+                FROM job, jsonb_array_elements(job.dependencies) as deps
+                WHERE id = %s
+            )
+        ''', [j[0]])
+
+    return jobs
+
+def _resolve(db):
+    return db.execute_many(STATEMENTS['queued_jobs'], ['master', 1, [0]])
+
+def main():
+    jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    db = DB(connect_db())
+    project_id = _create_build(db, jobs)
+
+    try:
+        _timed('query per job', jobs, lambda: _old_resolve(db))
+        result = _timed('queued_jobs', jobs, lambda: _resolve(db))
+
+        states = {}
+        for r in result:
+            states[r[4]] = states.get(r[4], 0) + 1
+
+        print(states)
+    finally:
+        _delete_build(db, project_id)
+
+if __name__ == '__main__':
+    main()
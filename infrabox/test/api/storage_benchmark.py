@@ -0,0 +1,58 @@
+'''
+Benchmark of small object operations on the configured storage, not part of
+the test suite.
+
+Uploads, checks, streams and deletes the given number of small objects
+(default 200) once with a new client per operation (like before the clients
+were cached) and once with the client shared by the process, and prints the
+latency per operation. Uses the INFRABOX_STORAGE_* environment, e.g. the
+minio of docker-compose.yml.
+
+    python storage_benchmark.py [objects] [size]
+'''
+import sys
+import time
+import uuid
+
+from io import BytesIO
+
+from pyinfraboxutils.storage import storage
+
+def _upload(key, data):
+    storage.upload_cache(BytesIO(data), key)
+
+def _exists(key, data):
+    storage.exists('cache/%s' % key)
+
+def _stream(key, data):
+    b''.join(storage._stream('cache/%s' % key))
+
+def _delete(key, data):
+    storage.delete_cache(key)
+
+def _timed(name, keys, data, fn, new_client):
+    start = time.time()
+    for key in keys:
+        if new_client:
+            storage.client = None
+
+        fn(key, data)
+
+    duration = time.time() - start
+    print('%-20s %8.3fs %10.2fms/op' % (name, duration, duration * 1000 / len(keys)))
+
+def main():
+    objects = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    data = b'x' * size
+
+    for new_client in (True, False):
+        print('new client per operation' if new_client else 'shared client')
+        keys = ['benchmark_%s' % uuid.uuid4() for _ in range(objects)]
+
+        for name, fn in (('upload', _upload), ('exists', _exists),
+                         ('stream', _stream), ('delete', _delete)):
+            _timed(name, keys, data, fn, new_client)
+
+if __name__ == '__main__':
+    main()
@@ -13,7 +13,8 @@ class ApiTestTemplate(unittest.TestCase):
             'collaborator, auth_token, secret, '
             'console, job_markup, job_badge, job, '
             'build, commit, repository, '
-            '"user", project, source_upload, cluster'
+            '"user", project, source_upload, cluster, '
+            'cache_chunk, cache_manifest'
         )
 
         self.project_id = '1514af82-3c4f-4bb5-b1da-a89a0ced5e6f'
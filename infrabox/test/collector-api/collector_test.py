@@ -14,5 +14,53 @@ class CollectorTest(unittest.TestCase):
     def test_collector_pods(self):
         r = TestClient.get(url = 'api/pods', headers = None)
         self.assertEqual(r, [])
-        
 
+    def test_collector_post_log(self):
+        entries = [{
+            'log': 'line %s' % i,
+            'kubernetes': {
+                'namespace_name': 'default',
+                'pod_id': 'post-log',
+                'pod_name': 'post-log-pod',
+                'container_name': 'main'
+            }
+        } for i in range(3)]
+
+        r = TestClient.post('api/log', entries, headers=None)
+        self.assertEqual(r['status'], 200)
+
+        r = TestClient.get(url='api/pods/post-log', headers=None)
+        self.assertEqual(r['containers'], ['main'])
+
+        r = TestClient.get(url='api/pods/post-log/log/main', headers=None)
+        self.assertEqual(r.data, b'line 0\nline 1\nline 2\n')
+
+        r = TestClient.get(url='api/pods/post-log/log/other', headers=None)
+        self.assertEqual(r.status_code, 404)
+
+    def test_collector_log_range(self):
+        entries = [{
+            'log': 'line %s' % i,
+            'kubernetes': {
+                'namespace_name': 'default',
+                'pod_id': 'log-range',
+                'pod_name': 'log-range-pod',
+                'container_name': 'main'
+            }
+        } for i in range(5)]
+
+        TestClient.post('api/log', entries, headers=None)
+
+        r = TestClient.get(url='api/pods/log-range/log/main?tail=2', headers=None)
+        self.assertEqual(r.data, b'line 3\nline 4\n')
+        self.assertEqual(r.headers['Infrabox-Log-Offset'], '35')
+
+        r = TestClient.get(url='api/pods/log-range/log/main?offset=7&limit=14', headers=None)
+        self.assertEqual(r.data, b'line 1\nline 2\n')
+        self.assertEqual(r.headers['Infrabox-Log-Offset'], '21')
+
+        r = TestClient.get(url='api/pods/log-range/log/main?offset=35', headers=None)
+        self.assertEqual(r.data, b'')
+
+        r = TestClient.get(url='api/pods/log-range/log/main?tail=x', headers=None)
+        self.assertEqual(r.status_code, 400)
@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from logstore import LogStore
+
+
+def entry(log, pod_id='pod-1', container_name='main'):
+    return {
+        'log': log,
+        'kubernetes': {
+            'namespace_name': 'default',
+            'pod_id': pod_id,
+            'pod_name': 'pod-%s' % pod_id,
+            'container_name': container_name
+        }
+    }
+
+
+class LogStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_append(self):
+        store = LogStore(self.path)
+        store.append([entry('first'), entry('second\n'), entry('other', container_name='sidecar')])
+        store.append([entry('third'), {'log': 'not from kubernetes'}])
+
+        self.assertEqual(store.read('pod-1', 'main'), b'first\nsecond\nthird\n')
+        self.assertEqual(store.read('pod-1', 'sidecar'), b'other\n')
+        self.assertIsNone(store.read('pod-1', 'unknown'))
+        self.assertIsNone(store.read('pod-2', 'main'))
+
+        self.assertEqual(store.list_pods(), [{
+            'namespace_name': 'default',
+            'pod_id': 'pod-1',
+            'pod_name': 'pod-pod-1',
+            'containers': ['main', 'sidecar']
+        }])
+
+    def test_reload(self):
+        store = LogStore(self.path, segment_size=10)
+        store.append([entry('first'), entry('second')])
+        store.append([entry('third', container_name='k8s/sidecar')])
+
+        store = LogStore(self.path, segment_size=10)
+        store.append([entry('fourth'), entry('fifth', container_name='k8s/sidecar')])
+
+        self.assertEqual(store.get_pod('pod-1')['containers'], ['main', 'k8s/sidecar'])
+        self.assertEqual(store.read('pod-1', 'main'), b'first\nsecond\nfourth\n')
+        self.assertEqual(store.read('pod-1', 'sidecar'), b'third\nfifth\n')
+
+    def test_rotation(self):
+        store = LogStore(self.path, segment_size=10, max_pod_size=25)
+
+        for i in range(11):
+            store.append([entry('line %s' % i)])
+
+        # Segments of two lines, only the newest one fits next to the current
+        self.assertEqual(store.read('pod-1', 'main'), b'line 8\nline 9\nline 10\n')
+        self.assertEqual(sorted(os.listdir(os.path.join(self.path, 'pod-1'))),
+                         ['main.log', 'main.log.5', 'metadata.json'])
+
+    def test_offset_after_rotation(self):
+        store = LogStore(self.path, segment_size=10, max_pod_size=25)
+        for i in range(4):
+            store.append([entry('line %s' % i)])
+
+        log = store.open('pod-1', 'main')
+        offset = log.size
+        log.close()
+
+        # Deletes the segment with line 2 and 3, offsets stay the same
+        for i in range(4, 7):
+            store.append([entry('line %s' % i)])
+
+        log = store.open('pod-1', 'main')
+        self.assertEqual(log.start, 28)
+        self.assertEqual(b''.join(log.read(offset, log.size)), b'line 4\nline 5\nline 6\n')
+
+        log = store.open('pod-1', 'main')
+        self.assertEqual(log.tail(100), 28)
+        self.assertEqual(b''.join(log.read(0, log.size)), b'line 4\nline 5\nline 6\n')
+
+        store = LogStore(self.path, segment_size=10, max_pod_size=25)
+        log = store.open('pod-1', 'main')
+        self.assertEqual((log.start, log.size), (28, 49))
+        log.close()
+
+        self.assertEqual(store.get_pod('pod-1')['containers'], ['main'])
+
+    def test_open_files(self):
+        store = LogStore(self.path, max_open_files=2)
+        store.append([entry('log', pod_id='pod-%s' % i) for i in range(5)])
+
+        self.assertEqual(len(store.files), 2)
+        for i in range(5):
+            self.assertEqual(store.read('pod-%s' % i, 'main'), b'log\n')
+
+    def test_read_range(self):
+        store = LogStore(self.path, segment_size=10)
+        store.append([entry('first'), entry('second')])
+        store.append([entry('third')])
+
+        log = store.open('pod-1', 'main')
+        self.assertEqual(log.size, 19)
+        self.assertEqual(b''.join(log.read(3, 15, block_size=4)), b'st\nsecond\nth')
+
+        log = store.open('pod-1', 'main')
+        self.assertEqual(b''.join(log.read(13, 19)), b'third\n')
+
+    def test_tail(self):
+        store = LogStore(self.path, segment_size=10)
+        for i in range(10):
+            store.append([entry('line %s' % i)])
+
+        log = store.open('pod-1', 'main')
+        self.assertEqual(b''.join(log.read(log.tail(3, block_size=5), log.size)), b'line 7\nline 8\nline 9\n')
+
+        log = store.open('pod-1', 'main')
+        self.assertEqual(log.tail(0), log.size)
+        self.assertEqual(log.tail(100), 0)
+        log.close()
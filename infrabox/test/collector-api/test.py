@@ -4,6 +4,7 @@ import sys
 from xmlrunner import XMLTestRunner
 
 from collector_test import CollectorTest
+from logstore_test import LogStoreTest
 
 
 if __name__ == '__main__':
@@ -12,6 +13,7 @@ if __name__ == '__main__':
         suite = unittest.TestSuite()
         #unittest.main(testRunner=xmlrunner.XMLTestRunner(output=output))
         suite.addTest(unittest.TestLoader().loadTestsFromTestCase(CollectorTest))
+        suite.addTest(unittest.TestLoader().loadTestsFromTestCase(LogStoreTest))
 
         testRunner = XMLTestRunner(output=output)
         #unittest.main(testRunner = XMLTestRunner(output=output),
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from infrabox_job.cache import ChunkStore, write_chunks, read_chunks, MAX_CHUNK_SIZE
+
+
+def write_file(path, size, mtime=1500000000):
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+
+    os.utime(path, (mtime, mtime))
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.source = os.path.join(self.path, 'source')
+        self.store = ChunkStore(os.path.join(self.path, 'chunks'))
+
+        # 12 MB in 40 files, so there are several chunks cut at file boundaries
+        for d in range(4):
+            os.makedirs(os.path.join(self.source, 'dir%s' % d))
+
+            for i in range(10):
+                write_file(os.path.join(self.source, 'dir%s' % d, 'file%s' % i), 300 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def assertSameFiles(self, a, b):
+        files = sorted(os.path.relpath(os.path.join(root, name), a)
+                       for root, _, names in os.walk(a) for name in names)
+        other = sorted(os.path.relpath(os.path.join(root, name), b)
+                       for root, _, names in os.walk(b) for name in names)
+        self.assertEqual(files, other)
+
+        for name in files:
+            with open(os.path.join(a, name), 'rb') as f1, open(os.path.join(b, name), 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def test_round_trip(self):
+        chunks = write_chunks(self.source, self.store)
+        self.assertTrue(len(chunks) > 1)
+
+        output = os.path.join(self.path, 'output')
+        os.makedirs(output)
+        read_chunks(chunks, self.store, output)
+
+        self.assertSameFiles(self.source, output)
+
+    def test_stable_boundaries(self):
+        before = write_chunks(self.source, self.store)
+
+        # Same name and size, but new content and modification time
+        write_file(os.path.join(self.source, 'dir2', 'file5'), 300 * 1024, mtime=1600000000)
+        after = write_chunks(self.source, self.store)
+
+        # Only the chunks around the changed file are new
+        new = [c for c in after if c not in before]
+        self.assertTrue(0 < len(new) <= 2, '%s of %s chunks changed' % (len(new), len(after)))
+
+    def test_large_file(self):
+        write_file(os.path.join(self.source, 'large'), 2 * MAX_CHUNK_SIZE + 1)
+
+        for chunk_id in write_chunks(self.source, self.store):
+            self.assertTrue(len(self.store.read(chunk_id)) <= MAX_CHUNK_SIZE)
+
+    def test_put_compressed(self):
+        chunk_id = self.store.put(b'data')
+        self.assertTrue(self.store.has(chunk_id))
+
+        self.assertRaises(ValueError, self.store.put_compressed, chunk_id, zlib.compress(b'other'))
+        self.assertEqual(self.store.read(chunk_id), b'data')
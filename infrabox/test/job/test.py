@@ -0,0 +1,17 @@
+import unittest
+import sys
+
+from xmlrunner import XMLTestRunner
+
+from cache_test import CacheTest
+
+
+if __name__ == '__main__':
+
+    with open('results.xml', 'wb') as output:
+        suite = unittest.TestSuite()
+        suite.addTest(unittest.TestLoader().loadTestsFromTestCase(CacheTest))
+
+        testRunner = XMLTestRunner(output=output)
+        ret = testRunner.run(suite).wasSuccessful()
+        sys.exit(not ret)
@@ -0,0 +1,75 @@
+import os
+import unittest
+
+from scheduler import Scheduler
+
+class Args(object):
+    token = 'token'
+    api_server = 'http://localhost'
+
+def _jobs(project_id, count, weight=1):
+    return [('%s%s' % (project_id, i), 1, 1024, project_id, 10, project_id, weight) for i in range(count)]
+
+def _ids(jobs):
+    return [j[0] for j in jobs]
+
+class FairShareTest(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['INFRABOX_GENERAL_WORKER_NAMESPACE'] = 'infrabox-worker'
+        os.environ['INFRABOX_CLUSTER_NAME'] = 'master'
+        os.environ['INFRABOX_SCHEDULER_FAIR_SHARE_ENABLED'] = 'true'
+        os.environ['INFRABOX_SCHEDULER_MAX_ACTIVE_JOBS'] = '100'
+
+        self.scheduler = Scheduler(Args())
+        self.active = {}
+        self.scheduler._active_jobs_per_project = lambda: dict(self.active)
+
+    def tearDown(self):
+        del os.environ['INFRABOX_SCHEDULER_MAX_ACTIVE_JOBS']
+
+    def test_limit_required(self):
+        # Without a limit all jobs would be started at once
+        os.environ['INFRABOX_SCHEDULER_MAX_ACTIVE_JOBS'] = '0'
+        self.assertRaises(Exception, Scheduler, Args())
+
+    def test_no_shards(self):
+        # The replicas would not share the limit
+        os.environ['INFRABOX_SCHEDULER_SHARDS'] = '4'
+        try:
+            self.assertRaises(Exception, Scheduler, Args())
+        finally:
+            del os.environ['INFRABOX_SCHEDULER_SHARDS']
+
+    def test_weighted_round_robin(self):
+        jobs = _jobs('a', 3) + _jobs('b', 3, weight=2)
+
+        self.assertEqual(_ids(self.scheduler.fair_share_order(jobs)),
+                         ['a0', 'b0', 'b1', 'a1', 'b2', 'a2'])
+
+        # the next iteration continues with the next project
+        self.assertEqual(_ids(self.scheduler.fair_share_order(jobs)),
+                         ['b0', 'b1', 'a0', 'b2', 'a1', 'a2'])
+
+    def test_share_of_active_jobs(self):
+        self.scheduler.max_active_jobs = 4
+        self.active = {'a': 2}
+
+        # a already runs its share, b gets the free slots
+        released = self.scheduler.fair_share_order(_jobs('a', 3) + _jobs('b', 3))
+        self.assertEqual(_ids(released), ['b0', 'b1'])
+
+    def test_unused_share(self):
+        self.scheduler.max_active_jobs = 4
+
+        # b has nothing queued, so a may use its share
+        self.active = {'b': 1}
+        released = self.scheduler.fair_share_order(_jobs('a', 5))
+        self.assertEqual(_ids(released), ['a0', 'a1', 'a2'])
+
+    def test_admission(self):
+        self.scheduler.admission = True
+        self.scheduler._admission_check = lambda: lambda j: j[0] != 'a0'
+
+        released = self.scheduler.fair_share_order(_jobs('a', 2) + _jobs('b', 1))
+        self.assertEqual(_ids(released), ['a1', 'b0'])
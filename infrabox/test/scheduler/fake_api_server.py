@@ -0,0 +1,72 @@
+import json
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+class FakeAPIServer(object):
+    ''' Minimal kubernetes API server which answers LIST requests with
+    the configured items and WATCH requests with the queued events. '''
+
+    def __init__(self):
+        self.items = []
+        self.resource_version = '1'
+        self.watch_status = 200
+        self.events = []
+        self.requests = []
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                server.requests.append((url.path, query))
+
+                if query.get('watch', None) == ['true']:
+                    self._watch()
+                else:
+                    self._list()
+
+            def _list(self):
+                body = json.dumps({
+                    'metadata': {'resourceVersion': server.resource_version},
+                    'items': server.items
+                }).encode()
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _watch(self):
+                if server.watch_status != 200:
+                    self.send_response(server.watch_status)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                body = b''.join([json.dumps(e).encode() + b'\n' for e in server.events])
+                server.events = []
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%s' % self.httpd.server_port
+
+    def start(self):
+        t = threading.Thread(target=self.httpd.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
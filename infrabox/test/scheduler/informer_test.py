@@ -0,0 +1,115 @@
+import unittest
+
+from scheduler import Informer, KubeClient, GoneException
+from fake_api_server import FakeAPIServer
+
+def _obj(name, rv, state='running'):
+    return {
+        'metadata': {
+            'name': name,
+            'resourceVersion': rv
+        },
+        'status': {
+            'state': state
+        }
+    }
+
+class Args(object):
+    token = 'token'
+
+class InformerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeAPIServer()
+        self.server.start()
+        self.url = self.server.url + '/apis/core.infrabox.net/v1alpha1/namespaces/infrabox-worker/ibpipelineinvocations'
+        self.informer = Informer(KubeClient(Args(), 1), self.url, 3600)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_list(self):
+        self.server.items = [_obj('a', '1'), _obj('b', '1')]
+        self.informer._list()
+
+        self.assertEqual(self.informer.resource_version, '1')
+        self.assertEqual(sorted(self.informer.names()), ['a', 'b'])
+
+        # the first call of a consumer returns everything
+        changed = self.informer.changed('test')
+        self.assertEqual(sorted([o['metadata']['name'] for o in changed]), ['a', 'b'])
+
+        # nothing changed in the meantime
+        self.assertEqual(self.informer.changed('test'), [])
+
+    def test_watch_only_returns_changed_objects(self):
+        self.server.items = [_obj('a', '1'), _obj('b', '1')]
+        self.informer._list()
+        self.informer.changed('test')
+
+        self.server.events = [
+            {'type': 'MODIFIED', 'object': _obj('a', '2', state='finalizing')},
+            {'type': 'ADDED', 'object': _obj('c', '3')},
+            {'type': 'DELETED', 'object': _obj('b', '4')},
+            {'type': 'BOOKMARK', 'object': {'metadata': {'resourceVersion': '5'}}}
+        ]
+        self.informer._watch()
+
+        path, query = self.server.requests[-1]
+        self.assertEqual(query['resourceVersion'], ['1'])
+        self.assertEqual(query['watch'], ['true'])
+
+        self.assertEqual(self.informer.resource_version, '5')
+        self.assertEqual(sorted(self.informer.names()), ['a', 'c'])
+        self.assertEqual(self.informer.get('a')['status']['state'], 'finalizing')
+
+        changed = self.informer.changed('test')
+        self.assertEqual(sorted([o['metadata']['name'] for o in changed]), ['a', 'c'])
+
+    def test_consumers_are_independent(self):
+        self.server.items = [_obj('a', '1')]
+        self.informer._list()
+        self.informer.changed('first')
+        self.informer.changed('second')
+
+        self.server.events = [{'type': 'MODIFIED', 'object': _obj('a', '2')}]
+        self.informer._watch()
+
+        self.assertEqual(len(self.informer.changed('first')), 1)
+        self.assertEqual(len(self.informer.changed('second')), 1)
+        self.assertEqual(self.informer.changed('first'), [])
+
+    def test_mark(self):
+        self.server.items = [_obj('a', '1')]
+        self.informer._list()
+        self.informer.changed('test')
+
+        self.informer.mark('a')
+        self.informer.mark('unknown')
+        self.assertEqual([o['metadata']['name'] for o in self.informer.changed('test')], ['a'])
+
+    def test_resync_on_gone_event(self):
+        self.server.items = [_obj('a', '1')]
+        self.informer._list()
+
+        self.server.events = [{'type': 'ERROR', 'object': {'kind': 'Status', 'code': 410}}]
+        self.assertRaises(GoneException, self.informer._watch)
+
+    def test_resync_on_gone_status(self):
+        self.server.items = [_obj('a', '1')]
+        self.informer._list()
+
+        self.server.watch_status = 410
+        self.assertRaises(GoneException, self.informer._watch)
+
+    def test_on_change(self):
+        seen = []
+        self.informer.on_change = lambda o: seen.append(o['metadata']['name'])
+
+        self.server.items = [_obj('a', '1')]
+        self.informer._list()
+
+        self.server.events = [{'type': 'MODIFIED', 'object': _obj('b', '2')}]
+        self.informer._watch()
+
+        self.assertEqual(seen, ['a', 'b'])
@@ -0,0 +1,19 @@
+import unittest
+import sys
+
+from xmlrunner import XMLTestRunner
+
+from informer_test import InformerTest
+from fair_share_test import FairShareTest
+
+
+if __name__ == '__main__':
+
+    with open('results.xml', 'wb') as output:
+        suite = unittest.TestSuite()
+        suite.addTest(unittest.TestLoader().loadTestsFromTestCase(InformerTest))
+        suite.addTest(unittest.TestLoader().loadTestsFromTestCase(FairShareTest))
+
+        testRunner = XMLTestRunner(output=output)
+        ret = testRunner.run(suite).wasSuccessful()
+        sys.exit(not ret)
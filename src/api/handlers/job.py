@@ -1,5 +1,5 @@
 #pylint: disable=unused-argument
-from flask import g, jsonify, abort, send_file
+from flask import g, jsonify, abort
 from flask_restx import Resource, fields
 
 from pyinfraboxutils.ibflask import check_job_belongs_to_project
@@ -73,12 +73,12 @@ class Output(Resource):
         g.release_db()
 
         key = '%s.tar.snappy' % job_id
-        f = storage.download_output(key)
+        r = storage.send_output(key, filename=key)
 
-        if not f:
+        if not r:
             abort(404)
 
-        return send_file(f, attachment_filename=key)
+        return r
 
 @ns.route('/manifest', doc=False)
 @api.doc(responses={403: 'Not Authorized'})
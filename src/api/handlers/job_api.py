@@ -1,7 +1,10 @@
 #pylint: disable=too-many-lines,too-few-public-methods,too-many-locals,too-many-statements,too-many-branches 
 import os
+import re
 import json
 import time
+import zlib
+import hashlib
 import uuid
 import copy
 import urllib.request, urllib.parse, urllib.error
@@ -25,6 +28,7 @@ from pyinfrabox import ValidationError
 
 from pyinfraboxutils import get_logger
 from pyinfraboxutils.token import encode_job_token
+from pyinfraboxutils.multipart import MultipartFile
 from pyinfraboxutils.ibrestplus import api
 from pyinfraboxutils.ibflask import app
 from pyinfraboxutils.storage import storage
@@ -36,6 +40,26 @@ logger = get_logger(__name__)
 def allowed_file(filename, extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in extensions
 
+CHUNK_ID = re.compile(r'^[0-9a-f]{64}$')
+
+# Largest chunk of the content-addressed cache (infrabox_job.cache.MAX_CHUNK_SIZE),
+# compressed it may only grow by the zlib overhead
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_COMPRESSED_CHUNK_SIZE = MAX_CHUNK_SIZE + 64 * 1024
+
+def chunk_key(project_id, chunk_id):
+    return 'chunks/%s/%s' % (project_id, chunk_id)
+
+def validate_chunks(chunks):
+    if not isinstance(chunks, list):
+        return False
+
+    for c in chunks:
+        if not isinstance(c, str) or not CHUNK_ID.match(c):
+            return False
+
+    return True
+
 def delete_file(path):
     if os.path.exists(path):
         try:
@@ -679,12 +703,12 @@ class Source(Resource):
 
         g.release_db()
 
-        f = storage.download_source(filename)
+        r = storage.send_source(filename)
 
-        if not f:
+        if not r:
             abort(404)
 
-        return send_file(f)
+        return r
 
 
 @api.route("/api/job/cache", doc=False)
@@ -699,12 +723,12 @@ class Cache(Resource):
         key = template % (project_id, job_name, filename)
         key = key.replace('/', '_')
 
-        f = storage.download_cache(key)
+        r = storage.send_cache(key)
 
-        if not f:
+        if not r:
             abort(404)
 
-        return send_file(f)
+        return r
 
     def post(self):
         g.release_db()
@@ -722,6 +746,141 @@ class Cache(Resource):
         return jsonify({})
 
 
+@api.route("/api/job/cache/chunks", doc=False)
+class CacheChunks(Resource):
+
+    def post(self):
+        '''
+        Returns the chunks of the content-addressed cache which are not stored yet
+        '''
+        project_id = g.token['project']['id']
+        chunks = (request.get_json() or {}).get('chunks', None)
+
+        if not validate_chunks(chunks):
+            abort(400, "Invalid chunks")
+
+        # Chunks which are in use are kept by the gc
+        stored = g.db.execute_many('''
+            UPDATE cache_chunk
+            SET last_used = now()
+            WHERE project_id = %s
+            AND id = ANY(%s)
+            RETURNING id
+        ''', [project_id, chunks])
+        g.db.commit()
+
+        stored = set(r[0] for r in stored)
+        return jsonify({'missing': [c for c in chunks if c not in stored]})
+
+
+@api.route("/api/job/cache/chunks/<chunk_id>", doc=False)
+class CacheChunk(Resource):
+
+    def get(self, chunk_id):
+        project_id = g.token['project']['id']
+        g.release_db()
+
+        if not CHUNK_ID.match(chunk_id):
+            abort(400, "Invalid chunk")
+
+        r = storage.send_cache(chunk_key(project_id, chunk_id))
+
+        if not r:
+            abort(404)
+
+        return r
+
+    def post(self, chunk_id):
+        project_id = g.token['project']['id']
+
+        if not CHUNK_ID.match(chunk_id):
+            abort(400, "Invalid chunk")
+
+        if request.content_length is None or request.content_length > MAX_COMPRESSED_CHUNK_SIZE:
+            abort(413, "Chunk too large")
+
+        # The chunk is zlib compressed and named by the sha256 of its content,
+        # it's never decompressed beyond the size a chunk may have
+        data = request.get_data()
+        decompressor = zlib.decompressobj()
+
+        try:
+            content = decompressor.decompress(data, MAX_CHUNK_SIZE + 1)
+        except zlib.error:
+            abort(400, "Chunk does not match its id")
+
+        if len(content) > MAX_CHUNK_SIZE:
+            abort(413, "Chunk too large")
+
+        valid = decompressor.eof and hashlib.sha256(content).hexdigest() == chunk_id
+
+        if not valid:
+            abort(400, "Chunk does not match its id")
+
+        storage.upload_cache(BytesIO(data), chunk_key(project_id, chunk_id))
+
+        g.db.execute('''
+            INSERT INTO cache_chunk (project_id, id, size)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (project_id, id) DO UPDATE SET last_used = now()
+        ''', [project_id, chunk_id, len(data)])
+        g.db.commit()
+
+        return jsonify({})
+
+
+@api.route("/api/job/cache/manifest", doc=False)
+class CacheManifest(Resource):
+
+    def get(self):
+        project_id = g.token['project']['id']
+        job_name = g.token['job']['name']
+
+        r = g.db.execute_one('''
+            SELECT chunks
+            FROM cache_manifest
+            WHERE project_id = %s
+            AND job_name = %s
+        ''', [project_id, job_name])
+
+        if not r:
+            abort(404)
+
+        return jsonify({'chunks': r[0]})
+
+    def post(self):
+        project_id = g.token['project']['id']
+        job_name = g.token['job']['name']
+        chunks = (request.get_json() or {}).get('chunks', None)
+
+        if not validate_chunks(chunks):
+            abort(400, "Invalid chunks")
+
+        missing = g.db.execute_many('''
+            SELECT c
+            FROM unnest(%s::text[]) c
+            WHERE NOT EXISTS (
+                SELECT 1
+                FROM cache_chunk
+                WHERE project_id = %s
+                AND id = c
+            )
+        ''', [chunks, project_id])
+
+        if missing:
+            abort(400, "Chunks not stored: %s" % ', '.join(r[0] for r in missing))
+
+        g.db.execute('''
+            INSERT INTO cache_manifest (project_id, job_name, chunks)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (project_id, job_name)
+            DO UPDATE SET chunks = EXCLUDED.chunks, updated_at = now()
+        ''', [project_id, job_name, chunks])
+        g.db.commit()
+
+        return jsonify({})
+
+
 @api.route("/api/job/archive", doc=False)
 class Archive(Resource):
 
@@ -821,11 +980,11 @@ class Output(Resource):
             for c in clusters:
                 stream.seek(0)
                 url = '%s/api/job/output?recursive=false' % c['root_url']
-                files = {f: stream}
+                body = MultipartFile(f, stream)
                 token = encode_job_token(job_id)
-                headers = {'Authorization': 'bearer ' + token}
+                headers = {'Authorization': 'bearer ' + token, 'Content-Type': body.content_type}
                 logger.info("Uploading output of job {} to another cluster {}".format(job_id, url))
-                r = requests.post(url, files=files, headers=headers, timeout=120, verify=False)
+                r = requests.post(url, data=body, headers=headers, timeout=120, verify=False)
 
                 if r.status_code != 200:
                     logger.error(r.text)
@@ -864,11 +1023,11 @@ class OutputParent(Resource):
 
         key = "%s/%s" % (parent_job_id, filename)
 
-        f = storage.download_output(key)
+        r = storage.send_output(key)
 
-        if f:
+        if r:
             g.release_db()
-            return send_file(f)
+            return r
 
         c = g.db.execute_one_dict('''
             SELECT *
@@ -14,6 +14,8 @@ import logging
 from flask import g, abort
 from flask_restx import Resource
 
+from pyinfraboxutils import console
+from pyinfraboxutils.storage import storage
 from pyinfraboxutils.ibrestplus import api
 from api.handlers.mcp.auth import mcp_auth_required, check_project_access_mcp
 from api.handlers.mcp.rate_limit import mcp_rate_limit
@@ -24,6 +26,26 @@ logger = logging.getLogger('mcp_jobs')
 _ACCESS_DENIED = 'access to this project is not permitted for the current MCP token'
 _JOB_BY_PROJECT = 'SELECT id FROM job WHERE id = %s AND project_id = %s'
 
+
+def _job_log(job_id):
+    # Finished jobs have their output in the storage or the job,
+    # running jobs in the console table
+    job = g.db.execute_one_dict('SELECT console, console_key FROM job WHERE id = %s', [job_id])
+
+    if job['console_key']:
+        f = storage.open_console(job['console_key'])
+        if not f:
+            return ''
+
+        with f:
+            return f.read().decode('utf-8')
+
+    if job['console']:
+        return job['console']
+
+    log, _, _ = console.read(g.db, job_id)
+    return log.decode('utf-8')
+
 ns_build_jobs = api.namespace('MCP Build Jobs',
                               path='/api/v1/mcp/projects/<project_id>/builds/<build_id>',
                               description='MCP job list')
@@ -110,10 +132,7 @@ class MCPJobLog(Resource):
             abort(404)
 
         try:
-            rows = g.db.execute_many_dict('''
-                SELECT output FROM console WHERE job_id = %s ORDER BY date
-            ''', [job_id])
-            log = ''.join(r['output'] for r in rows)
+            log = _job_log(job_id)
             audit_mcp('get_job_log', outcome='success',
                       details={'project_id': project_id, 'job_id': job_id})
             return log, 200, {'Content-Type': 'text/plain; charset=utf-8'}
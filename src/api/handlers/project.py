@@ -9,7 +9,7 @@ from functools import wraps, update_wrapper
 
 import requests
 
-from flask import g, request, abort, make_response, Response, send_file
+from flask import g, request, abort, make_response, Response
 from flask_restx import Resource, fields
 
 from werkzeug.datastructures import FileStorage
@@ -421,16 +421,13 @@ class Archive(Resource):
         if result['commit_id']:
             headers['Infrabox-Commit'] = result['commit_id']
 
-        f = storage.download_archive('%s/%s' % (job_id, filename))
+        resp = storage.send_archive('%s/%s' % (job_id, filename),
+                                    mimetype=mimetypes.guess_type(os.path.basename(filename))[0])
 
-        if not f:
+        if not resp:
             abort(404)
 
-        filename = os.path.basename(filename)
-
-        resp = make_response(send_file(f, attachment_filename=filename,
-                                       mimetype=mimetypes.guess_type(filename)[0]))
-        resp.headers = headers
+        resp.headers.extend(headers)
         return resp
 
 @ns.route('/upload/<build_id>/')
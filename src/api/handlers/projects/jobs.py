@@ -3,15 +3,16 @@ import os
 import uuid
 import re
 import mimetypes
+import zlib
 
 from io import BytesIO
 
 import requests
 
-from flask import g, abort, Response, send_file, request, redirect
+from flask import g, abort, Response, send_file, request, redirect, stream_with_context
 from flask_restx import Resource, fields
 
-from pyinfraboxutils import get_logger
+from pyinfraboxutils import get_logger, console
 from pyinfraboxutils.ibflask import OK
 from pyinfraboxutils.ibrestplus import api, response_model
 from pyinfraboxutils.storage import storage
@@ -715,9 +716,15 @@ class ArchiveDownload(Resource):
 
         job_cluster = result['cluster_name']
         key = '%s/%s' % (job_id, filename)
+        basename = os.path.basename(filename)
 
-        f = storage.download_archive(key)
-        if not f and os.environ['INFRABOX_CLUSTER_NAME'] != job_cluster:
+        r = storage.send_archive(key, filename=basename, as_attachment=force_download,
+                                 mimetype=mimetypes.guess_type(basename)[0])
+        if r:
+            return r
+
+        f = None
+        if os.environ['INFRABOX_CLUSTER_NAME'] != job_cluster:
             c = g.db.execute_one_dict('''
                 SELECT *
                 FROM cluster
@@ -740,10 +747,8 @@ class ArchiveDownload(Resource):
         if not f:
             abort(404)
 
-        filename = os.path.basename(filename)
-
-        return send_file(f, as_attachment=force_download, attachment_filename=filename,\
-                         mimetype=mimetypes.guess_type(filename)[0])
+        return send_file(f, as_attachment=force_download, attachment_filename=basename,\
+                         mimetype=mimetypes.guess_type(basename)[0])
 
 @ns.route('/<job_id>/archive')
 @api.response(403, 'Not Authorized')
@@ -776,39 +781,115 @@ class ArchiveDownloadAll(Resource):
         '''
         return redirect("/api/v1/projects/%s/jobs/%s/archive/download?filename=all_archives.tar.gz" %(project_id, job_id))
 
+def _gzip(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    yield compressor.flush()
+
 @ns.route('/<job_id>/console')
 @api.response(403, 'Not Authorized')
 class Console(Resource):
 
+    @api.doc(params={'offset': 'Byte offset in the output to start from',
+                     'seq': 'Sequence number of the last chunk already read (running jobs only)'})
     def get(self, project_id, job_id):
         '''
         Returns job's console output
+
+        The output is streamed. The Infrabox-Console-Offset and Infrabox-Console-Seq
+        headers of the response can be passed as offset and seq to only get new output.
+        A byte range can be requested with the Range header instead. Without a range
+        the output is gzip compressed if the client accepts it.
         '''
+        try:
+            offset = int(request.args.get('offset', 0))
+            seq = int(request.args.get('seq', 0))
+        except ValueError:
+            abort(400, 'offset and seq must be integers')
+
+        if offset < 0 or seq < 0:
+            abort(400, 'offset and seq must not be negative')
+
         result = g.db.execute_one_dict('''
-            SELECT console
+            SELECT octet_length(console) AS size, console_key, console_size
             FROM job
             WHERE   id = %s
                 AND project_id = %s
         ''', [job_id, project_id])
 
-        if result and result['console']:
-            return Response(result['console'], mimetype='text/plain')
-
-        result = g.db.execute_many_dict('''
-            SELECT output
-            FROM console
-            WHERE job_id = %s
-            ORDER BY date
-        ''', [job_id])
-
         if not result:
             return ''
 
-        output = ''
-        for r in result:
-            output += r['output']
+        # Only the output available right now is returned, so its length is known upfront
+        stored = None
+        archived = bool(result['size'])
+        if result['console_key']:
+            # The output of a finished job has been moved into the storage,
+            # it's decompressed while it's read from there
+            stored = storage.open_console(result['console_key'])
+
+            if not stored:
+                abort(404)
+
+            length = result['console_size']
+        elif archived:
+            # The output of a finished job has been moved into the job
+            length = result['size']
+        else:
+            last_seq, length = console.last_chunk(g.db, job_id)
 
-        return Response(output, mimetype='text/plain')
+            if seq:
+                offset = max(offset, console.end_of_chunk(g.db, job_id, seq))
+
+            seq = max(seq, last_seq)
+
+        start = min(offset, length)
+        stop = length
+        status = 200
+
+        if request.range:
+            r = request.range.range_for_length(length)
+
+            if r is None:
+                if stored:
+                    stored.close()
+
+                return Response(status=416, headers={'Content-Range': 'bytes */%s' % length})
+
+            start, stop = r
+            status = 206
+
+        if stored:
+            chunks = console.stream_file(stored, start, stop)
+        elif archived:
+            chunks = console.stream_archived(g.db, job_id, start, stop)
+        else:
+            chunks = console.stream(g.db, job_id, start, stop)
+
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'Infrabox-Console-Offset': str(stop),
+            'Infrabox-Console-Seq': str(seq)
+        }
+
+        if status == 206:
+            headers['Content-Range'] = 'bytes %s-%s/%s' % (start, stop - 1, length)
+
+        if status == 200 and request.accept_encodings['gzip']:
+            chunks = _gzip(chunks)
+            headers['Content-Encoding'] = 'gzip'
+            headers['Vary'] = 'Accept-Encoding'
+        else:
+            headers['Content-Length'] = str(stop - start)
+
+        # The database connection is needed until the output has been sent
+        return Response(stream_with_context(chunks), status=status,
+                        headers=headers, mimetype='text/plain')
 
 
 @ns.route('/<job_id>/output', doc=False)
@@ -820,12 +901,13 @@ class Output(Resource):
         g.release_db()
 
         key = '%s.tar.gz' % job_id
-        f = storage.download_output(key)
+        r = storage.send_output(key, filename=key,
+                                mimetype=mimetypes.guess_type(key)[0])
 
-        if not f:
+        if not r:
             abort(404)
 
-        return send_file(f, attachment_filename=key)
+        return r
 
 @ns.route('/<job_id>/testruns', doc=False)
 @api.response(403, 'Not Authorized')
@@ -1,11 +1,18 @@
 from datetime import datetime
 
+import psycopg2
+import psycopg2.extras
+
 from flask import g, request
 from flask_restx import Resource
 
+from pyinfrabox.utils import validate_uuid
+from pyinfraboxutils import get_logger
 from pyinfraboxutils.ibrestplus import api, response_model
 from api.handlers.trigger import trigger_model, trigger_build
 
+logger = get_logger('internal')
+
 ns = api.namespace('Internal',
                    path='/internal/api',
                    description='Project related operations')
@@ -53,32 +60,51 @@ class ConsoleUpdate(Resource):
 
             data[job_id]['log'] += log
 
-        for job_id, item in list(data.items()):
-            if not item['log']:
-                continue
-
-            r = g.db.execute_one("""
-                SELECT state
-                FROM job
-                WHERE id = %s
-            """, [job_id])
-
-            if not r:
-                continue
-
-            if r[0] not in ('scheduled', 'running'):
-                continue
-
-            g.db.execute("""
-                INSERT INTO console (job_id, output, date) VALUES (%s, %s, to_timestamp(%s));
-            """, [job_id, item['log'], item['date']])
-            g.db.commit() # Commit here, updating job state later on might fail
-
-            g.db.execute("""
-                UPDATE job SET state = 'running', start_date = current_timestamp
-                WHERE id = %s
-                AND state = 'scheduled'
-            """, [job_id])
-            g.db.commit()
+        data = [(job_id, item['log'], item['date'])
+                for job_id, item in data.items()
+                if item['log'] and validate_uuid(job_id)]
+
+        if not data:
+            return {}
+
+        # Only jobs which are scheduled or running accept output
+        r = g.db.execute_many("""
+            SELECT id::text
+            FROM job
+            WHERE id = ANY(%s::uuid[])
+            AND state IN ('scheduled', 'running')
+        """, [[d[0] for d in data]])
+
+        active = set(j[0] for j in r)
+        data = [d for d in data if d[0] in active]
+
+        if not data:
+            return {}
+
+        # Appending locks the output of a job until the commit,
+        # so all batches lock the jobs in the same order
+        data.sort()
+
+        cursor = g.db.conn.cursor()
+        try:
+            psycopg2.extras.execute_values(cursor, """
+                INSERT INTO console (job_id, output, date) VALUES %s
+            """, data, template='(%s, %s, to_timestamp(%s))', page_size=len(data))
+
+            # Updating the job state might fail, the output is kept anyway
+            cursor.execute("SAVEPOINT job_state")
+            try:
+                cursor.execute("""
+                    UPDATE job SET state = 'running', start_date = current_timestamp
+                    WHERE id = ANY(%s::uuid[])
+                    AND state = 'scheduled'
+                """, [[d[0] for d in data]])
+            except psycopg2.Error as e:
+                logger.warning('Failed to update job state: %s', e)
+                cursor.execute("ROLLBACK TO SAVEPOINT job_state")
+        finally:
+            cursor.close()
+
+        g.db.commit()
 
         return {}
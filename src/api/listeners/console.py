@@ -1,61 +1,124 @@
 import json
+import os
 
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
-from eventlet.hubs import trampoline
 
 from pyinfraboxutils.db import connect_db
 from pyinfraboxutils import dbpool
 from pyinfraboxutils import get_logger
 
+from listeners.lease import always, wait
+
 logger = get_logger('console_listener')
 
-def __handle_event(event, socketio, client_manager):
+# Seconds to collect the notifications of a job before its output is pushed
+PUSH_INTERVAL = float(os.environ.get('INFRABOX_API_CONSOLE_PUSH_INTERVAL', '0.2'))
+
+# job_id -> notifications received since the last push
+__pending = {}
+
+def __handle_event(event, client_manager):
     job_id = event['job_id']
-    console_id = event['id']
 
     if not client_manager.has_clients(job_id):
         return
 
-    logger.debug('start console %s', console_id)
+    __pending.setdefault(job_id, []).append(event)
+
+def __fetch(events):
+    # Output which didn't fit into the notification
+    ids = [e['id'] for e in events if 'output' not in e]
+
+    if not ids:
+        return
+
     conn = dbpool.get()
     try:
-        r = conn.execute_one('''
-           SELECT output FROM console WHERE id = %s
-        ''', [console_id])
-        logger.debug('retrived console %s', console_id)
+        rows = conn.execute_many('''
+           SELECT id, output FROM console WHERE id = ANY(%s::uuid[])
+        ''', [ids])
+    finally:
+        dbpool.put(conn)
 
-        if not r:
-            return
+    output = dict((r[0], r[1]) for r in rows)
+    for e in events:
+        if 'output' not in e:
+            e['output'] = output.get(e['id'])
+
+def __push(socketio):
+    global __pending
+
+    pending = __pending
+    __pending = {}
+
+    __fetch([e for events in pending.values() for e in events])
+
+    for job_id, events in pending.items():
+        events.sort(key=lambda e: e['seq'])
+
+        # Only the contiguous output up to the first chunk which is missing
+        # is pushed, clients resume from the last chunk they got
+        included = []
+        for e in events:
+            if e['output'] is None:
+                break
+
+            if included and e['seq'] != included[-1]['seq'] + 1:
+                break
 
-        r = r[0]
+            included.append(e)
 
+        data = ''.join(e['output'] for e in included)
+
+        if not data:
+            continue
+
+        # The output continues the output up to the sequence number
+        # after, clients which miss something in between resume
         socketio.emit('notify:console', {
-            'data': r,
-            'job_id': job_id
+            'data': data,
+            'job_id': job_id,
+            'after': included[0]['seq'] - 1,
+            'seq': included[-1]['seq']
         }, room=job_id)
-    finally:
-        dbpool.put(conn)
-        logger.debug('stop console %s', console_id)
 
-def listen(socketio, client_manager):
+def push(socketio):
     while True:
+        socketio.sleep(PUSH_INTERVAL)
+
+        if not __pending:
+            continue
+
         try:
-            __listen(socketio, client_manager)
+            __push(socketio)
         except Exception as e:
             logger.exception(e)
 
-def __listen(socketio, client_manager):
+def listen(socketio, client_manager, leader=always):
+    socketio.start_background_task(push, socketio)
+
+    while True:
+        if not leader():
+            socketio.sleep(1)
+            continue
+
+        try:
+            __listen(client_manager, leader)
+        except Exception as e:
+            logger.exception(e)
+
+def __listen(client_manager, leader):
     conn = connect_db()
     conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
     cur = conn.cursor()
     cur.execute("LISTEN console_update")
 
     while True:
-        trampoline(conn, read=True)
+        if not wait(conn, leader):
+            conn.close()
+            return
+
         conn.poll()
         while conn.notifies:
-            n = conn.notifies.pop()
-            socketio.start_background_task(__handle_event,
-                                           json.loads(n.payload),
-                                           socketio,
-                                           client_manager)
+            n = conn.notifies.pop(0)
+            __handle_event(json.loads(n.payload), client_manager)
@@ -1,92 +1,157 @@
 import json
+from collections import OrderedDict
 
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
-from eventlet.hubs import trampoline
 
 from pyinfraboxutils import get_logger
 from pyinfraboxutils.db import connect_db
 from pyinfraboxutils import dbpool
 
+from listeners.lease import always, wait
+
 logger = get_logger('job_listener')
 
-def __handle_event(event, socketio):
+JOB_COLUMNS = '''
+    json_build_object(
+        'id', j.id,
+        'state', j.state,
+        'start_date', to_char(j.start_date, 'YYYY-MM-DD HH24:MI:SS'),
+        'type', j.type,
+        'dockerfile', j.dockerfile,
+        'end_date', to_char(j.end_date, 'YYYY-MM-DD HH24:MI:SS'),
+        'name', j.name,
+        'dependencies', j.dependencies,
+        'created_at', to_char(j.created_at, 'YYYY-MM-DD HH24:MI:SS'),
+        'message', j.message,
+        'project_id', j.project_id,
+        'build_id', j.build_id,
+        'node_name', j.node_name,
+        'avg_cpu', j.avg_cpu,
+        'definition', j.definition,
+        'restarted', j.restarted
+    ) job,
+    json_build_object(
+        'id', p.id,
+        'name', p.name,
+        'type', p.type
+    ) project,
+    json_build_object(
+        'id', b.id,
+        'build_number', b.build_number,
+        'restart_counter', b.restart_counter,
+        'commit_id', b.commit_id,
+        'is_cronjob', b.is_cronjob
+    ) build
+'''
+
+JOB_TABLES = '''
+    FROM job j
+    JOIN project p
+        ON p.id = j.project_id
+    JOIN build b
+        ON b.id = j.build_id
+'''
+
+JOB_QUERY = 'SELECT ' + JOB_COLUMNS + JOB_TABLES + 'WHERE j.id = %s'
+
+# With the commit and pull request of the build, which don't change
+JOB_COMMIT_QUERY = 'SELECT ' + JOB_COLUMNS + ''',
+    CASE WHEN c.id IS NOT NULL THEN json_build_object(
+        'id', c.id,
+        'message', split_part(c.message, '\n', 1),
+        'author_name', c.author_name,
+        'author_email', c.author_email,
+        'author_username', c.author_username,
+        'committer_name', c.committer_name,
+        'committer_email', c.committer_email,
+        'committer_username', c.committer_username,
+        'url', c.url,
+        'branch', c.branch,
+        'pull_request_id', c.pull_request_id
+    ) END AS commit,
+    CASE WHEN pr.id IS NOT NULL THEN json_build_object(
+        'title', pr.title,
+        'url', pr.url
+    ) END AS pull_request
+''' + JOB_TABLES + '''
+    LEFT JOIN commit c
+        ON c.id = b.commit_id
+        AND c.project_id = j.project_id
+    LEFT JOIN pull_request pr
+        ON pr.id = c.pull_request_id
+        AND pr.project_id = j.project_id
+    WHERE j.id = %s
+'''
+
+# Build, commit and pull request of the latest builds, which don't change
+# (except the restart counter of the build, which is always read)
+BUILD_CACHE_SIZE = 1000
+__builds = OrderedDict()
+
+def __cached_build(build_id):
+    build = __builds.get(build_id)
+
+    if build:
+        __builds.move_to_end(build_id)
+
+    return build
+
+def __cache_build(build_id, build):
+    __builds[build_id] = build
+
+    while len(__builds) > BUILD_CACHE_SIZE:
+        __builds.popitem(last=False)
+
+def __handle_event(event, socketio, client_manager):
     job_id = event['job_id']
+    build_id = event.get('build_id')
+    project_id = event.get('project_id')
+
+    if build_id and project_id and \
+            not client_manager.has_clients(build_id) and \
+            not client_manager.has_clients(project_id):
+        return
+
+    cached = __cached_build(build_id) if build_id else None
 
     db = dbpool.get()
 
     try:
-        job = db.execute_one_dict('''
-            SELECT id, state, to_char(start_date, 'YYYY-MM-DD HH24:MI:SS') start_date, type, dockerfile,
-                   to_char(end_date, 'YYYY-MM-DD HH24:MI:SS') end_date,
-                   name, dependencies, to_char(created_at, 'YYYY-MM-DD HH24:MI:SS') created_at, message,
-                   project_id, build_id, node_name, avg_cpu, definition, restarted
-            FROM job
-            WHERE id = %s
-        ''', [job_id])
-
-        if not job:
-            return
-
-        project_id = job['project_id']
-        build_id = job['build_id']
+        if cached is None:
+            r = db.execute_one_dict(JOB_COMMIT_QUERY, [job_id])
+        else:
+            r = db.execute_one_dict(JOB_QUERY, [job_id])
+    finally:
+        dbpool.put(db)
 
-        project = db.execute_one_dict('''
-            SELECT id, name, type
-            FROM project
-            WHERE id = %s
-        ''', [project_id])
+    if not r:
+        return
 
-        if not project:
-            return
+    job = r['job']
+    project = r['project']
+    build = r['build']
+    build_id = job['build_id']
+    project_id = job['project_id']
 
-        build = db.execute_one_dict('''
-            SELECT id, build_number, restart_counter, commit_id, is_cronjob
-            FROM build
-            WHERE id = %s
-        ''', [build_id])
-
-        commit_id = build['commit_id']
+    if cached is None:
+        cached = {
+            'commit': None,
+            'pull_request': None
+        }
 
-        commit = None
-        pr = None
         if project['type'] in ('gerrit', 'github'):
-            commit = db.execute_one_dict('''
-                SELECT
-                            c.id,
-                            split_part(c.message, '\n', 1) as message,
-                            c.author_name,
-                            c.author_email,
-                            c.author_username,
-                            c.committer_name,
-                            c.committer_email,
-                            c.committer_username,
-                            c.url,
-                            c.branch,
-                            c.pull_request_id
-                FROM commit c
-                WHERE c.id = %s
-                AND   c.project_id = %s
-            ''', [commit_id, project_id])
-
-            pull_request_id = commit['pull_request_id']
-
-            pr = db.execute_one_dict('''
-                SELECT title, url
-                FROM pull_request
-                WHERE id = %s
-                AND   project_id = %s
-            ''', [pull_request_id, project_id])
+            cached['commit'] = r['commit']
+            cached['pull_request'] = r['pull_request']
 
-    finally:
-        dbpool.put(db)
+        __cache_build(build_id, cached)
 
     msg = {
         'type': event['type'],
         'data': {
             'build': build,
             'project': project,
-            'commit': commit,
-            'pull_request': pr,
+            'commit': cached['commit'],
+            'pull_request': cached['pull_request'],
             'job': job
         }
     }
@@ -94,24 +159,32 @@ def __handle_event(event, socketio):
     socketio.emit('notify:job', msg, room=build_id)
     socketio.emit('notify:job', msg, room=project_id)
 
-def listen(socketio):
+def listen(socketio, client_manager, leader=always):
     while True:
+        if not leader():
+            socketio.sleep(1)
+            continue
+
         try:
-            __listen(socketio)
+            __listen(socketio, client_manager, leader)
         except Exception as e:
             logger.exception(e)
 
-def __listen(socketio):
+def __listen(socketio, client_manager, leader):
     conn = connect_db()
     conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
     cur = conn.cursor()
     cur.execute("LISTEN job_update")
 
     while True:
-        trampoline(conn, read=True)
+        if not wait(conn, leader):
+            conn.close()
+            return
+
         conn.poll()
         while conn.notifies:
             n = conn.notifies.pop()
             socketio.start_background_task(__handle_event,
                                            json.loads(n.payload),
-                                           socketio)
+                                           socketio,
+                                           client_manager)
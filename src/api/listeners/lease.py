@@ -0,0 +1,60 @@
+import uuid
+
+from eventlet.hubs import trampoline
+
+from pyinfraboxutils.db import connect_db
+from pyinfraboxutils.leader import renew_lease
+from pyinfraboxutils import get_logger
+
+logger = get_logger('listener_lease')
+
+class Lease(object):
+    ''' With a shared message queue only the API replica holding the lease listens
+    for the database events and pushes them to the clients of all replicas '''
+
+    def __init__(self, service_name):
+        self.service_name = service_name
+        self.holder = str(uuid.uuid4())
+        self.leader = False
+
+    def __call__(self):
+        return self.leader
+
+    def run(self, socketio, interval=10):
+        conn = None
+
+        while True:
+            try:
+                if not conn:
+                    conn = connect_db()
+
+                leader = renew_lease(conn, self.service_name, self.holder)
+            except Exception as e:
+                logger.exception(e)
+                leader = False
+
+                if conn:
+                    conn.close()
+                    conn = None
+
+            if leader != self.leader:
+                logger.info('%s the listener lease', 'Took over' if leader else 'Lost')
+
+            self.leader = leader
+            socketio.sleep(interval)
+
+def always():
+    return True
+
+def wait(conn, leader, timeout=5):
+    ''' Waits until there are notifications on the connection,
+    returns False if the listener should stop because it lost the lease '''
+    while leader():
+        try:
+            trampoline(conn, read=True, timeout=None if leader is always else timeout,
+                       timeout_exc=TimeoutError)
+            return True
+        except TimeoutError:
+            pass
+
+    return False
@@ -2,6 +2,7 @@
 import uuid
 import os
 import sys
+import time
 
 
 import eventlet
@@ -21,6 +22,7 @@ from pyinfraboxutils.ibflask import get_token, normalize_token
 from pyinfraboxutils.ibrestplus import api, app
 from pyinfraboxutils.ibopa import opa_do_auth, opa_start_push_loop
 from pyinfraboxutils import dbpool
+from pyinfraboxutils import console
 
 import handlers
 import settings
@@ -28,6 +30,7 @@ import internal
 
 import listeners.console
 import listeners.job
+import listeners.lease
 
 
 logger = get_logger('api')
@@ -50,8 +53,8 @@ def status():
     return jsonify({'status': "active"})
 
 class ClientManager(socketio.base_manager.BaseManager):
-    def __init__(self):
-        super(ClientManager, self).__init__()
+    def __init__(self, *args, **kwargs):
+        super(ClientManager, self).__init__(*args, **kwargs)
         self.__rooms = {}
 
     def enter_room(self, sid, namespace, room):
@@ -60,6 +63,7 @@ class ClientManager(socketio.base_manager.BaseManager):
 
         if room not in self.__rooms:
             self.__rooms[room] = 0
+            self.room_added(room)
 
         self.__rooms[room] += 1
 
@@ -70,6 +74,16 @@ class ClientManager(socketio.base_manager.BaseManager):
 
         if not self.__rooms[room]:
             del self.__rooms[room]
+            self.room_removed(room)
+
+    def room_added(self, room):
+        pass
+
+    def room_removed(self, room):
+        pass
+
+    def rooms_with_clients(self):
+        return list(self.__rooms.keys())
 
     def has_clients(self, room):
         clients = self.__rooms.get(room, None)
@@ -79,6 +93,66 @@ class ClientManager(socketio.base_manager.BaseManager):
 
         return False
 
+class RedisClientManager(ClientManager, socketio.RedisManager):
+    ''' Sends the messages to the clients of all API replicas through redis. The
+    rooms with clients of every replica are kept in redis as well, so the replica
+    listening for the database events knows the rooms without any client. '''
+    KEY = 'infrabox:api:rooms:'
+
+    def __init__(self, url):
+        super(RedisClientManager, self).__init__(url, channel='infrabox')
+
+        import redis
+        self.rooms = redis.Redis.from_url(url)
+        self.key = self.KEY + str(uuid.uuid4())
+        self.remote_rooms = set()
+        self.remote_rooms_updated = 0
+
+    def room_added(self, room):
+        try:
+            self.rooms.sadd(self.key, room)
+        except Exception as e:
+            logger.warning('Failed to add room: %s', e)
+
+    def room_removed(self, room):
+        try:
+            self.rooms.srem(self.key, room)
+        except Exception as e:
+            logger.warning('Failed to remove room: %s', e)
+
+    def has_clients(self, room):
+        if super(RedisClientManager, self).has_clients(room):
+            return True
+
+        # Joins on other replicas are seen within a second
+        if time.time() - self.remote_rooms_updated > 1:
+            try:
+                keys = list(self.rooms.scan_iter(match=self.KEY + '*'))
+                rooms = self.rooms.sunion(keys) if keys else set()
+                self.remote_rooms = set(r.decode('utf-8') for r in rooms)
+                self.remote_rooms_updated = time.time()
+            except Exception as e:
+                logger.warning('Failed to get rooms: %s', e)
+                return True
+
+        return room in self.remote_rooms
+
+    def heartbeat(self, sio, interval=10):
+        # The rooms of replicas which are gone expire
+        while True:
+            try:
+                rooms = self.rooms_with_clients()
+                pipe = self.rooms.pipeline()
+                pipe.delete(self.key)
+                if rooms:
+                    pipe.sadd(self.key, *rooms)
+                pipe.expire(self.key, interval * 3)
+                pipe.execute()
+            except Exception as e:
+                logger.warning('Failed to refresh rooms: %s', e)
+
+            sio.sleep(interval)
+
 def main(): # pragma: no cover
     get_env('INFRABOX_VERSION')
     get_env('INFRABOX_DATABASE_HOST')
@@ -98,7 +172,15 @@ def main(): # pragma: no cover
         get_env('INFRABOX_STORAGE_S3_REGION')
 
     app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024 * 1024 * 4
-    client_manager = ClientManager()
+
+    # Share the messages of all API replicas, only one of them
+    # listens for the database events then
+    message_queue = os.environ.get('INFRABOX_API_MESSAGE_QUEUE_ENABLED', 'false') == 'true'
+    if message_queue:
+        client_manager = RedisClientManager(get_env('REDIS_URL'))
+    else:
+        client_manager = ClientManager()
+
     sio = flask_socketio.SocketIO(app,
                                   path='/api/v1/socket.io',
                                   async_mode='eventlet',
@@ -159,8 +241,38 @@ def main(): # pragma: no cover
 
         flask_socketio.join_room(build_id)
 
+    def resume_console(job_id, seq):
+        # Sends the output after the sequence number seq, which the
+        # client already has, only to the client. Returns the sequence
+        # number the client is at afterwards, or tells it to reload the
+        # complete output if its chunks are not available anymore.
+        conn = dbpool.get()
+        try:
+            data, after_seq, _ = console.read(conn, job_id, seq)
+
+            if not data:
+                last_seq, _ = console.last_chunk(conn, job_id)
+
+                if last_seq < seq:
+                    # The job finished and its output has been moved
+                    return {'reload': True}
+        finally:
+            dbpool.put(conn)
+
+        if not data:
+            return {'seq': seq}
+
+        flask_socketio.emit('notify:console', {
+            'data': data.decode('utf-8'),
+            'job_id': job_id,
+            'after': seq,
+            'seq': after_seq
+        })
+
+        return {'seq': after_seq}
+
     @sio.on('listen:console')
-    def __listen_console(job_id):
+    def __listen_console(job_id, seq=None):
         logger.debug('listen:console for %s', job_id)
 
         if not job_id:
@@ -173,6 +285,10 @@ def main(): # pragma: no cover
             logger.debug('job_id not a uuid')
             return flask_socketio.disconnect()
 
+        if seq is not None and (not isinstance(seq, int) or seq < 0):
+            logger.debug('seq not a sequence number')
+            return flask_socketio.disconnect()
+
         if not sio_is_authorized(['listen:console', job_id]):
             return flask_socketio.disconnect()
 
@@ -196,10 +312,16 @@ def main(): # pragma: no cover
         finally:
             dbpool.put(conn)
 
+        # Join first, so no output is lost between reading
+        # the missing output and the next push
         flask_socketio.join_room(job_id)
 
+        if seq is not None:
+            # Acknowledged with the result
+            return resume_console(job_id, seq)
+
     @sio.on('listen:dashboard-console')
-    def __listen_dashboard_console(job_id):
+    def __listen_dashboard_console(job_id, seq=None):
         logger.debug('listen:dashboard-console for %s', job_id)
 
         if not job_id:
@@ -212,6 +334,10 @@ def main(): # pragma: no cover
             logger.debug('job_id not a uuid')
             return flask_socketio.disconnect()
 
+        if seq is not None and (not isinstance(seq, int) or seq < 0):
+            logger.debug('seq not a sequence number')
+            return flask_socketio.disconnect()
+
         conn = dbpool.get()
         try:
             u = conn.execute_one_dict('''
@@ -235,8 +361,14 @@ def main(): # pragma: no cover
         finally:
             dbpool.put(conn)
 
+        # Join first, so no output is lost between reading
+        # the missing output and the next push
         flask_socketio.join_room(job_id)
 
+        if seq is not None:
+            # Acknowledged with the result
+            return resume_console(job_id, seq)
+
     def sio_is_authorized(path):
         g.db = dbpool.get()
         try:
@@ -263,8 +395,14 @@ def main(): # pragma: no cover
 
 
     logger.info('Starting DB listeners')
-    sio.start_background_task(listeners.job.listen, sio)
-    sio.start_background_task(listeners.console.listen, sio, client_manager)
+    leader = listeners.lease.always
+    if message_queue:
+        leader = listeners.lease.Lease('api-listener-%s' % get_env('INFRABOX_CLUSTER_NAME'))
+        sio.start_background_task(leader.run, sio)
+        sio.start_background_task(client_manager.heartbeat, sio)
+
+    sio.start_background_task(listeners.job.listen, sio, client_manager, leader)
+    sio.start_background_task(listeners.console.listen, sio, client_manager, leader)
 
     logger.info('Starting repeated push of data to Open Policy Agent')
     opa_start_push_loop()
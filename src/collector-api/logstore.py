@@ -0,0 +1,340 @@
+import json
+import os
+import re
+from collections import OrderedDict
+
+from pyinfraboxutils import get_logger
+
+logger = get_logger('logstore')
+
+SEGMENT = re.compile(r'^(.+)\.log(?:\.(\d+))?$')
+
+class Container(object):
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+
+        # Sizes of the rotated segments (oldest first) and the current one,
+        # segments are numbered across all containers of the pod
+        self.segments = OrderedDict()
+        self.size = 0
+
+        # Bytes of the segments already deleted, the offset of the oldest one kept
+        self.start = 0
+
+    def log_path(self, segment=None):
+        if segment is None:
+            return os.path.join(self.path, self.name + '.log')
+
+        return os.path.join(self.path, '%s.log.%s' % (self.name, segment))
+
+    def total_size(self):
+        return sum(self.segments.values()) + self.size
+
+class Pod(object):
+    def __init__(self, path, metadata):
+        self.path = path
+        self.start = metadata.pop('start', {})
+        self.metadata = metadata
+        self.containers = {}
+        self.last_segment = 0
+
+    def size(self):
+        return sum(c.total_size() for c in self.containers.values())
+
+class LogStore(object):
+    ''' Stores the log of every container of a pod in a directory per pod.
+
+    The metadata of all pods is kept in memory and only written when a pod or
+    container is added or a segment is deleted. Log entries are appended per request with one write
+    per container, the files stay open in a LRU. The log of a container is
+    rotated into segments, the oldest segments of a pod are deleted when the
+    pod grows above max_pod_size. '''
+
+    def __init__(self, path, max_open_files=256, segment_size=16 * 1024 * 1024,
+                 max_pod_size=256 * 1024 * 1024):
+        self.path = path
+        self.max_open_files = max_open_files
+        self.segment_size = segment_size
+        self.max_pod_size = max_pod_size
+        self.pods = OrderedDict()
+        self.files = OrderedDict()
+
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        for pod_id in sorted(os.listdir(self.path)):
+            pod_path = os.path.join(self.path, pod_id)
+            metadata_path = os.path.join(pod_path, 'metadata.json')
+
+            if not os.path.exists(metadata_path):
+                continue
+
+            try:
+                with open(metadata_path) as f:
+                    pod = Pod(pod_path, json.load(f))
+            except ValueError:
+                logger.warning('Invalid metadata of pod %s', pod_id)
+                continue
+
+            for container_name in pod.metadata['containers']:
+                name = container_name.split('/')[-1]
+                pod.containers[name] = Container(pod_path, name)
+                pod.containers[name].start = pod.start.get(name, 0)
+
+            for name in os.listdir(pod_path):
+                m = SEGMENT.match(name)
+                if not m:
+                    continue
+
+                container = pod.containers.get(m.group(1))
+                if not container:
+                    container = Container(pod_path, m.group(1))
+                    container.start = pod.start.get(m.group(1), 0)
+                    pod.containers[m.group(1)] = container
+
+                size = os.path.getsize(os.path.join(pod_path, name))
+                if m.group(2) is None:
+                    container.size = size
+                else:
+                    container.segments[int(m.group(2))] = size
+
+            for container in pod.containers.values():
+                container.segments = OrderedDict(sorted(container.segments.items()))
+                pod.last_segment = max([pod.last_segment] + list(container.segments.keys()))
+
+            self.pods[pod_id] = pod
+
+        logger.info('Loaded %s pods', len(self.pods))
+
+    def _save_metadata(self, pod):
+        # Replace the file at once, so it's never read half written
+        metadata_path = os.path.join(pod.path, 'metadata.json')
+        with open(metadata_path + '.tmp', 'w') as f:
+            json.dump(dict(pod.metadata, start=pod.start), f)
+
+        os.rename(metadata_path + '.tmp', metadata_path)
+
+    def _pod(self, e):
+        pod = self.pods.get(e['pod_id'])
+        if pod:
+            return pod
+
+        pod_path = os.path.join(self.path, e['pod_id'])
+        if not os.path.exists(pod_path):
+            os.makedirs(pod_path)
+
+        pod = Pod(pod_path, {
+            'namespace_name': e['namespace_name'],
+            'pod_id': e['pod_id'],
+            'pod_name': e['pod_name'],
+            'containers': []
+        })
+        self.pods[e['pod_id']] = pod
+        self._save_metadata(pod)
+        return pod
+
+    def _container(self, pod, container_name):
+        name = container_name.split('/')[-1]
+
+        container = pod.containers.get(name)
+        if container:
+            return container
+
+        # The first log entry of the container, register it in the metadata
+        container = Container(pod.path, name)
+        pod.containers[name] = container
+        pod.metadata['containers'].append(container_name)
+        self._save_metadata(pod)
+        return container
+
+    def _open(self, path):
+        f = self.files.get(path)
+        if f:
+            self.files.move_to_end(path)
+            return f
+
+        f = open(path, 'ab')
+        self.files[path] = f
+
+        while len(self.files) > self.max_open_files:
+            _, old = self.files.popitem(last=False)
+            old.close()
+
+        return f
+
+    def _close(self, path):
+        f = self.files.pop(path, None)
+        if f:
+            f.close()
+
+    def _rotate(self, pod, container):
+        self._close(container.log_path())
+
+        pod.last_segment += 1
+        os.rename(container.log_path(), container.log_path(pod.last_segment))
+        container.segments[pod.last_segment] = container.size
+        container.size = 0
+
+        # Drop the oldest segments of the pod until it fits again
+        while pod.size() > self.max_pod_size:
+            oldest = None
+            for c in pod.containers.values():
+                if c.segments and (not oldest or next(iter(c.segments)) < next(iter(oldest.segments))):
+                    oldest = c
+
+            if not oldest:
+                break
+
+            segment, size = oldest.segments.popitem(last=False)
+            os.remove(oldest.log_path(segment))
+
+            # Offsets stay the same for clients reading the log
+            oldest.start += size
+            pod.start[oldest.name] = oldest.start
+            self._save_metadata(pod)
+
+    def append(self, entries):
+        ''' Appends the log entries of a fluent-bit batch '''
+        logs = OrderedDict()
+
+        for entry in entries:
+            if 'kubernetes' not in entry:
+                continue
+
+            e = entry['kubernetes']
+            pod = self._pod(e)
+            container = self._container(pod, e['container_name'])
+
+            if 'log' in entry:
+                log = entry['log'].replace('\x00', '\n')
+                if not log.endswith('\n'):
+                    log = log + '\n'
+
+                logs.setdefault((pod, container), []).append(log)
+
+        for (pod, container), lines in logs.items():
+            data = ''.join(lines).encode('utf-8')
+
+            f = self._open(container.log_path())
+            f.write(data)
+            f.flush()
+            container.size += len(data)
+
+            if container.size >= self.segment_size:
+                self._rotate(pod, container)
+
+    def list_pods(self):
+        return [p.metadata for p in self.pods.values()]
+
+    def get_pod(self, pod_id):
+        pod = self.pods.get(pod_id)
+
+        if not pod:
+            return None
+
+        return pod.metadata
+
+    def get_container(self, pod_id, container_name):
+        pod = self.pods.get(pod_id)
+
+        if not pod:
+            return None
+
+        return pod.containers.get(container_name.split('/')[-1])
+
+    def open(self, pod_id, container_name):
+        ''' Opens the log of the container as it is right now, None if there is none '''
+        container = self.get_container(pod_id, container_name)
+
+        if not container:
+            return None
+
+        segments = [(container.log_path(s), size) for s, size in container.segments.items()]
+        segments.append((container.log_path(), container.size))
+
+        files = []
+        for path, size in segments:
+            if size and os.path.exists(path):
+                files.append((open(path, 'rb'), size))
+
+        return Log(files, container.start)
+
+    def read(self, pod_id, container_name):
+        ''' Returns the log of the container, None if there is none '''
+        log = self.open(pod_id, container_name)
+
+        if log is None:
+            return None
+
+        return b''.join(log.read(log.start, log.size))
+
+class Log(object):
+    ''' The segments of a container log opened at once, so rotating and deleting
+    them doesn't change what is read. Offsets are counted from the beginning
+    of the log, including the segments already deleted. The log is kept from
+    start up to size. '''
+
+    def __init__(self, files, start=0):
+        self.files = files
+        self.start = start
+        self.size = start + sum(size for _, size in files)
+
+    def close(self):
+        for f, _ in self.files:
+            f.close()
+
+    def _blocks(self, start, stop, block_size):
+        # Yields (file, position in the file, length) to read start to stop
+        offset = self.start
+        for f, size in self.files:
+            if offset + size > start and offset < stop:
+                begin = max(start - offset, 0)
+                end = min(stop - offset, size)
+
+                while begin < end:
+                    length = min(block_size, end - begin)
+                    yield f, begin, length
+                    begin += length
+
+            offset += size
+
+    def read(self, start, stop, block_size=64 * 1024):
+        ''' Yields the log from start to stop (exclusive) and closes the files '''
+        try:
+            for f, position, length in self._blocks(start, stop, block_size):
+                f.seek(position)
+                yield f.read(length)
+        finally:
+            self.close()
+
+    def tail(self, lines, block_size=64 * 1024):
+        ''' Returns the offset at which the last lines start '''
+        if lines <= 0:
+            return self.size
+
+        blocks = list(self._blocks(self.start, self.size, block_size))
+        end = self.size
+        found = 0
+
+        for f, position, length in reversed(blocks):
+            f.seek(position)
+            data = f.read(length)
+            end -= length
+
+            i = len(data)
+            while True:
+                i = data.rfind(b'\n', 0, i)
+                if i < 0:
+                    break
+
+                # The newline ending the last line doesn't start a line
+                if end + i == self.size - 1:
+                    continue
+
+                found += 1
+                if found == lines:
+                    return end + i + 1
+
+        return self.start
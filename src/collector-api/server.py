@@ -12,10 +12,17 @@ eventlet.monkey_patch()
 
 from pyinfraboxutils import get_logger
 
+from logstore import LogStore
+
 logger = get_logger('api')
 
 storage_path = '/tmp/collector/'
 
+store = LogStore(storage_path,
+                 max_open_files=int(os.environ.get('INFRABOX_COLLECTOR_MAX_OPEN_FILES', 256)),
+                 segment_size=int(os.environ.get('INFRABOX_COLLECTOR_SEGMENT_SIZE', 16 * 1024 * 1024)),
+                 max_pod_size=int(os.environ.get('INFRABOX_COLLECTOR_MAX_POD_SIZE', 256 * 1024 * 1024)))
+
 app = Flask(__name__)
 app.config['OPA_ENABLED'] = False
 api = Api(app)
@@ -26,99 +33,71 @@ class Ping(Resource):
     def get(self):
         return {'status': 200}
 
-def handle_entry(entry):
-    if 'kubernetes' not in entry:
-        return
-
-    e = entry['kubernetes']
-    pod_path = os.path.join(storage_path, e['pod_id'])
-
-    if not os.path.exists(pod_path):
-        os.makedirs(pod_path)
-
-    metadata_path = os.path.join(pod_path, "metadata.json")
-    container_name = e['container_name']
-    if '/' in container_name:
-        container_name = container_name.split("/")[-1]
-    log_path = os.path.join(pod_path, container_name +".log")
-
-    if not os.path.exists(metadata_path):
-        with open(metadata_path, 'w+') as metadata_file:
-            md = {
-                'namespace_name': e['namespace_name'],
-                'pod_id': e['pod_id'],
-                'pod_name': e['pod_name'],
-                'containers': []
-            }
-            json.dump(md, metadata_file)
-
-    if not os.path.exists(log_path):
-        # this is the first log entry we receive, so also register it in the metadata
-        with open(metadata_path, 'r') as metadata_file:
-            md = json.load(metadata_file)
-            md['containers'].append(e['container_name'])
-
-        with open(metadata_path, 'w') as metadata_file:
-            json.dump(md, metadata_file)
-
-    if 'log' in entry:
-        with open(log_path, 'a+') as log_file:
-            log = entry['log']
-            log = log.replace('\x00', '\n')
-            if not log.endswith('\n'):
-                log = log + '\n'
-            log_file.write(log)
-
 @api.route('/api/log')
 class Console(Resource):
     def post(self):
         entries = request.get_json()
-
-        for e in entries:
-            handle_entry(e)
+        store.append(entries)
 
         return {'status': 200}
 
 @api.route('/api/pods')
 class Pods(Resource):
     def get(self):
-        pods = []
-        for root, dirs, _ in os.walk(storage_path):
-            for name in dirs:
-                p = os.path.join(root, name, 'metadata.json')
-                with open(p) as f:
-                    pods.append(json.load(f))
-
-        return pods
+        return store.list_pods()
 
 @api.route('/api/pods/<pod_id>')
 class Pod(Resource):
     def get(self, pod_id):
-        p = os.path.join(os.path.join(storage_path), pod_id, 'metadata.json')
+        pod = store.get_pod(pod_id)
 
-        if not p.startswith(storage_path):
+        if not pod:
             abort(404)
 
-        if not os.path.exists(p):
-            abort(404)
-
-        with open(p) as f:
-            return json.load(f)
+        return pod
 
 @api.route('/api/pods/<pod_id>/log/<container_name>')
 class PodLog(Resource):
     def get(self, pod_id, container_name):
-        p = os.path.join(os.path.join(storage_path), pod_id, container_name + '.log')
-
-        if not p.startswith(storage_path):
+        '''
+        Returns the log of the container
+
+        With offset and limit only limit bytes starting at the byte offset are
+        returned, with tail only the last lines. The Infrabox-Log-Offset header
+        contains the offset to continue from. Offsets which were already
+        deleted by the rotation continue from the oldest log still kept.
+        '''
+        try:
+            offset = int(request.args.get('offset', 0))
+            limit = request.args.get('limit', None)
+            limit = int(limit) if limit is not None else None
+            tail = request.args.get('tail', None)
+            tail = int(tail) if tail is not None else None
+        except ValueError:
+            abort(400, 'offset, limit and tail must be integers')
+
+        if offset < 0 or (limit is not None and limit < 0) or (tail is not None and tail < 0):
+            abort(400, 'offset, limit and tail must not be negative')
+
+        log = store.open(pod_id, container_name)
+
+        if log is None:
             abort(404)
 
-        if not os.path.exists(p):
-            abort(404)
+        start = max(min(offset, log.size), log.start)
+        if tail is not None:
+            start = max(start, log.tail(tail))
+
+        stop = log.size
+        if limit is not None:
+            stop = min(stop, start + limit)
+
+        headers = {
+            'Content-Length': str(stop - start),
+            'Infrabox-Log-Offset': str(stop)
+        }
 
-        with open(p) as f:
-            d = f.read()
-            return Response(d, mimetype='text/plain')
+        return Response(log.read(start, stop), mimetype='text/plain', headers=headers)
 
 def main(): # pragma: no cover
     app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024 * 1024 * 4
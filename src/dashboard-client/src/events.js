@@ -39,8 +39,13 @@ export default new Vue({
         listenJobs (project) {
             this.$socket.emit('listen:jobs', project.id)
         },
-        listenConsole (id) {
-            this.$socket.emit('listen:dashboard-console', id)
+        listenConsole (id, seq, done) {
+            if (done) {
+                // Called with the result once the missing output has been sent
+                this.$socket.emit('listen:dashboard-console', id, seq, done)
+            } else {
+                this.$socket.emit('listen:dashboard-console', id, seq)
+            }
         }
     }
 })
@@ -105,6 +105,8 @@ export default class Job {
         this.currentSection = null
         this.linesProcessed = 0
         this.hasLogsAvailable = false
+        this.consoleSeq = null
+        this.consoleResuming = false
         this.message = message
         this.definition = definition
         this.nodeName = nodeName
@@ -238,17 +240,19 @@ export default class Job {
             })
     }
 
-    loadConsole () {
-        if (this.sections.length) {
+    loadConsole (reload = false) {
+        if (this.sections.length && !reload) {
             return
         }
 
-        return NewAPIService.get(`projects/${this.project.id}/jobs/${this.id}/console`)
-            .then((console) => {
-                store.commit('setConsole', { job: this, console: console })
-                events.listenConsole(this.id)
+        return NewAPIService.getResponse(`projects/${this.project.id}/jobs/${this.id}/console`)
+            .then((response) => {
+                const seq = parseInt(response.headers.get('Infrabox-Console-Seq'), 10) || 0
+                store.commit('setConsole', { job: this, console: response.body, seq: seq, reload: reload })
+                events.listenConsole(this.id, seq)
             })
             .catch((err) => {
+                this.consoleResuming = false
                 NotificationService.$emit('NOTIFICATION', new Notification(err))
             })
     }
@@ -329,7 +333,7 @@ export default class Job {
     }
 
     listenConsole () {
-        events.listenConsole(this.id)
+        events.listenConsole(this.id, this.consoleSeq)
     }
 
     downloadOutput () {
@@ -27,6 +27,13 @@ class NewAPIService {
             .catch(this._handleError(ignoreUnauthorized))
     }
 
+    getResponse (url, ignoreUnauthorized) {
+        const u = this.api + url
+        console.log(`GET API: ${url}`)
+        return Vue.http.get(u)
+            .catch(this._handleError(ignoreUnauthorized))
+    }
+
     openAPIUrl (u) {
         const url = this.api + u
         window.open(url, '_blank')
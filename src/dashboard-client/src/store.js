@@ -300,15 +300,60 @@ function handleConsoleUpdate (state, update) {
         return
     }
 
+    if (update.seq !== undefined && job.consoleSeq !== null) {
+        if (update.seq <= job.consoleSeq) {
+            // Already received
+            return
+        }
+
+        if (update.after !== job.consoleSeq) {
+            // Output is missing, get it again from the last output received
+            if (!job.consoleResuming) {
+                resumeConsole(job)
+            }
+
+            return
+        }
+
+        job.consoleSeq = update.seq
+    }
+
     const lines = update.data.split('\n')
     job._addLines(lines)
 }
 
+function resumeConsole (job) {
+    job.consoleResuming = true
+    events.listenConsole(job.id, job.consoleSeq, (result) => {
+        store.commit('consoleResumed', { job: job, result: result })
+    })
+}
+
+function consoleResumed (state, data) {
+    const job = data.job
+    job.consoleResuming = false
+
+    if (!data.result || data.result.reload) {
+        // The missing output is not available anymore, get all of it again
+        job.consoleResuming = true
+        job.loadConsole(true)
+    }
+}
+
 function setConsole (state, data) {
     const job = data.job
     const console = data.console
     const lines = console.split('\n')
+
+    if (data.reload) {
+        job.sections = []
+        job.currentSection = null
+        job.linesProcessed = 0
+    }
+
     job._addLines(lines)
+    job.consoleSeq = data.seq
+    job.consoleResuming = false
 }
 
 function deleteProject (state, projectId) {
@@ -363,6 +408,7 @@ const mutations = {
     setUser,
     setGithubRepos,
     handleConsoleUpdate,
+    consoleResumed,
     deleteProject,
     setSettings,
     setBadges,
@@ -399,4 +445,14 @@ events.$on('NOTIFY_CONSOLE', (update) => {
     store.commit('handleConsoleUpdate', update)
 })
 
+events.$on('CONNECTED', () => {
+    // Only get the output missed while disconnected
+    for (const id of Object.keys(store.state.jobs)) {
+        const job = store.state.jobs[id]
+        if (job.consoleSeq !== null) {
+            resumeConsole(job)
+        }
+    }
+})
+
 export default store
@@ -0,0 +1 @@
+CREATE INDEX job_queued_cluster_name_idx ON job USING btree (cluster_name, created_at) WHERE state = 'queued';
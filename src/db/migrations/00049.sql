@@ -0,0 +1,3 @@
+-- Share of the concurrently running jobs a project gets if the scheduler
+-- runs in fair share mode, relative to the weights of the other projects.
+ALTER TABLE "project" ADD COLUMN scheduler_weight integer DEFAULT 1 NOT NULL CHECK (scheduler_weight > 0);
@@ -0,0 +1,22 @@
+CREATE FUNCTION project_credentials_notify() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+	IF TG_OP = 'DELETE' THEN
+		PERFORM pg_notify('project_credentials', OLD.project_id::text);
+		RETURN OLD;
+	END IF;
+
+	PERFORM pg_notify('project_credentials', NEW.project_id::text);
+
+	IF TG_OP = 'UPDATE' AND OLD.project_id IS DISTINCT FROM NEW.project_id THEN
+		PERFORM pg_notify('project_credentials', OLD.project_id::text);
+	END IF;
+
+	RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER secret_credentials_notify AFTER INSERT OR UPDATE OR DELETE ON secret FOR EACH ROW EXECUTE PROCEDURE project_credentials_notify();
+CREATE TRIGGER sshkey_credentials_notify AFTER INSERT OR UPDATE OR DELETE ON sshkey FOR EACH ROW EXECUTE PROCEDURE project_credentials_notify();
+CREATE TRIGGER repository_credentials_notify AFTER INSERT OR UPDATE OR DELETE ON repository FOR EACH ROW EXECUTE PROCEDURE project_credentials_notify();
@@ -0,0 +1,47 @@
+-- The console output of a job is appended in chunks numbered per job.
+-- end_offset is the byte offset at which a chunk ends in the complete
+-- output, so readers can continue from a sequence number or byte offset.
+ALTER TABLE console ADD COLUMN seq bigint;
+ALTER TABLE console ADD COLUMN end_offset bigint;
+
+UPDATE console c
+SET seq = s.seq, end_offset = s.end_offset
+FROM (
+    SELECT id,
+           row_number() OVER w AS seq,
+           sum(octet_length(output)) OVER w AS end_offset
+    FROM console
+    WINDOW w AS (PARTITION BY job_id ORDER BY date, id)
+) s
+WHERE c.id = s.id;
+
+ALTER TABLE console ALTER COLUMN seq SET NOT NULL;
+ALTER TABLE console ALTER COLUMN end_offset SET NOT NULL;
+
+CREATE UNIQUE INDEX console_job_id_seq_idx ON console USING btree (job_id, seq);
+CREATE INDEX console_job_id_end_offset_idx ON console USING btree (job_id, end_offset);
+
+CREATE FUNCTION console_append() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+	-- Appends to the output of the same job are serialized
+	PERFORM pg_advisory_xact_lock(hashtext(NEW.job_id::text));
+
+	SELECT c.seq + 1, c.end_offset + octet_length(NEW.output)
+	INTO NEW.seq, NEW.end_offset
+	FROM console c
+	WHERE c.job_id = NEW.job_id
+	ORDER BY c.seq DESC
+	LIMIT 1;
+
+	IF NEW.seq IS NULL THEN
+		NEW.seq := 1;
+		NEW.end_offset := octet_length(NEW.output);
+	END IF;
+
+	RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER console_append_insert BEFORE INSERT ON console FOR EACH ROW EXECUTE PROCEDURE console_append();
@@ -0,0 +1,5 @@
+-- The console output of a finished job can be kept gzip compressed in the
+-- object storage instead of the console column. console_size is the size
+-- of the uncompressed output in bytes.
+ALTER TABLE job ADD COLUMN console_key character varying;
+ALTER TABLE job ADD COLUMN console_size bigint;
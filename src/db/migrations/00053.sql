@@ -0,0 +1,30 @@
+-- The console notification carries the sequence number of the chunk and,
+-- if the payload stays well below the 8000 bytes limit of pg_notify, the
+-- output itself, so listeners don't have to read the chunk again.
+CREATE OR REPLACE FUNCTION console_notify() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+	payload text;
+BEGIN
+	IF TG_OP = 'DELETE' THEN
+		RETURN OLD;
+	END IF;
+
+	IF TG_OP = 'UPDATE' THEN
+		RETURN NEW;
+	END IF;
+
+	IF octet_length(NEW.output) <= 7000 THEN
+		payload := json_build_object('id', NEW.id, 'job_id', NEW.job_id, 'seq', NEW.seq, 'output', NEW.output)::text;
+	END IF;
+
+	IF payload IS NULL OR octet_length(payload) > 7000 THEN
+		payload := json_build_object('id', NEW.id, 'job_id', NEW.job_id, 'seq', NEW.seq)::text;
+	END IF;
+
+	PERFORM pg_notify('console_update', payload);
+
+	RETURN NEW;
+END;
+$$;
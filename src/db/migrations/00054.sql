@@ -0,0 +1,17 @@
+-- The job_update notification names the build and project of the job,
+-- so listeners can skip jobs nobody is interested in without a query.
+CREATE OR REPLACE FUNCTION job_queue_notify() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+BEGIN
+	IF TG_OP = 'DELETE' THEN
+		RETURN OLD;
+	END IF;
+
+	PERFORM pg_notify('job_update', json_build_object('type', TG_OP, 'job_id', NEW.id, 'state', NEW.state,
+	                                                  'build_id', NEW.build_id, 'project_id', NEW.project_id)::text);
+
+  RETURN NEW;
+END;
+$$;
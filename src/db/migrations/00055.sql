@@ -0,0 +1,18 @@
+-- Content-addressed job caches: a chunk is stored once per project under the
+-- sha256 of its content, the manifest lists the chunks of the cache of a job.
+-- last_used is updated whenever a job finds the chunk already stored.
+CREATE TABLE cache_chunk (
+    project_id uuid NOT NULL,
+    id character varying(64) NOT NULL,
+    size bigint NOT NULL,
+    last_used timestamp with time zone DEFAULT now() NOT NULL,
+    PRIMARY KEY (project_id, id)
+);
+
+CREATE TABLE cache_manifest (
+    project_id uuid NOT NULL,
+    job_name character varying NOT NULL,
+    chunks character varying(64)[] NOT NULL,
+    updated_at timestamp with time zone DEFAULT now() NOT NULL,
+    PRIMARY KEY (project_id, job_name)
+);
@@ -27,11 +27,13 @@ class GC(object):
             time.sleep(3600)
 
     def _gc(self, db):
+        self._gc_job_console_storage(db)
         self._gc_job_console_output(db)
         self._gc_job_output(db)
         self._gc_test_runs(db)
         self._gc_orphaned_projects(db)
         self._gc_storage_job_cache(db)
+        self._gc_storage_cache_chunks(db)
         self._gc_swift()
 
     def _gc_job_console_output(self, db):
@@ -55,6 +57,29 @@ class GC(object):
 
         db.commit()
 
+    def _gc_job_console_storage(self, db):
+        # Delete the console output in the storage
+        # of jobs which are older than 30 days
+        r = db.execute_many_dict('''
+            SELECT id, console_key
+            FROM job
+            WHERE created_at < NOW() - INTERVAL '30 days'
+            AND console_key IS NOT NULL
+        ''')
+
+        logger.info('Deleting stored console output of %s jobs', len(r))
+
+        for j in r:
+            storage.delete_console(j['console_key'])
+
+            db.execute('''
+                UPDATE job
+                SET console = 'deleted', console_key = NULL, console_size = NULL
+                WHERE id = %s
+            ''', [j['id']])
+
+            db.commit()
+
     def _gc_test_runs(self, db):
         # Delete the test_runs
         # which are older than 30 days
@@ -101,7 +126,7 @@ class GC(object):
             'auth_token', 'build', 'collaborator', 'commit',
             'job', 'job_badge', 'job_markup', 'measurement',
             'pull_request', 'repository', 'secret', 'source_upload',
-            'test_run'
+            'test_run', 'cache_manifest'
         ]
         for t in tables:
             self._gc_table_content_of_deleted_project(db, t)
@@ -168,6 +193,46 @@ class GC(object):
             key = 'project_%s_job_%s.tar.snappy' % (j['project_id'], j['name'])
             storage.delete_cache(key)
 
+    def _gc_storage_cache_chunks(self, db):
+        # Delete the content-addressed caches of all jobs which
+        # have not been executed in the last 7 days and then
+        # all chunks not used by a cache for more than a day
+        db.execute('''
+            DELETE
+            FROM cache_manifest
+            WHERE updated_at < NOW() - INTERVAL '7 days'
+        ''')
+        db.commit()
+
+        r = db.execute_many_dict('''
+            SELECT project_id, id
+            FROM cache_chunk c
+            WHERE last_used < NOW() - INTERVAL '1 day'
+            AND NOT EXISTS (
+                SELECT 1
+                FROM cache_manifest m
+                WHERE m.project_id = c.project_id
+                AND c.id = ANY(m.chunks)
+            )
+        ''')
+
+        logger.info('Deleting %s cache chunks', len(r))
+
+        for c in r:
+            # Unless a job found it in the meantime
+            deleted = db.execute_many('''
+                DELETE
+                FROM cache_chunk
+                WHERE project_id = %s
+                AND id = %s
+                AND last_used < NOW() - INTERVAL '1 day'
+                RETURNING id
+            ''', [c['project_id'], c['id']])
+            db.commit()
+
+            if deleted:
+                storage.delete_cache('chunks/%s/%s' % (c['project_id'], c['id']))
+
 def main():
     get_env('INFRABOX_DATABASE_DB')
     get_env('INFRABOX_DATABASE_USER')
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import subprocess
+import tarfile
+import zlib
+
+# A chunk is cut after a file once it's larger than MIN_CHUNK_SIZE, on average
+# at AVG_CHUNK_SIZE. Files which don't fit are cut every MAX_CHUNK_SIZE bytes.
+MIN_CHUNK_SIZE = 1024 * 1024
+AVG_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+
+class ChunkStore(object):
+    ''' Local store of cache chunks, named by the sha256 of their content
+    and kept zlib compressed like in the storage '''
+
+    def __init__(self, path):
+        self.path = path
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def _path(self, chunk_id):
+        return os.path.join(self.path, chunk_id)
+
+    def _write(self, chunk_id, compressed):
+        path = self._path(chunk_id)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(compressed)
+
+        os.rename(path + '.tmp', path)
+
+    def has(self, chunk_id):
+        return os.path.exists(self._path(chunk_id))
+
+    def put(self, data):
+        chunk_id = hashlib.sha256(data).hexdigest()
+
+        if not self.has(chunk_id):
+            self._write(chunk_id, zlib.compress(data, 1))
+
+        return chunk_id
+
+    def put_compressed(self, chunk_id, compressed):
+        if hashlib.sha256(zlib.decompress(compressed)).hexdigest() != chunk_id:
+            raise ValueError('Chunk %s does not match its content' % chunk_id)
+
+        self._write(chunk_id, compressed)
+
+    def read(self, chunk_id):
+        return zlib.decompress(self.read_compressed(chunk_id))
+
+    def read_compressed(self, chunk_id):
+        with open(self._path(chunk_id), 'rb') as f:
+            return f.read()
+
+class ChunkWriter(object):
+    ''' File object for tarfile which cuts the tar stream into chunks.
+
+    The chunk boundaries only depend on the files (their name, size and
+    modification time), so adding or changing a file only changes the
+    chunks around it and all others are found in the storage again. '''
+
+    def __init__(self, store):
+        self.store = store
+        self.chunks = []
+        self.buffer = bytearray()
+        self.offset = 0
+        self.member = None
+
+    def _cut(self, size):
+        self.chunks.append(self.store.put(bytes(self.buffer[:size])))
+        del self.buffer[:size]
+
+    def tell(self):
+        return self.offset
+
+    def write(self, data):
+        self.offset += len(data)
+        self.buffer += data
+
+        while len(self.buffer) >= MAX_CHUNK_SIZE:
+            self._cut(MAX_CHUNK_SIZE)
+
+    def next_member(self, tarinfo):
+        # Called before a member is written, the previous one is complete
+        member = self.member
+        self.member = tarinfo
+
+        if member and len(self.buffer) >= MIN_CHUNK_SIZE:
+            h = hashlib.sha256(('%s:%s:%s' % (member.name, member.size, member.mtime)).encode('utf-8'))
+
+            # Cut with a probability proportional to the size of the file
+            if int(h.hexdigest()[:8], 16) < 2 ** 32 * (member.size + tarfile.BLOCKSIZE) / (AVG_CHUNK_SIZE - MIN_CHUNK_SIZE):
+                self._cut(len(self.buffer))
+
+        return tarinfo
+
+    def close(self):
+        if self.buffer:
+            self._cut(len(self.buffer))
+
+def write_chunks(source, store):
+    ''' Writes the directory as tar into chunks of the store,
+    returns the ids of the chunks in order '''
+    writer = ChunkWriter(store)
+
+    with tarfile.open(fileobj=writer, mode='w', format=tarfile.PAX_FORMAT) as tar:
+        tar.add(source, arcname='.', filter=writer.next_member)
+
+    writer.close()
+    return writer.chunks
+
+def read_chunks(chunks, store, output):
+    ''' Extracts the tar of the chunks of the store into the directory '''
+    p = subprocess.Popen(['tar', '-xf', '-', '-C', output], stdin=subprocess.PIPE)
+
+    try:
+        for chunk_id in chunks:
+            p.stdin.write(store.read(chunk_id))
+    finally:
+        p.stdin.close()
+
+    if p.wait() != 0:
+        raise Exception('Failed to extract the cache (%s)' % p.returncode)
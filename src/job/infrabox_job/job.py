@@ -1,13 +1,20 @@
 import os
 import sys
 import json
-import glob
 import copy
 import time
 import shutil
 import requests
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from pyinfraboxutils.multipart import MultipartFile
 
 from infrabox_job.process import Failure, Error
+from infrabox_job.cache import write_chunks, read_chunks
+
+# Chunks of the content-addressed cache transferred at once
+CACHE_CONCURRENCY = 8
 
 class Job(object):
     def __init__(self):
@@ -234,26 +241,77 @@ class Job(object):
 
             raise Error('Failed to download file(%s): %s' % (r.status_code, msg))
 
+    def get_file_list_from_api_server(self, url):
+        ''' Returns the parts of a file uploaded with split, None if there is none '''
+        # Parents may have just uploaded their output, wait as long as for a download
+        r = self._request_api_server('GET', url + "?filename=output.json", retries=20, retry_time=10)
+
+        if r.status_code == 404:
+            return None
+
+        return r.json()
+
+    def stream_file_from_api_server(self, url, files, out):
+        ''' Writes the parts of a file uploaded with split to out, interrupted
+        downloads are resumed where they stopped. Returns the number of bytes. '''
+        size = 0
+
+        for f in files:
+            received = 0
+            message = None
+
+            for _ in range(0, 20):
+                headers = self.get_headers()
+                if received:
+                    headers['Range'] = 'bytes=%s-' % received
+
+                try:
+                    r = requests.get("%s%s?filename=%s" % (self.api_server, url, f),
+                                     headers=headers, timeout=600, stream=True, verify=self.verify)
+
+                    if r.status_code not in (200, 206):
+                        raise Error('Failed to download %s (%s)' % (f, r.status_code))
+
+                    # Skip what was already written if the range was ignored
+                    skip = received if r.status_code == 200 else 0
+
+                    for chunk in r.iter_content(chunk_size=1024 * 1024):
+                        if skip:
+                            n = min(skip, len(chunk))
+                            chunk = chunk[n:]
+                            skip -= n
+
+                        if chunk:
+                            out.write(chunk)
+                            received += len(chunk)
+
+                    message = None
+                    break
+                except (requests.exceptions.RequestException, Error) as e:
+                    message = str(e)
+                    self.console.collect('Failed to download file (%s), retrying' % message, show=True)
+                    time.sleep(10)
+
+            if message:
+                raise Error('Failed to download file: %s' % message)
+
+            size += received
+
+        return size
+
     def post_file_to_api_server(self, url, path, filename=None, split=False):
         if not filename:
             filename = os.path.basename(path)
 
         if split:
-            self.console.execute(["split", "-b", "64m", path, path + "-"], show=True)
-            files = glob.glob(path + "-*")
-            files.sort()
-
-            filenames = []
-            for f in files:
-                filenames.append(os.path.basename(f))
+            # The file is stored as one object (the storage uploads it in parts),
+            # the file list keeps it readable for jobs which download the parts
+            self._post_file_to_api_server(url, path, filename)
 
             with open('/tmp/files.json', 'w') as out:
-                json.dump(filenames, out)
+                json.dump([filename], out)
 
             self._post_file_to_api_server(url, '/tmp/files.json', 'output.json')
-
-            for f in files:
-                self._post_file_to_api_server(url, f, os.path.basename(f))
         else:
             self._post_file_to_api_server(url, path, filename)
 
@@ -265,11 +323,14 @@ class Job(object):
 
         for _ in range(0, 5):
             message = None
-            files = {filename: open(path, "rb")}
             try:
-                r = requests.post("%s%s" % (self.api_server, url),
-                                  headers=self.get_headers(),
-                                  files=files, timeout=600, verify=self.verify)
+                with open(path, "rb") as f:
+                    body = MultipartFile(filename, f)
+                    headers = self.get_headers()
+                    headers['Content-Type'] = body.content_type
+                    r = requests.post("%s%s" % (self.api_server, url),
+                                      headers=headers,
+                                      data=body, timeout=600, verify=self.verify)
             except Exception as e:
                 message = str(e)
                 retry_time *= 2
@@ -289,3 +350,74 @@ class Job(object):
                 return
 
         raise Error('Failed to upload file: %s' % message)
+
+    def _request_api_server(self, method, url, retries=5, retry_time=5, **kwargs):
+        # Retried a few times, returns the response if it's found or not
+        message = None
+
+        for _ in range(0, retries):
+            try:
+                r = requests.request(method, "%s%s" % (self.api_server, url),
+                                     headers=self.get_headers(),
+                                     timeout=600, verify=self.verify, **kwargs)
+
+                if r.status_code in (200, 404):
+                    return r
+
+                message = r.text
+            except Exception as e:
+                message = str(e)
+
+            time.sleep(retry_time)
+
+        raise Error('Request to the API failed: %s' % message)
+
+    def upload_cache_chunks(self, source, store):
+        chunks = write_chunks(source, store)
+        unique = list(OrderedDict.fromkeys(chunks))
+
+        r = self._request_api_server('POST', '/cache/chunks', json={'chunks': unique})
+
+        if r.status_code != 200:
+            raise Error('Failed to upload the cache: %s' % r.text)
+
+        missing = r.json()['missing']
+
+        size = sum(len(store.read_compressed(c)) for c in missing)
+        self.console.collect('Uploading %s of %s chunks (%s kb)' % (len(missing), len(unique), size // 1024),
+                             show=True)
+
+        def _upload(chunk_id):
+            self._request_api_server('POST', '/cache/chunks/%s' % chunk_id,
+                                data=store.read_compressed(chunk_id))
+
+        with ThreadPoolExecutor(max_workers=CACHE_CONCURRENCY) as executor:
+            list(executor.map(_upload, missing))
+
+        self._request_api_server('POST', '/cache/manifest', json={'chunks': chunks})
+
+    def download_cache_chunks(self, store, output):
+        ''' Restores the cache from its chunks, returns False if there is no manifest '''
+        r = self._request_api_server('GET', '/cache/manifest')
+
+        if r.status_code == 404:
+            return False
+
+        chunks = r.json()['chunks']
+        missing = [c for c in OrderedDict.fromkeys(chunks) if not store.has(c)]
+
+        self.console.collect('Downloading %s of %s chunks' % (len(missing), len(set(chunks))), show=True)
+
+        def _download(chunk_id):
+            r = self._request_api_server('GET', '/cache/chunks/%s' % chunk_id)
+
+            if r.status_code == 404:
+                raise Error('Chunk %s of the cache not found' % chunk_id)
+
+            store.put_compressed(chunk_id, r.content)
+
+        with ThreadPoolExecutor(max_workers=CACHE_CONCURRENCY) as executor:
+            list(executor.map(_download, missing))
+
+        read_chunks(chunks, store, output)
+        return True
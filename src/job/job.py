@@ -15,6 +15,7 @@ import urllib3
 import yaml
 import tarfile
 import signal
+from concurrent.futures import ThreadPoolExecutor
 
 from pyinfrabox.infrabox import validate_json
 from pyinfrabox.docker_compose import create_from
@@ -22,6 +23,7 @@ from pyinfrabox.docker_compose import create_from
 from infrabox_job.stats import StatsCollector
 from infrabox_job.process import ApiConsole, Failure, Error
 from infrabox_job.job import Job
+from infrabox_job.cache import ChunkStore
 from infrabox_job import find_infrabox_file
 
 from pyinfraboxutils.testresult import Parser as TestresultParser
@@ -35,6 +37,9 @@ logger = get_logger('scheduler')
 ERR_EXIT_FAILURE = 1
 ERR_EXIT_ERROR = 2
 
+# Parent jobs of which the output is downloaded at once
+INPUT_CONCURRENCY = 4
+
 BUILD_ARGS = ('GITHUB_OAUTH_TOKEN', 'GITHUB_BASE_URL', 'INFRABOX_CRONJOB')
 
 def makedirs(path):
@@ -59,6 +64,9 @@ class RunJob(Job):
         os.makedirs(self.storage_dir)
 
         self.mount_repo_dir = '/data/repo'
+
+        # Chunks of the content-addressed cache, only missing ones are downloaded
+        self.chunk_store_dir = '/data/chunks'
         self.mount_data_dir = self.mount_repo_dir + '/.infrabox'
 
     def create_infrabox_directories(self):
@@ -138,6 +146,69 @@ class RunJob(Job):
 
             json.dump(o, out)
 
+    def download_cache_dedup(self):
+        # Returns False to fall back to the regular cache if there is no manifest yet
+        try:
+            if not self.download_cache_chunks(ChunkStore(self.chunk_store_dir), self.infrabox_cache_dir):
+                return False
+
+            self.console.collect("Cache restored", show=True)
+        except Exception as e:
+            self.console.collect("Failed to restore cache: %s" % e, show=True)
+
+            # Drops what has been restored so far, the regular cache is unpacked instead
+            shutil.rmtree(self.infrabox_cache_dir, True)
+            makedirs(self.infrabox_cache_dir)
+            return False
+
+        return True
+
+    def download_input(self, dep):
+        # Streams the output of the parent through snappy into tar, no files in between
+        c = self.console
+        url = '/output/%s' % dep['id']
+        files = self.get_file_list_from_api_server(url)
+
+        if files is None:
+            c.collect("no output found for %s" % dep['name'], show=True)
+            return
+
+        c.collect("output found for %s" % dep['name'], show=True)
+        dir_name = dep['name'].split('/')[-1]
+
+        m = re.search('(.*)\.([0-9]+)', dir_name)
+        if m:
+            dir_name = m.group(1)
+
+        infrabox_input_dir = os.path.join(self.infrabox_inputs_dir, dir_name)
+        os.makedirs(infrabox_input_dir)
+
+        start = time.time()
+        p = self.uncompress_stream(infrabox_input_dir)
+        try:
+            size = self.stream_file_from_api_server(url, files, p.stdin)
+        finally:
+            # tar stops at the end of its input, also if the download failed
+            try:
+                p.stdin.close()
+            except IOError:
+                pass
+
+            p.wait()
+
+        if p.returncode != 0:
+            raise Error('Failed to unpack the output of %s' % dep['name'])
+
+        duration = max(time.time() - start, 0.001)
+        c.collect("Input %s: %.1f MB in %.1fs (%.1f MB/s)" % (dir_name, size / 1024.0 / 1024, duration,
+                                                               size / 1024.0 / 1024 / duration), show=True)
+        return infrabox_input_dir
+
+    def uncompress_stream(self, output):
+        # Returns the uncompress process of a stream written to its stdin
+        cmd = "python3 -c \"import snappy,sys;d=snappy.StreamDecompressor();[sys.stdout.buffer.write(d.decompress(c)) for c in iter(lambda:sys.stdin.buffer.read(65536),b'')]\" | tar -xf - -C %s" % output
+        return subprocess.Popen(cmd, cwd=output, shell=True, stdin=subprocess.PIPE)
+
     def compress(self, source, output):
         cmd = "tar -cf - --directory %s . | pv -L 500m | python3 -c \"import snappy,sys;c=snappy.StreamCompressor();f=open(sys.argv[1],'wb');[f.write(c.add_chunk(b)) for b in iter(lambda:sys.stdin.buffer.read(65536),b'')]\" %s" % (source, output)
         self.console.execute(cmd, cwd=source, show=True, shell=True, show_cmd=False)
@@ -523,34 +594,16 @@ class RunJob(Job):
 
         signal.signal(signal.SIGTERM, self.handle_abort)
 
-        # base dir for inputs
-        storage_inputs_dir = os.path.join(self.storage_dir, 'inputs')
-
         # Sync deps
         c.collect("Syncing inputs:", show=True)
-        for dep in self.parents:
-            storage_input_file_dir = os.path.join(storage_inputs_dir, dep['id'])
-            os.makedirs(storage_input_file_dir)
-
-            # Get files.json
-            storage_input_file_tar = os.path.join(storage_input_file_dir, 'output.tar.snappy')
-            self.get_file_from_api_server('/output/%s' % dep['id'], storage_input_file_tar, split=True)
+        with ThreadPoolExecutor(max_workers=INPUT_CONCURRENCY) as executor:
+            inputs = list(executor.map(self.download_input, self.parents))
 
-            if os.path.isfile(storage_input_file_tar):
-                c.collect("output found for %s" % dep['name'], show=True)
-                dir_name = dep['name'].split('/')[-1]
-
-                m = re.search('(.*)\.([0-9]+)', dir_name)
-                if m:
-                    dir_name = m.group(1)
-
-                infrabox_input_dir = os.path.join(self.infrabox_inputs_dir, dir_name)
-                os.makedirs(infrabox_input_dir)
-                self.uncompress(storage_input_file_tar, infrabox_input_dir)
+        # Listed once all are unpacked, so the listings are not mixed up
+        for infrabox_input_dir in inputs:
+            if infrabox_input_dir:
                 c.execute(['ls', '-alh', infrabox_input_dir], show=True)
-                os.remove(storage_input_file_tar)
-            else:
-                c.collect("no output found for %s" % dep['name'], show=True)
+
         c.collect("", show=True)
 
         # <storage_dir>/cache is synced with the corresponding
@@ -563,6 +616,9 @@ class RunJob(Job):
         c.collect("Syncing cache:", show=True)
         if not self.job['definition'].get('cache', {}).get('data', True):
             c.collect("Not downloading cache, because cache.data has been set to false", show=True)
+        elif self.job['definition'].get('cache', {}).get('dedup', False) and self.download_cache_dedup():
+            # Restored from the chunks of the content-addressed cache
+            pass
         else:
             self.get_file_from_api_server("/cache", storage_cache_tar, split=True)
 
@@ -617,15 +673,17 @@ class RunJob(Job):
         if not self.job['definition'].get('cache', {}).get('data', True):
             c.collect("Not updating cache, because cache.data has been set to false", show=True)
         else:
-            if os.path.isdir(self.infrabox_cache_dir) and os.listdir(self.infrabox_cache_dir):
+            if not os.path.isdir(self.infrabox_cache_dir) or not os.listdir(self.infrabox_cache_dir):
+                c.collect("Cache is empty", show=True)
+            elif self.job['definition'].get('cache', {}).get('dedup', False):
+                self.upload_cache_chunks(self.infrabox_cache_dir, ChunkStore(self.chunk_store_dir))
+            else:
                 self.compress(self.infrabox_cache_dir, storage_cache_tar)
 
                 file_size = os.stat(storage_cache_tar).st_size
 
                 c.collect("Output size: %s kb" % (file_size / 1024), show=True)
                 self.post_file_to_api_server('/cache', storage_cache_tar, split=True)
-            else:
-                c.collect("Cache is empty", show=True)
         c.collect("", show=True)
 
         shutil.rmtree(self.mount_data_dir, True)
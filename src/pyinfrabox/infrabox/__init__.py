@@ -146,11 +146,14 @@ def parse_environment(e, path):
 
 
 def parse_cache(d, path):
-    check_allowed_properties(d, path, ("data", "image"))
+    check_allowed_properties(d, path, ("data", "image", "dedup"))
 
     if 'data' in d:
         check_boolean(d['data'], path + ".data")
 
+    if 'dedup' in d:
+        check_boolean(d['dedup'], path + ".dedup")
+
     if 'image' in d:
         check_boolean(d['image'], path + ".image")
 
@@ -24,6 +24,24 @@ class TestDockerCompose(unittest.TestCase):
     def test_empty_jobs(self):
         validate_json({'version': 1, 'jobs': []})
 
+    def test_cache(self):
+        d = {
+            "version": 1,
+            "jobs": [{
+                "type": "docker",
+                "name": "compile",
+                "docker_file": "Dockerfile",
+                "build_only": False,
+                "resources": {"limits": {"cpu": 1, "memory": 1024}},
+                "cache": {"data": True, "dedup": True}
+            }]
+        }
+
+        validate_json(d)
+
+        d['jobs'][0]['cache']['dedup'] = 'yes'
+        self.raises_expect(d, "#jobs[0].cache.dedup: must be a boolean")
+
     def test_dep_defined_later(self):
         d = {
             "version": 1,
@@ -0,0 +1,132 @@
+'''
+The console output of a running job is stored in the console table as
+chunks numbered per job (seq). Each chunk knows the byte offset at which it
+ends in the complete output (end_offset), so readers can continue where they
+stopped instead of loading the complete output again.
+'''
+import uuid
+
+def read_chunks(db, job_id, after_seq=0, offset=0):
+    ''' Returns (seq, end_offset, output) of the chunks after the sequence number after_seq
+    which end behind the byte offset '''
+    return db.execute_many('''
+        SELECT seq, end_offset, output
+        FROM console
+        WHERE job_id = %s
+        AND seq > %s
+        AND end_offset > %s
+        ORDER BY seq
+    ''', [job_id, after_seq, offset])
+
+def read(db, job_id, after_seq=0, offset=0):
+    ''' Returns the output (bytes) after the sequence number and byte offset,
+    followed by the sequence number and byte offset to continue from '''
+    data = []
+
+    for seq, end_offset, output in read_chunks(db, job_id, after_seq, offset):
+        chunk = output.encode('utf-8')
+        start = end_offset - len(chunk)
+
+        if start < offset:
+            chunk = chunk[offset - start:]
+
+        data.append(chunk)
+        after_seq = seq
+        offset = end_offset
+
+    return b''.join(data), after_seq, offset
+
+def last_chunk(db, job_id):
+    ''' Returns the sequence number and end_offset of the last chunk, (0, 0) if there is none '''
+    r = db.execute_one('''
+        SELECT seq, end_offset
+        FROM console
+        WHERE job_id = %s
+        ORDER BY seq DESC
+        LIMIT 1
+    ''', [job_id])
+
+    if not r:
+        return 0, 0
+
+    return r[0], r[1]
+
+def end_of_chunk(db, job_id, seq):
+    ''' Returns the byte offset at which a chunk ends, 0 if it does not exist (anymore) '''
+    r = db.execute_one('''
+        SELECT end_offset
+        FROM console
+        WHERE job_id = %s
+        AND seq = %s
+    ''', [job_id, seq])
+
+    if not r:
+        return 0
+
+    return r[0]
+
+def stream(db, job_id, start, stop, batch_size=100):
+    ''' Yields the output (bytes) between the byte offsets start and stop,
+    read in batches through a server side cursor '''
+    cursor = db.conn.cursor(name='console_%s' % uuid.uuid4().hex)
+    cursor.itersize = batch_size
+
+    try:
+        cursor.execute('''
+            SELECT end_offset, output
+            FROM console
+            WHERE job_id = %s
+            AND end_offset > %s
+            ORDER BY end_offset
+        ''', [job_id, start])
+
+        for end_offset, output in cursor:
+            chunk = output.encode('utf-8')
+            chunk_start = end_offset - len(chunk)
+
+            if chunk_start >= stop:
+                break
+
+            yield chunk[max(start - chunk_start, 0):stop - chunk_start]
+    finally:
+        cursor.close()
+
+def stream_archived(db, job_id, start, stop, size=1024 * 1024):
+    ''' Yields the output (bytes) of a finished job between the byte offsets start and stop,
+    queried in windows of size bytes '''
+    for offset in range(start, stop, size):
+        length = min(size, stop - offset)
+
+        r = db.execute_one('''
+            SELECT substring(convert_to(console, 'UTF8') FROM %s FOR %s)
+            FROM job
+            WHERE id = %s
+        ''', [offset + 1, length, job_id])
+
+        if not r or not r[0]:
+            return
+
+        data = bytes(r[0])
+        yield data
+
+        if len(data) < length:
+            # end of the output
+            return
+
+def stream_file(f, start, stop, size=64 * 1024):
+    ''' Yields the output (bytes) between the byte offsets start and stop of a
+    file like object, i.e. the decompressed output in the storage, and closes it '''
+    try:
+        f.seek(start)
+        remaining = stop - start
+
+        while remaining > 0:
+            data = f.read(min(size, remaining))
+
+            if not data:
+                break
+
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
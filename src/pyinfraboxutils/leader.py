@@ -10,6 +10,13 @@ def _is_leader(conn, service_name, cluster_name=None):
         return True
 
     conn.rollback()
+    return renew_lease(conn, service_name, cluster_name)
+
+def renew_lease(conn, service_name, holder):
+    """ Takes over the lease if it expired and refreshes it if it's held by holder """
+    if os.environ.get('INFRABOX_DISABLE_LEADER_ELECTION', 'false') == 'true':
+        return True
+
     c = conn.cursor()
     c.execute("""
         INSERT INTO leader_election (service_name, cluster_name, last_seen_active)
@@ -21,15 +28,89 @@ def _is_leader(conn, service_name, cluster_name=None):
                         ELSE leader_election.cluster_name
                         END,
             last_seen_active = CASE WHEN leader_election.cluster_name = EXCLUDED.cluster_name
+                                    OR leader_election.last_seen_active < now() - interval '30 second'
                                     THEN EXCLUDED.last_seen_active
                                     ELSE leader_election.last_seen_active
                                     END
         RETURNING service_name, cluster_name;
-    """, [service_name, cluster_name])
+    """, [service_name, holder])
     r = c.fetchone()
     c.close()
     conn.commit()
-    return r == (service_name, cluster_name)
+    return r == (service_name, holder)
+
+def release_lease(conn, service_name, holder):
+    c = conn.cursor()
+    c.execute("""
+        DELETE FROM leader_election
+        WHERE service_name = %s
+        AND cluster_name = %s
+    """, [service_name, holder])
+    c.close()
+    conn.commit()
+
+def shard_lease(service_name, shard):
+    return '%s/shard/%s' % (service_name, shard)
+
+def elect_shard_leaders(conn, service_name, shards, holder):
+    """ Returns the shards (0 to shards - 1) the holder is the leader of.
+
+    Every replica registers itself with a lease of its own. A replica keeps
+    or takes over the leases of at most its fair share of the shards, so the
+    shards are spread across all live replicas. Shards held above the fair
+    share are released and will be picked up by the other replicas.
+    """
+    if os.environ.get('INFRABOX_DISABLE_LEADER_ELECTION', 'false') == 'true':
+        return list(range(shards))
+
+    conn.rollback()
+    renew_lease(conn, '%s/replica/%s' % (service_name, holder), holder)
+
+    c = conn.cursor()
+    c.execute("""
+        DELETE FROM leader_election
+        WHERE service_name LIKE %s
+        AND last_seen_active < now() - interval '10 minute'
+    """, [service_name + '/replica/%'])
+    c.execute("""
+        SELECT count(*)
+        FROM leader_election
+        WHERE service_name LIKE %s
+        AND last_seen_active >= now() - interval '30 second'
+    """, [service_name + '/replica/%'])
+    replicas = max(c.fetchone()[0], 1)
+    c.execute("""
+        SELECT service_name
+        FROM leader_election
+        WHERE service_name LIKE %s
+        AND cluster_name = %s
+    """, [service_name + '/shard/%', holder])
+    held = set(r[0] for r in c.fetchall())
+    c.close()
+    conn.commit()
+
+    fair_share = (shards + replicas - 1) // replicas
+    leases = [shard_lease(service_name, shard) for shard in range(shards)]
+
+    # Keep the shards we already have first, then try to get free ones
+    result = []
+    for shard in sorted(range(shards), key=lambda s: leases[s] not in held):
+        if len(result) >= fair_share:
+            if leases[shard] in held:
+                logger.info('Releasing shard %s of %s', shard, service_name)
+                release_lease(conn, leases[shard], holder)
+
+            continue
+
+        if renew_lease(conn, leases[shard], holder):
+            if leases[shard] not in held:
+                logger.info('Took over shard %s of %s', shard, service_name)
+
+            result.append(shard)
+        elif leases[shard] in held:
+            logger.warning('Lost shard %s of %s', shard, service_name)
+
+    return sorted(result)
 
 def is_leader(conn, service_name, cluster_name=None, exit=True):
     leader = _is_leader(conn, service_name, cluster_name)
@@ -0,0 +1,40 @@
+import os
+import uuid
+from io import BytesIO
+
+class MultipartFile(object):
+    ''' A multipart/form-data body with a single file, read from the file while
+    it's sent. requests builds the whole body in memory for files=, pass this
+    as data= instead together with the content_type header. '''
+
+    def __init__(self, name, fileobj):
+        boundary = uuid.uuid4().hex
+        header = ('--%s\r\n'
+                  'Content-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                  'Content-Type: application/octet-stream\r\n\r\n') % (boundary, name, name)
+        footer = '\r\n--%s--\r\n' % boundary
+
+        position = fileobj.tell()
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell() - position
+        fileobj.seek(position)
+
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+        self.parts = [BytesIO(header.encode('utf-8')), fileobj, BytesIO(footer.encode('utf-8'))]
+
+        # requests sets the Content-Length from len
+        self.len = len(header.encode('utf-8')) + size + len(footer.encode('utf-8'))
+
+    def read(self, size=-1):
+        data = b''
+
+        while self.parts and (size < 0 or len(data) < size):
+            chunk = self.parts[0].read(-1 if size < 0 else size - len(data))
+
+            if not chunk:
+                self.parts.pop(0)
+                continue
+
+            data += chunk
+
+        return data
@@ -26,14 +26,21 @@ class AESCipher:
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
         return unpad(cipher.decrypt(ciphertext), self.bs).decode()
 
+_cipher = (None, None)
+
+def _get_cipher():
+    # The key is only read again if the file changed, e.g. the mounted secret got rotated
+    global _cipher
+    mtime = os.stat(private_key_path).st_mtime
+
+    if _cipher[0] != mtime:
+        with open(private_key_path) as f:
+            _cipher = (mtime, AESCipher(f.read()))
+
+    return _cipher[1]
+
 def encrypt_secret(s):
-    with open(private_key_path) as f:
-        key = f.read()
-        a = AESCipher(key)
-        return a.encrypt(str(s))
+    return _get_cipher().encrypt(str(s))
 
 def decrypt_secret(s):
-    with open(private_key_path) as f:
-        key = f.read()
-        a = AESCipher(key)
-        return a.decrypt(str(s))
+    return _get_cipher().decrypt(str(s))
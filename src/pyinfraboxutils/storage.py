@@ -1,13 +1,20 @@
 #pylint: disable=too-few-public-methods
+import gzip
+import json
 import os
+import threading
 import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+import requests
 from botocore.errorfactory import ClientError
 from google.cloud import storage as gcs
-from flask import after_this_request
+from flask import after_this_request, request, Response
 from flask import _app_ctx_stack as stack
 from azure.storage.blob import BlockBlobService
+from azure.storage.blob.models import BlobBlock
 from keystoneauth1 import session
 from keystoneauth1.identity import v3
 from swiftclient.client import Connection, ClientException
@@ -22,19 +29,197 @@ USE_AZURE = get_env('INFRABOX_STORAGE_AZURE_ENABLED') == 'true'
 USE_SWIFT = get_env('INFRABOX_STORAGE_SWIFT_ENABLED') == 'true'
 storage = None
 
+# Bytes read from the backend at once when streaming an object
+CHUNK_SIZE = 1024 * 1024
+
+# Connections kept open to the backend
+MAX_CONNECTIONS = 50
+
+# Streams larger than a part are uploaded in parts (MB), several at once
+UPLOAD_PART_SIZE = int(os.environ.get('INFRABOX_STORAGE_UPLOAD_PART_SIZE', '64')) * 1024 * 1024
+UPLOAD_CONCURRENCY = int(os.environ.get('INFRABOX_STORAGE_UPLOAD_CONCURRENCY', '4'))
+
+def _remaining_size(stream):
+    # Bytes left in the stream, None if it can't seek
+    try:
+        position = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell() - position
+        stream.seek(position)
+        return size
+    except (AttributeError, IOError, ValueError):
+        return None
+
+class Stream(object):
+    ''' The bytes start to stop (exclusive) of an object of the given size,
+    read in chunks straight from the backend '''
+
+    def __init__(self, chunks, size, start=None, stop=None, close=None):
+        self.chunks = chunks
+        self.size = size
+        self.start = 0 if start is None else start
+        self.stop = size if stop is None else stop
+        self._close = close
+        self._reader = None
+        self._buffer = b''
+
+    def __iter__(self):
+        try:
+            for chunk in self.chunks:
+                if chunk:
+                    yield chunk
+        finally:
+            self.close()
+
+    def read(self, size=-1):
+        ''' Reads like a file, i.e. for gzip.GzipFile(fileobj=stream) '''
+        if self._reader is None:
+            self._reader = iter(self)
+
+        data = [self._buffer]
+        length = len(self._buffer)
+
+        while size < 0 or length < size:
+            chunk = next(self._reader, None)
+
+            if chunk is None:
+                break
+
+            data.append(chunk)
+            length += len(chunk)
+
+        data = b''.join(data)
+
+        if size < 0:
+            self._buffer = b''
+            return data
+
+        self._buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        if self._close:
+            self._close()
+            self._close = None
+
+class GzipStream(gzip.GzipFile):
+    ''' The decompressed content of a gzip compressed Stream, closes the stream when closed '''
+
+    def __init__(self, stream):
+        super(GzipStream, self).__init__(fileobj=stream, mode='rb')
+        self.stream = stream
+
+    def close(self):
+        try:
+            super(GzipStream, self).close()
+        finally:
+            self.stream.close()
+
 class Storage(object):
     def __init__(self):
+        # One client per process, shared by all requests (and greenlets)
+        # so the connections to the backend are pooled
+        self.client = None
+        self.lock = threading.Lock()
+
+    def _create_client(self):
         return
 
+    def _get_client(self):
+        if not self.client:
+            with self.lock:
+                if not self.client:
+                    self.client = self._create_client()
+
+        return self.client
+
     def _upload(self, stream, key):
+        size = _remaining_size(stream)
+
+        if size is not None and size <= UPLOAD_PART_SIZE:
+            return self._put(stream, key)
+
+        return self._put_parts(stream, key)
+
+    def _put(self, stream, key):
+        return
+
+    def _put_parts(self, stream, key):
         return
 
+    def _upload_parts(self, stream, upload_part):
+        ''' Calls upload_part(number, data) for every part of the stream (numbered
+        from 1), UPLOAD_CONCURRENCY at once, and returns the results in order '''
+        results = []
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as executor:
+            number = 0
+            while True:
+                data = stream.read(UPLOAD_PART_SIZE)
+
+                if not data and number:
+                    break
+
+                number += 1
+                pending.append(executor.submit(upload_part, number, data))
+
+                # Only read ahead as many parts as are uploaded
+                if len(pending) >= UPLOAD_CONCURRENCY:
+                    results.append(pending.popleft().result())
+
+            while pending:
+                results.append(pending.popleft().result())
+
+        return results
+
     def _download(self, key):
         return
 
+    def _stream(self, key, start=None, stop=None):
+        return
+
     def _delete(self, key):
         return
 
+    def _send(self, key, filename=None, as_attachment=False, mimetype=None):
+        # Sends the object without a copy on disk, a range of it if requested
+        stream = self._stream(key)
+
+        if not stream:
+            return None
+
+        status = 200
+        headers = {'Accept-Ranges': 'bytes'}
+
+        if request.range:
+            r = request.range.range_for_length(stream.size)
+
+            if r is None:
+                stream.close()
+                return Response(status=416, headers={'Content-Range': 'bytes */%s' % stream.size})
+
+            if r != (0, stream.size):
+                stream.close()
+                stream = self._stream(key, *r)
+
+                if not stream:
+                    return None
+
+                status = 206
+                headers['Content-Range'] = 'bytes %s-%s/%s' % (stream.start, stream.stop - 1, stream.size)
+
+        headers['Content-Length'] = str(stream.stop - stream.start)
+
+        response = Response(stream, status=status, headers=headers,
+                            mimetype=mimetype or 'application/octet-stream',
+                            direct_passthrough=True)
+
+        if as_attachment:
+            response.headers.add('Content-Disposition', 'attachment', filename=filename)
+
+        return response
+
     def _clean_up(self, path):
         if not stack.top:
             return
@@ -57,6 +242,9 @@ class Storage(object):
     def upload_archive(self, stream, key):
         return self._upload(stream, 'archive/%s' % key)
 
+    def upload_console(self, stream, key):
+        return self._upload(stream, 'console/%s' % key)
+
     def download_source(self, key):
         return self._download('upload/%s' % key)
 
@@ -69,15 +257,43 @@ class Storage(object):
     def download_cache(self, key):
         return self._download('cache/%s' % key)
 
+    def download_console(self, key):
+        return self._download('console/%s' % key)
+
+    def open_console(self, key):
+        ''' Returns the decompressed console output as file object, read
+        straight from the storage, None if it does not exist '''
+        stream = self._stream('console/%s' % key)
+
+        if not stream:
+            return None
+
+        return GzipStream(stream)
+
+    def send_source(self, key):
+        return self._send('upload/%s' % key)
+
+    def send_output(self, key, **kwargs):
+        return self._send('output/%s' % key, **kwargs)
+
+    def send_archive(self, key, **kwargs):
+        return self._send('archive/%s' % key, **kwargs)
+
+    def send_cache(self, key):
+        return self._send('cache/%s' % key)
+
     def delete_cache(self, key):
         return self._delete('cache/%s' % key)
 
+    def delete_console(self, key):
+        return self._delete('console/%s' % key)
+
     def exists(self, key):
         return
 
 class S3(Storage):
     def __init__(self):
-        super(Storage, self).__init__()
+        super(S3, self).__init__()
 
         if get_env('INFRABOX_STORAGE_S3_SECURE') == 'true':
             url = 'https://'
@@ -99,12 +315,37 @@ class S3(Storage):
             return False
         return True
 
-    def _upload(self, stream, key):
+    def _put(self, stream, key):
         client = self._get_client()
         client.put_object(Body=stream,
                           Bucket=self.bucket,
                           Key=key)
 
+    def _put_parts(self, stream, key):
+        client = self._get_client()
+        upload_id = client.create_multipart_upload(Bucket=self.bucket,
+                                                   Key=key)['UploadId']
+
+        def _upload_part(number, data):
+            result = client.upload_part(Body=data,
+                                        Bucket=self.bucket,
+                                        Key=key,
+                                        UploadId=upload_id,
+                                        PartNumber=number)
+            return {'ETag': result['ETag'], 'PartNumber': number}
+
+        try:
+            parts = self._upload_parts(stream, _upload_part)
+            client.complete_multipart_upload(Bucket=self.bucket,
+                                             Key=key,
+                                             UploadId=upload_id,
+                                             MultipartUpload={'Parts': parts})
+        except:
+            client.abort_multipart_upload(Bucket=self.bucket,
+                                          Key=key,
+                                          UploadId=upload_id)
+            raise
+
     def create_buckets(self):
         client = self._get_client()
         try:
@@ -137,10 +378,33 @@ class S3(Storage):
 
         return path
 
-    def _get_client(self):
+    def _stream(self, key, start=None, stop=None):
+        client = self._get_client()
+        args = {}
+
+        if start is not None:
+            args['Range'] = 'bytes=%s-%s' % (start, stop - 1)
+
+        try:
+            result = client.get_object(Bucket=self.bucket,
+                                       Key=key,
+                                       **args)
+        except ClientError:
+            return None
+
+        if start is None:
+            size = result['ContentLength']
+        else:
+            size = int(result['ContentRange'].split('/')[-1])
+
+        body = result['Body']
+        return Stream(body.iter_chunks(CHUNK_SIZE), size, start, stop, body.close)
+
+    def _create_client(self):
         client = boto3.client('s3',
                               endpoint_url=self.url,
-                              config=boto3.session.Config(signature_version='s3v4'),
+                              config=boto3.session.Config(signature_version='s3v4',
+                                                          max_pool_connections=MAX_CONNECTIONS),
                               aws_access_key_id=get_env('INFRABOX_STORAGE_S3_ACCESS_KEY'),
                               aws_secret_access_key=get_env('INFRABOX_STORAGE_S3_SECRET_KEY'))
 
@@ -148,33 +412,66 @@ class S3(Storage):
 
 class GCS(Storage):
     def __init__(self):
-        super(Storage, self).__init__()
+        super(GCS, self).__init__()
         self.bucket = get_env('INFRABOX_STORAGE_GCS_BUCKET')
 
+    def _create_client(self):
+        # The bucket handle is created without a request and keeps the client
+        client = gcs.Client()
+        return client.bucket(self.bucket)
+
     def _delete(self, key):
         try:
-            client = gcs.Client()
-            bucket = client.get_bucket(self.bucket)
+            bucket = self._get_client()
             blob = bucket.blob(key)
             blob.delete()
         except:
             pass
 
     def exists(self, key):
-        client = gcs.Client()
-        bucket = client.get_bucket(self.bucket)
+        bucket = self._get_client()
         blob = bucket.blob(key)
         return blob.exists()
 
-    def _upload(self, stream, key):
-        client = gcs.Client()
-        bucket = client.get_bucket(self.bucket)
+    def _put(self, stream, key):
+        bucket = self._get_client()
         blob = bucket.blob(key)
         blob.upload_from_file(stream)
 
+    def _put_parts(self, stream, key):
+        # The parts are uploaded as temporary blobs and composed,
+        # at most 32 at once
+        bucket = self._get_client()
+        prefix = '%s.parts/%s' % (key, uuid.uuid4())
+        blobs = []
+
+        def _upload_part(number, data):
+            blob = bucket.blob('%s/%08d' % (prefix, number))
+            blobs.append(blob)
+            blob.upload_from_string(data)
+            return blob
+
+        try:
+            parts = self._upload_parts(stream, _upload_part)
+
+            level = 0
+            while len(parts) > 32:
+                level += 1
+                composed = []
+                for i in range(0, len(parts), 32):
+                    blob = bucket.blob('%s/%s-%08d' % (prefix, level, i))
+                    blobs.append(blob)
+                    blob.compose(parts[i:i + 32])
+                    composed.append(blob)
+
+                parts = composed
+
+            bucket.blob(key).compose(parts)
+        finally:
+            bucket.delete_blobs(blobs, on_error=lambda blob: None)
+
     def _download(self, key):
-        client = gcs.Client()
-        bucket = client.get_bucket(self.bucket)
+        bucket = self._get_client()
         blob = bucket.get_blob(key)
 
         if not blob:
@@ -188,16 +485,35 @@ class GCS(Storage):
 
         return path
 
+    def _stream(self, key, start=None, stop=None):
+        bucket = self._get_client()
+        blob = bucket.get_blob(key)
+
+        if not blob:
+            return None
+
+        stream = Stream(None, blob.size, start, stop)
+
+        def _chunks():
+            # One request per chunk, all of the same generation of the blob
+            for begin in range(stream.start, stream.stop, CHUNK_SIZE):
+                end = min(begin + CHUNK_SIZE, stream.stop) - 1
+                yield blob.download_as_bytes(start=begin, end=end,
+                                             if_generation_match=blob.generation)
+
+        stream.chunks = _chunks()
+        return stream
+
 class AZURE(Storage):
     def __init__(self):
-        super(Storage, self).__init__()
+        super(AZURE, self).__init__()
         self.container = 'infrabox'
 
     def exists(self, key):
         client = self._get_client()
         return client.exists(container_name=self.container, blob_name=key)
 
-    def _upload(self, stream, key):
+    def _put(self, stream, key):
         client = self._get_client()
         if not client.exists(container_name=self.container):
             client.create_container(container_name=self.container)
@@ -205,6 +521,29 @@ class AZURE(Storage):
                                        blob_name=key,
                                        stream=stream)
 
+    def _put_parts(self, stream, key):
+        client = self._get_client()
+        if not client.exists(container_name=self.container):
+            client.create_container(container_name=self.container)
+
+        # Uncommitted blocks of the blob are shared by all uploads to it,
+        # so the ids are unique per upload (and all of the same length)
+        upload_id = uuid.uuid4().hex
+
+        def _upload_part(number, data):
+            # Blocks which are never committed are removed by azure
+            block_id = '%s-%08d' % (upload_id, number)
+            client.put_block(container_name=self.container,
+                             blob_name=key,
+                             block=data,
+                             block_id=block_id)
+            return BlobBlock(id=block_id)
+
+        blocks = self._upload_parts(stream, _upload_part)
+        client.put_block_list(container_name=self.container,
+                              blob_name=key,
+                              block_list=blocks)
+
     def _delete(self, key):
         client = self._get_client()
         try:
@@ -227,20 +566,48 @@ class AZURE(Storage):
 
         return path
 
-    def _get_client(self):
+    def _stream(self, key, start=None, stop=None):
+        client = self._get_client()
+        try:
+            blob = client.get_blob_properties(container_name=self.container,
+                                              blob_name=key)
+        except:
+            return None
+
+        stream = Stream(None, blob.properties.content_length, start, stop)
+
+        def _chunks():
+            # One request per chunk, all of the same version of the blob
+            for begin in range(stream.start, stream.stop, CHUNK_SIZE):
+                end = min(begin + CHUNK_SIZE, stream.stop) - 1
+                yield client.get_blob_to_bytes(container_name=self.container,
+                                               blob_name=key,
+                                               start_range=begin,
+                                               end_range=end,
+                                               max_connections=1,
+                                               if_match=blob.properties.etag).content
+
+        stream.chunks = _chunks()
+        return stream
+
+    def _create_client(self):
+        request_session = requests.Session()
+        request_session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_CONNECTIONS))
+        request_session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=MAX_CONNECTIONS))
+
         client = BlockBlobService(account_name=get_env('INFRABOX_STORAGE_AZURE_ACCOUNT_NAME'),
-                                  account_key=get_env('INFRABOX_STORAGE_AZURE_ACCOUNT_KEY'))
+                                  account_key=get_env('INFRABOX_STORAGE_AZURE_ACCOUNT_KEY'),
+                                  request_session=request_session)
         return client
 
 class SWIFT(Storage):
     def __init__(self):
-        super(Storage, self).__init__()
+        super(SWIFT, self).__init__()
         self.container = get_env('INFRABOX_STORAGE_SWIFT_CONTAINER_NAME')
         self.auth_url = get_env('INFRABOX_STORAGE_SWIFT_AUTH_URL')
         self.user_domain_name = get_env('INFRABOX_STORAGE_SWIFT_USER_DOMAIN_NAME')
         self.project_name = get_env('INFRABOX_STORAGE_SWIFT_PROJECT_NAME')
         self.project_domain_name = get_env('INFRABOX_STORAGE_SWIFT_PROJECT_DOMAIN_NAME')
-        self.client = None
 
     def exists(self, key):
         client = self._get_client()
@@ -253,17 +620,42 @@ class SWIFT(Storage):
                 raise
         return True
 
-    def _upload(self, stream, key):
+    def _put(self, stream, key):
         client = self._get_client()
         client.put_object(container=self.container,
                           obj=key,
                           contents=stream)
 
+    def _put_parts(self, stream, key):
+        # The parts are uploaded as segments of a static large object,
+        # a connection per part as a connection can't be shared
+        client = self._get_client()
+        prefix = '%s.segments/%s' % (key, uuid.uuid4())
+
+        def _upload_part(number, data):
+            segment = '%s/%08d' % (prefix, number)
+            etag = Connection(session=client.session).put_object(container=self.container,
+                                                                 obj=segment,
+                                                                 contents=data)
+            return {
+                'path': '/%s/%s' % (self.container, segment),
+                'etag': etag,
+                'size_bytes': len(data)
+            }
+
+        segments = self._upload_parts(stream, _upload_part)
+        client.put_object(container=self.container,
+                          obj=key,
+                          contents=json.dumps(segments),
+                          query_string='multipart-manifest=put')
+
     def _delete(self, key):
         client = self._get_client()
         try:
+            # Deletes the segments too if it's a static large object
             client.delete_object(container=self.container,
-                                 obj=key)
+                                 obj=key,
+                                 query_string='multipart-manifest=delete')
         except:
             pass
 
@@ -285,17 +677,49 @@ class SWIFT(Storage):
 
         return path
 
-    def _get_client(self):
-        if not self.client:
-            auth = v3.Password(auth_url=self.auth_url,
-                            username=os.getenv('INFRABOX_STORAGE_SWIFT_USERNAME'),
-                            password=os.getenv('INFRABOX_STORAGE_SWIFT_PASSWORD'),
-                            user_domain_name=self.user_domain_name,
-                            project_name=self.project_name,
-                            project_domain_name=self.project_domain_name)
-            keystone_session = session.Session(auth=auth)
-            self.client = Connection(session=keystone_session)
-        return self.client
+    def _stream(self, key, start=None, stop=None):
+        # The body is read lazily, so the stream gets its own connection
+        # which is closed with it instead of sharing the one of the client
+        client = Connection(session=self._get_client().session)
+        headers = {}
+
+        if start is not None:
+            headers['Range'] = 'bytes=%s-%s' % (start, stop - 1)
+
+        try:
+            result, body = client.get_object(self.container, key,
+                                             resp_chunk_size=CHUNK_SIZE,
+                                             headers=headers)
+        except Exception as e:
+            client.close()
+            if isinstance(e, ClientException) and e.http_status == 404:
+                return None
+            logger.error("Download object {} failed: {}".format(key, e))
+            return None
+
+        if start is None:
+            size = int(result['content-length'])
+        else:
+            size = int(result['content-range'].split('/')[-1])
+
+        def _close():
+            try:
+                if hasattr(body, 'close'):
+                    body.close()
+            finally:
+                client.close()
+
+        return Stream(body, size, start, stop, _close)
+
+    def _create_client(self):
+        auth = v3.Password(auth_url=self.auth_url,
+                           username=os.getenv('INFRABOX_STORAGE_SWIFT_USERNAME'),
+                           password=os.getenv('INFRABOX_STORAGE_SWIFT_PASSWORD'),
+                           user_domain_name=self.user_domain_name,
+                           project_name=self.project_name,
+                           project_domain_name=self.project_domain_name)
+        keystone_session = session.Session(auth=auth)
+        return Connection(session=keystone_session)
 
 if USE_S3:
     storage = S3()
@@ -5,16 +5,28 @@ import os
 import random
 import json
 import copy
+import gzip
+import re
+import select
+import socket
+import tempfile
+import threading
+import uuid
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+import requests.adapters
 from croniter import croniter
+from prometheus_client import Counter, Gauge, Histogram, Summary, start_http_server
 
 import psycopg2
 import psycopg2.extensions
+import psycopg2.extras
 
 from pyinfraboxutils import get_logger, get_env
 from pyinfraboxutils.db import connect_db
+from pyinfraboxutils.leader import elect_shard_leaders, renew_lease, shard_lease
 from pyinfraboxutils.token import encode_job_token
 from pyinfraboxutils.secrets import decrypt_secret
 
@@ -22,22 +34,699 @@ from pyinfraboxutils.secrets import decrypt_secret
 ERR_EXIT_FAILURE = 1
 ERR_EXIT_ERROR = 2
 
+QUANTITY_SUFFIXES = {
+    'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40, 'Pi': 2 ** 50, 'Ei': 2 ** 60,
+    'n': 1e-9, 'u': 1e-6, 'm': 1e-3, 'k': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12, 'P': 1e15, 'E': 1e18
+}
+
+def parse_quantity(q):
+    ''' Converts a kubernetes quantity like "3900m" or "16Gi" to cores or bytes '''
+    q = str(q)
+
+    if q[-2:] in QUANTITY_SUFFIXES:
+        return float(q[:-2]) * QUANTITY_SUFFIXES[q[-2:]]
+
+    if q[-1:] in QUANTITY_SUFFIXES:
+        return float(q[:-1]) * QUANTITY_SUFFIXES[q[-1:]]
+
+    return float(q)
+
+def job_resource_requests(cpu, mem):
+    ''' Resources requested by the pod of a job, cpu in cores and memory in MiB '''
+    return max(0.3, cpu / 2.0), mem
+
+# Fixed queries of the scheduling loop. In persistent connection mode they
+# are prepared once per database session and then only EXECUTEd.
+STATEMENTS = {
+    # Resolves the parent states of all queued jobs at once. A job is
+    # 'blocked' while a parent is not done yet, 'skipped' if a parent ended
+    # in a state not listed in the dependency's 'on' condition and
+    # 'runnable' otherwise. A job waits in the queue since it was created
+    # or its last parent ended. Queued jobs are sharded by their project.
+    'queued_jobs': '''
+        WITH queued AS (
+            SELECT j.id, j.type, j.dependencies, j.definition, j.created_at, j.project_id
+            FROM job j
+            WHERE j.state = 'queued' and cluster_name = %s
+            AND mod(get_byte(uuid_send(j.project_id), 15), %s) = ANY(%s::int[])
+        )
+        SELECT q.id, q.type, q.dependencies, q.definition,
+               CASE WHEN pa.blocked THEN 'blocked'
+                    WHEN pa.skipped THEN 'skipped'
+                    ELSE 'runnable'
+               END,
+               q.project_id,
+               extract(epoch FROM now() - GREATEST(q.created_at, pa.parents_done)),
+               pr.name,
+               pr.scheduler_weight
+        FROM queued q
+        JOIN project pr
+        ON pr.id = q.project_id
+        -- Looked up per queued job, so a burst of new jobs without
+        -- statistics yet does not lead to a quadratic plan
+        CROSS JOIN LATERAL (
+            SELECT bool_or(p.state IN ('running', 'scheduled', 'queued')) AS blocked,
+                   bool_or(NOT (deps->'on') ? p.state::text) AS skipped,
+                   max(p.end_date) AS parents_done
+            FROM job p
+            JOIN jsonb_array_elements(q.dependencies) as deps
+            ON p.id = (deps->>'job-id')::uuid
+            WHERE p.id = ANY(ARRAY(SELECT (d->>'job-id')::uuid
+                                   FROM jsonb_array_elements(q.dependencies) AS d))
+        ) pa
+        ORDER BY q.created_at ASC
+    ''',
+    # Skips jobs with unmet conditions and finishes runnable wait jobs
+    'resolve_queued_jobs': '''
+        UPDATE job j SET
+            state = r.state::job_state,
+            start_date = CASE WHEN r.state = 'finished' THEN now() ELSE j.start_date END,
+            end_date = CASE WHEN r.state = 'finished' THEN now() ELSE j.end_date END
+        FROM unnest(%s::text[], %s::text[]) AS r(id, state)
+        WHERE j.id = r.id::uuid
+        AND j.state = 'queued'
+    ''',
+    'job_definition': '''
+        SELECT definition, project_id FROM job j WHERE j.id = %s
+    ''',
+    # The key of the repository and the ssh key secrets of a project
+    'project_credentials': '''
+        SELECT p.type, r.private_key,
+               ARRAY(SELECT s.value
+                     FROM secret s
+                     JOIN sshkey k
+                     ON k.secret_id = s.id
+                     WHERE k.project_id = p.id
+                     AND s.project_id = p.id)
+        FROM project p
+        LEFT JOIN repository r
+        ON r.project_id = p.id
+        WHERE p.id = %s
+    ''',
+    'active_jobs_per_project': '''
+        SELECT project_id, count(*)
+        FROM job
+        WHERE state IN ('scheduled', 'running')
+        AND cluster_name = %s
+        GROUP BY project_id
+    ''',
+    # Jobs the scheduler already handed to kubernetes, their pods may not exist yet
+    'scheduled_job_limits': '''
+        SELECT id, definition->'resources'->'limits'
+        FROM job
+        WHERE state = 'scheduled'
+        AND cluster_name = %s
+    ''',
+    'cluster_capacity': '''
+        SELECT nodes, cpu_capacity, memory_capacity FROM cluster WHERE name = %s
+    ''',
+    'error_job': '''
+        UPDATE job SET state = 'error', message = %s WHERE id = %s
+    ''',
+    'scheduled_job': '''
+        UPDATE job SET state = 'scheduled' WHERE id = %s
+    ''',
+    'aborts': '''
+        SELECT j.id, a.user_id
+        FROM abort a
+        JOIN job j
+            ON a.job_id = j.id
+    ''',
+    'username': '''
+        SELECT username
+        FROM "user"
+        WHERE id = %s
+    ''',
+    'kill_job': '''
+        UPDATE job
+        SET state = 'killed',
+            end_date = current_timestamp,
+            message = %s
+        WHERE id = %s AND state IN ('scheduled', 'running', 'queued')
+    ''',
+    'delete_abort': '''
+        DELETE FROM "abort" WHERE job_id = %s
+    ''',
+    'timed_out_jobs': '''
+        SELECT j.id FROM job j
+        WHERE j.start_date < (NOW() - (CASE
+                                       WHEN j.definition->>'timeout' is not null THEN (j.definition->>'timeout')::integer * INTERVAL '1' SECOND
+                                       ELSE INTERVAL '3600' SECOND
+                                       END
+                                      )
+                             )
+        AND j.state = 'running'
+    ''',
+    'timeout_job': '''
+        UPDATE job SET state = 'failure', end_date = current_timestamp, message = 'Aborted due to timeout'
+        WHERE id = %s and state = 'running'
+    ''',
+    'job_states': '''
+        SELECT id, state, message FROM job WHERE id = ANY(%s::text[]::uuid[])
+    ''',
+    'failed_test_runs': '''
+        SELECT job_id
+        FROM test_run
+        WHERE job_id = ANY(%s::text[]::uuid[])
+        AND state IN ('error', 'failure')
+        GROUP BY job_id
+    ''',
+    # Rows which only update the message keep the other columns
+    'update_jobs': '''
+        UPDATE job j SET
+            state = CASE WHEN v.message_only THEN j.state ELSE v.state END,
+            start_date = CASE WHEN v.message_only THEN j.start_date ELSE v.start_date END,
+            end_date = CASE WHEN v.message_only THEN j.end_date ELSE v.end_date END,
+            message = v.message,
+            node_name = CASE WHEN v.message_only THEN j.node_name ELSE v.node_name END
+        FROM (VALUES %s) AS v(id, message_only, state, start_date, end_date, message, node_name)
+        WHERE j.id = v.id
+    ''',
+}
+
+STATEMENT_TEMPLATES = {
+    'update_jobs': '(%s::uuid, %s::boolean, %s::job_state, %s::timestamptz, %s::timestamptz, %s, %s)',
+}
+
 class APIException(Exception):
     def __init__(self, result):
         super(APIException, self).__init__("API Server Error (%s)" % result.status_code)
         self.result = result
 
+class GoneException(Exception):
+    pass
+
+def run_concurrently(executor, fn, items):
+    futures = [executor.submit(fn, i) for i in items]
+    return [f.result() for f in futures]
+
+class KubeClient(object):
+    ''' Keep-alive connection pool shared by all requests to the kubernetes API server '''
+
+    REQUEST_DURATION = Histogram(
+        'scheduler_kubernetes_request_duration_seconds',
+        'Time spent in requests to the kubernetes API server',
+        ['verb'])
+
+    def __init__(self, args, pool_size):
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = 'Bearer %s' % args.token
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, verb, url, **kwargs):
+        with self.REQUEST_DURATION.labels(verb).time():
+            return self.session.request(verb, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def watch(self, url, **kwargs):
+        # Watches are long running, they are not part of the request metrics
+        return self.session.get(url, stream=True, **kwargs)
+
+class Informer(object):
+    ''' Keeps a local copy of all objects of a resource up to date by watching it.
+
+    Consumers only get the objects which changed since they asked the last
+    time and all objects once per resync interval. '''
+
+    WATCH_TIMEOUT = 300
+
+    def __init__(self, client, url, resync_interval, on_change=None):
+        self.client = client
+        self.url = url
+        self.resync_interval = resync_interval
+        self.on_change = on_change
+        self.logger = get_logger("informer")
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.dirty = {}
+        self.last_resync = {}
+        self.resource_version = None
+
+    def _list(self):
+        self.logger.debug('LIST: %s', self.url)
+        r = self.client.get(self.url, timeout=10)
+
+        if r.status_code != 200:
+            raise APIException(r)
+
+        data = r.json()
+        items = data.get('items', None) or []
+
+        with self.lock:
+            self.cache = {}
+            for i in items:
+                self.cache[i['metadata']['name']] = i
+                self._mark(i['metadata']['name'])
+
+            self.resource_version = data['metadata']['resourceVersion']
+
+        if self.on_change:
+            for i in items:
+                self.on_change(i)
+
+    def _watch(self):
+        params = {
+            'watch': 'true',
+            'allowWatchBookmarks': 'true',
+            'resourceVersion': self.resource_version,
+            'timeoutSeconds': self.WATCH_TIMEOUT
+        }
+
+        self.logger.debug('WATCH: %s (%s)', self.url, self.resource_version)
+        r = self.client.watch(self.url, params=params, timeout=(10, self.WATCH_TIMEOUT + 30))
+
+        try:
+            if r.status_code == 410:
+                raise GoneException()
+
+            if r.status_code != 200:
+                raise APIException(r)
+
+            for line in r.iter_lines():
+                if line:
+                    self._handle_event(json.loads(line))
+        finally:
+            r.close()
+
+    def _handle_event(self, event):
+        event_type = event.get('type', None)
+        obj = event.get('object', {})
+
+        if event_type == 'ERROR':
+            if obj.get('code', None) == 410:
+                raise GoneException()
+
+            raise Exception('Watch failed: %s' % obj.get('message', None))
+
+        metadata = obj['metadata']
+        name = metadata.get('name', None)
+
+        with self.lock:
+            if event_type in ('ADDED', 'MODIFIED'):
+                self.cache[name] = obj
+                self._mark(name)
+            elif event_type == 'DELETED':
+                self.cache.pop(name, None)
+
+                for d in self.dirty.values():
+                    d.discard(name)
+
+            self.resource_version = metadata.get('resourceVersion', self.resource_version)
+
+        if self.on_change and event_type != 'BOOKMARK':
+            self.on_change(obj)
+
+    def _mark(self, name):
+        for d in self.dirty.values():
+            d.add(name)
+
+    def run(self):
+        while True:
+            try:
+                if self.resource_version is None:
+                    self._list()
+
+                self._watch()
+            except GoneException:
+                self.logger.info('resourceVersion %s of %s is too old, resyncing', self.resource_version, self.url)
+                self.resource_version = None
+            except APIException as e:
+                self.logger.warning(e.result.text)
+                self.resource_version = None
+                time.sleep(1)
+            except Exception as e:
+                self.logger.exception(e)
+                time.sleep(1)
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def mark(self, name):
+        with self.lock:
+            if name in self.cache:
+                self._mark(name)
+
+    def get(self, name):
+        with self.lock:
+            return self.cache.get(name, None)
+
+    def names(self):
+        with self.lock:
+            return list(self.cache.keys())
+
+    def items(self):
+        with self.lock:
+            return list(self.cache.values())
+
+    def changed(self, consumer):
+        with self.lock:
+            now = time.time()
+
+            if now - self.last_resync.get(consumer, 0) > self.resync_interval:
+                self.last_resync[consumer] = now
+                names = list(self.cache.keys())
+            else:
+                names = self.dirty.get(consumer, set())
+
+            self.dirty[consumer] = set()
+            return [self.cache[n] for n in names if n in self.cache]
+
+class NotificationListener(object):
+    ''' Listens to a notification channel of the database with a connection of its own '''
+
+    CHANNEL = None
+
+    def __init__(self):
+        self.logger = get_logger("listener")
+
+    def on_listen(self):
+        ''' Called whenever listening (again), to catch up with everything which
+        happened while not listening '''
+        pass
+
+    def on_notify(self, _):
+        assert False
+
+    def _listen(self):
+        conn = connect_db()
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute("LISTEN %s" % self.CHANNEL)
+            cursor.close()
+
+            self.on_listen()
+
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+
+                conn.poll()
+                while conn.notifies:
+                    n = conn.notifies.pop()
+                    self.on_notify(n.payload)
+        finally:
+            conn.close()
+
+    def run(self):
+        while True:
+            try:
+                self._listen()
+            except Exception as e:
+                self.logger.exception(e)
+                time.sleep(1)
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+class JobUpdateListener(NotificationListener):
+    ''' Wakes up the scheduler when the job_update notification of the
+    database reports a job which could be scheduled or unblock others '''
+
+    CHANNEL = 'job_update'
+
+    WAKEUP_STATES = ('queued', 'finished', 'failure', 'error', 'killed', 'skipped', 'unstable')
+
+    NOTIFICATIONS = Counter(
+        'scheduler_job_update_notifications_total',
+        'Number of received job_update notifications which woke up the scheduler')
+
+    def __init__(self, wakeup):
+        super(JobUpdateListener, self).__init__()
+        self.wakeup = wakeup
+
+    def on_listen(self):
+        self.wakeup.set()
+
+    def on_notify(self, payload):
+        event = json.loads(payload)
+
+        if event.get('state', None) in self.WAKEUP_STATES:
+            self.NOTIFICATIONS.inc()
+            self.wakeup.set()
+
+class LeaseHeartbeat(object):
+    ''' Renews the leases a worker holds with a connection of its own while
+    an iteration runs, so a slow iteration does not let the 30s leases of
+    pyinfraboxutils.leader expire and another replica take over '''
+
+    INTERVAL = 10
+
+    def __init__(self, holder):
+        self.holder = holder
+        self.logger = get_logger("lease")
+        self.leases = []
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _run(self):
+        conn = None
+
+        try:
+            while not self.stopped.wait(self.INTERVAL):
+                if not self.leases:
+                    continue
+
+                if conn is None:
+                    conn = connect_db()
+
+                for lease in list(self.leases):
+                    if not renew_lease(conn, lease, self.holder):
+                        self.logger.warning('Lost lease %s', lease)
+                        self.lost = True
+        except Exception as e:
+            # The leases can't be kept, don't rely on them anymore
+            self.logger.exception(e)
+            self.lost = True
+        finally:
+            if conn:
+                conn.close()
+
+    def start(self, leases):
+        self.leases = leases
+        self.lost = False
+        self.stopped.clear()
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+class CredentialCache(object):
+    ''' Git credentials of the projects, so a burst of jobs of one project
+    reads and decrypts them only once. Entries expire after ttl seconds and
+    are dropped when the project_credentials notification reports a change
+    of a secret, ssh key or repository. '''
+
+    REQUESTS = Counter(
+        'scheduler_credential_cache_requests_total',
+        'Number of project credential lookups by cache result',
+        ['result'])
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.generation = 0
+
+    def get(self, project_id):
+        with self.lock:
+            entry = self.entries.get(project_id, None)
+
+            if entry and entry[0] > time.time():
+                self.REQUESTS.labels('hit').inc()
+                return entry[1]
+
+        self.REQUESTS.labels('miss').inc()
+        return None
+
+    def put(self, project_id, credentials, generation):
+        with self.lock:
+            # Don't keep what was read before an invalidation
+            if generation == self.generation:
+                self.entries[project_id] = (time.time() + self.ttl, credentials)
+
+    def invalidate(self, project_id=None):
+        with self.lock:
+            self.generation += 1
+
+            if project_id:
+                self.entries.pop(project_id, None)
+            else:
+                self.entries = {}
+
+class CredentialListener(NotificationListener):
+    CHANNEL = 'project_credentials'
+
+    def __init__(self, cache):
+        super(CredentialListener, self).__init__()
+        self.cache = cache
+
+    def on_listen(self):
+        self.cache.invalidate()
+
+    def on_notify(self, payload):
+        self.cache.invalidate(payload)
+
+class SchedulerDB(object):
+    RECONNECTS = Counter(
+        'scheduler_db_reconnects_total',
+        'Number of times the scheduler had to reconnect to the database')
+
+    QUERY_DURATION = Summary(
+        'scheduler_db_query_duration_seconds',
+        'Time spent executing the fixed scheduler queries',
+        ['query'])
+
+    def __init__(self, persistent):
+        self.persistent = persistent
+        self.logger = get_logger("scheduler")
+        self.conn = None
+        self.broken = False
+        self.prepared = set()
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        conn = connect_db()
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        self.conn = conn
+        self.broken = False
+        self.prepared = set()
+
+    def _is_healthy(self):
+        if self.conn.closed:
+            return False
+
+        try:
+            if self.conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                # A previous iteration left a transaction open
+                cursor = self.conn.cursor()
+                cursor.execute("rollback")
+                cursor.close()
+
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            self.logger.warning("Database connection is broken: %s", e)
+            return False
+
+        return True
+
+    def acquire(self):
+        if self.conn is not None and not self._is_healthy():
+            self.invalidate(broken=True)
+
+        if self.conn is None:
+            if self.broken:
+                self.RECONNECTS.inc()
+
+            self._connect()
+
+        return self.conn
+
+    def release(self):
+        if not self.persistent:
+            self.invalidate()
+
+    def invalidate(self, broken=False):
+        self.broken = self.broken or broken
+
+        if self.conn is None:
+            return
+
+        try:
+            self.conn.close()
+        except psycopg2.Error:
+            pass
+
+        self.conn = None
+        self.prepared = set()
+
+    def _prepare(self, cursor, name):
+        # PREPARE uses positional $n parameters instead of %s
+        counter = [0]
+        def _positional(_):
+            counter[0] += 1
+            return '$%s' % counter[0]
+
+        stmt = re.sub('%s', _positional, STATEMENTS[name])
+        cursor.execute('PREPARE %s AS %s' % (name, stmt))
+        self.prepared.add(name)
+
+    def execute(self, name, args=None, fetch=False):
+        args = args or []
+
+        with self.lock, self.QUERY_DURATION.labels(name).time():
+            cursor = self.conn.cursor()
+
+            try:
+                if self.persistent:
+                    if name not in self.prepared:
+                        self._prepare(cursor, name)
+
+                    if args:
+                        cursor.execute('EXECUTE %s (%s)' % (name, ', '.join(['%s'] * len(args))), args)
+                    else:
+                        cursor.execute('EXECUTE %s' % name)
+                else:
+                    cursor.execute(STATEMENTS[name], args)
+
+                if fetch:
+                    return cursor.fetchall()
+
+                return None
+            finally:
+                cursor.close()
+
+    def execute_values(self, name, rows):
+        # Statements with a variable number of rows can't be prepared
+        with self.lock, self.QUERY_DURATION.labels(name).time():
+            cursor = self.conn.cursor()
+
+            try:
+                psycopg2.extras.execute_values(cursor, STATEMENTS[name], rows,
+                                               template=STATEMENT_TEMPLATES[name],
+                                               page_size=max(len(rows), 1))
+            finally:
+                cursor.close()
+
 class Controller(object):
-    def __init__(self, args, resource):
+    def __init__(self, args, resource, client, executor):
         self.args = args
         self.namespace = get_env("INFRABOX_GENERAL_WORKER_NAMESPACE")
         self.logger = get_logger("controller")
         self.resource = resource
+        self.client = client
+        self.executor = executor
+        self.informer = None
 
     def _get(self, url):
-        h = {'Authorization': 'Bearer %s' % self.args.token}
         self.logger.debug('GET: %s', url)
-        r = requests.get(url, headers=h, timeout=10)
+        r = self.client.get(url, timeout=10)
 
         if r.status_code == 404:
             return None
@@ -49,9 +738,8 @@ class Controller(object):
         return result
 
     def _update(self, url, data):
-        h = {'Authorization': 'Bearer %s' % self.args.token}
         self.logger.debug('PUT: %s', url)
-        r = requests.put(url, headers=h, json=data, timeout=10)
+        r = self.client.put(url, json=data, timeout=10)
 
         if r.status_code != 200:
             raise APIException(r)
@@ -60,9 +748,8 @@ class Controller(object):
         return result
 
     def _create(self, url, data):
-        h = {'Authorization': 'Bearer %s' % self.args.token}
         self.logger.debug('POST: %s', url)
-        r = requests.post(url, headers=h, json=data, timeout=10)
+        r = self.client.post(url, json=data, timeout=10)
 
         if r.status_code == 409:
             # Already exists
@@ -75,9 +762,8 @@ class Controller(object):
         return result
 
     def _delete(self, url):
-        h = {'Authorization': 'Bearer %s' % self.args.token}
         self.logger.debug('DELETE: %s', url)
-        r = requests.delete(url, headers=h, timeout=10)
+        r = self.client.delete(url, timeout=10)
 
         if r.status_code == 404:
             # does not exist
@@ -104,33 +790,51 @@ class Controller(object):
                                                                           fi['metadata']['name'])
         return url
 
-    def handle(self):
+    def _get_cached(self, informer, name, url):
+        if informer:
+            o = informer.get(name)
+
+            if o:
+                return copy.deepcopy(o)
+
+        return self._get(url)
+
+    def _list(self):
+        if self.informer:
+            return self.informer.changed(self.resource)
+
         url = '%s/apis/core.infrabox.net/v1alpha1/namespaces/%s/%s' % (self.args.api_server,
                                                                        self.namespace,
                                                                        self.resource)
         data = self._get(url)
 
         if 'items' not in data:
-            return
+            return []
 
-        for fi in data['items']:
-            try:
-                before = json.dumps(fi.get('status', {})) + json.dumps(fi['metadata'].get('finalizers', {}))
-                if fi['metadata'].get('deletionTimestamp', None):
-                    fi = self._sync_delete(fi)
-                else:
-                    fi = self._sync(fi)
+        return data['items']
 
-                url = self._get_url(fi)
-                after = json.dumps(fi.get('status', {})) + json.dumps(fi['metadata'].get('finalizers', {}))
+    def handle(self):
+        run_concurrently(self.executor, self._handle_item, self._list())
 
-                if before != after:
-                    self._update(url, fi)
-            except APIException as e:
-                self.logger.exception(e)
-                self.logger.warn(e.result.text)
-            except Exception as e:
-                self.logger.exception(e)
+    def _handle_item(self, item):
+        try:
+            # item may be owned by the informer cache, work on a copy
+            fi = copy.deepcopy(item)
+            if fi['metadata'].get('deletionTimestamp', None):
+                fi = self._sync_delete(fi)
+            else:
+                fi = self._sync(fi)
+
+            url = self._get_url(fi)
+
+            if fi.get('status', {}) != item.get('status', {}) or \
+               fi['metadata'].get('finalizers', {}) != item['metadata'].get('finalizers', {}):
+                self._update(url, fi)
+        except APIException as e:
+            self.logger.exception(e)
+            self.logger.warn(e.result.text)
+        except Exception as e:
+            self.logger.exception(e)
 
     def _sync(self, _):
         assert False
@@ -139,9 +843,10 @@ class Controller(object):
         assert False
 
 class PipelineInvocationController(Controller):
-    def __init__(self, args):
-        super(PipelineInvocationController, self).__init__(args, 'ibpipelineinvocations')
+    def __init__(self, args, client, executor):
+        super(PipelineInvocationController, self).__init__(args, 'ibpipelineinvocations', client, executor)
         self.pipelines = {}
+        self.function_informer = None
 
     def _get_pipeline(self, pi):
         if pi['spec']['pipelineName'] not in self.pipelines:
@@ -340,7 +1045,7 @@ class PipelineInvocationController(Controller):
                                                                                                  self.namespace,
                                                                                                  fi_name)
 
-            fi = self._get(url)
+            fi = self._get_cached(self.function_informer, fi_name, url)
 
             if fi.get('status', None):
                 pi['status']['stepStatuses'][i] = fi['status']
@@ -409,9 +1114,20 @@ class PipelineInvocationController(Controller):
         return pi
 
 class FunctionInvocationController(Controller):
-    def __init__(self, args):
-        super(FunctionInvocationController, self).__init__(args, 'ibfunctioninvocations')
+    def __init__(self, args, client, executor):
+        super(FunctionInvocationController, self).__init__(args, 'ibfunctioninvocations', client, executor)
         self.functions = {}
+        self.pod_informer = None
+
+    def _get_pods(self, fi):
+        if self.pod_informer:
+            return [p for p in self.pod_informer.items()
+                    if p['metadata'].get('labels', {}).get('function.infrabox.net/function-invocation-name', None) == fi['metadata']['name']]
+
+        url = '%s/api/v1/namespaces/%s/pods?labelSelector=function.infrabox.net/function-invocation-name=%s' % (self.args.api_server,
+                                                                                                                self.namespace,
+                                                                                                                fi['metadata']['name'])
+        return self._get(url)['items']
 
     def _get_function(self, fi):
         if fi['spec']['functionName'] not in self.functions:
@@ -427,11 +1143,7 @@ class FunctionInvocationController(Controller):
                                                           fi['metadata']['name'])
         self._delete(url)
 
-        url = '%s/api/v1/namespaces/%s/pods?labelSelector=function.infrabox.net/function-invocation-name=%s' % (self.args.api_server,
-                                                                                                                self.namespace,
-                                                                                                                fi['metadata']['name'])
-        pods = self._get(url)
-        for pod in pods['items']:
+        for pod in self._get_pods(fi):
             url = '%s/api/v1/namespaces/%s/pods/%s' % (self.args.api_server,
                                                        self.namespace,
                                                        pod['metadata']['name'])
@@ -504,11 +1216,7 @@ class FunctionInvocationController(Controller):
         self._create(url, batch)
 
         # Sync status
-        url = '%s/api/v1/namespaces/%s/pods?labelSelector=function.infrabox.net/function-invocation-name=%s' % (self.args.api_server,
-                                                                                                                self.namespace,
-                                                                                                                fi['metadata']['name'])
-        pods = self._get(url)
-        for pod in pods['items']:
+        for pod in self._get_pods(fi):
             if pod['status'].get('containerStatuses', None):
                 fi['status']['state'] = pod['status']['containerStatuses'][0]['state']
                 fi['status']['nodeName'] = pod['spec']['nodeName']
@@ -540,12 +1248,136 @@ class FunctionInvocationController(Controller):
         return fi
 
 class Scheduler(object):
+    DEBOUNCE = 0.2
+
+    ADMISSION_WAITING = Gauge(
+        'scheduler_admission_waiting_jobs',
+        'Number of runnable jobs kept queued because the cluster is full')
+
+    WAKEUPS = Counter(
+        'scheduler_wakeups_total',
+        'Number of scheduler iterations by what started them',
+        ['reason'])
+
+    QUEUE_WAIT = Histogram(
+        'scheduler_queue_wait_seconds',
+        'Time a runnable job waited in the queue until it was scheduled',
+        ['project'],
+        buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200))
+
+    SHARDS_HELD = Gauge(
+        'scheduler_shards_held',
+        'Number of queued job shards this replica schedules')
+
     def __init__(self, args):
         self.args = args
         self.namespace = get_env("INFRABOX_GENERAL_WORKER_NAMESPACE")
         self.logger = get_logger("scheduler")
-        self.function_controller = FunctionInvocationController(args)
-        self.pipeline_controller = PipelineInvocationController(args)
+
+        concurrency = int(os.environ.get('INFRABOX_SCHEDULER_KUBERNETES_CONCURRENCY', '10'))
+        self.client = KubeClient(args, concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+        self.function_controller = FunctionInvocationController(args, self.client, self.executor)
+        self.pipeline_controller = PipelineInvocationController(args, self.client, self.executor)
+        self.db = SchedulerDB(os.environ.get('INFRABOX_SCHEDULER_PERSISTENT_CONNECTION', 'false') == 'true')
+        self.conn = None
+        self.pipeline_informer = None
+
+        # Seconds between two iterations if nothing wakes the scheduler up earlier
+        self.interval = float(os.environ.get('INFRABOX_SCHEDULER_INTERVAL', '1'))
+        self.wakeup = threading.Event()
+        self.nodes = []
+        self.admission = os.environ.get('INFRABOX_SCHEDULER_ADMISSION_ENABLED', 'false') == 'true'
+
+        # Deficit round robin state, kept across iterations
+        self.fair_share = os.environ.get('INFRABOX_SCHEDULER_FAIR_SHARE_ENABLED', 'false') == 'true'
+        self.max_active_jobs = int(os.environ.get('INFRABOX_SCHEDULER_MAX_ACTIVE_JOBS', '0'))
+        self.deficits = {}
+        self.round_robin = []
+
+        if self.fair_share and self.max_active_jobs <= 0 and not self.admission:
+            # Without a limit every runnable job would be started at once
+            raise Exception("Fair share scheduling needs INFRABOX_SCHEDULER_MAX_ACTIVE_JOBS > 0 "
+                            "or INFRABOX_SCHEDULER_ADMISSION_ENABLED")
+
+        self.event_driven = os.environ.get('INFRABOX_SCHEDULER_LISTEN_ENABLED', 'false') == 'true'
+
+        if self.event_driven:
+            JobUpdateListener(self.wakeup).start()
+
+        # Keep the console output of finished jobs in the object storage
+        self.storage = None
+        if os.environ.get('INFRABOX_SCHEDULER_CONSOLE_STORAGE_ENABLED', 'false') == 'true':
+            from pyinfraboxutils.storage import storage
+            self.storage = storage
+
+        self.credentials = None
+        credential_cache_ttl = int(os.environ.get('INFRABOX_SCHEDULER_CREDENTIAL_CACHE_TTL', '0'))
+
+        if credential_cache_ttl > 0:
+            self.credentials = CredentialCache(credential_cache_ttl)
+            CredentialListener(self.credentials).start()
+
+        # With shards > 0 the duties run as concurrent workers which may be
+        # spread across replicas, see run_workers()
+        self.shards = int(os.environ.get('INFRABOX_SCHEDULER_SHARDS', '0'))
+        self.service_name = 'scheduler-%s' % os.environ['INFRABOX_CLUSTER_NAME']
+        self.holder = '%s-%s' % (socket.gethostname(), uuid.uuid4().hex[:8])
+        self.invocation_wakeup = self.wakeup
+        self.heartbeat = None
+
+        if self.shards > 0 and (self.fair_share or self.admission):
+            # Each replica would apply max_active_jobs and the free
+            # resources of the nodes to its own shards only
+            raise Exception("Fair share scheduling and admission are not supported "
+                            "with INFRABOX_SCHEDULER_SHARDS > 0")
+
+        if os.environ.get('INFRABOX_SCHEDULER_WATCH_ENABLED', 'false') == 'true':
+            self._init_informers()
+
+    def _init_informers(self):
+        resync_interval = int(os.environ.get('INFRABOX_SCHEDULER_WATCH_RESYNC_INTERVAL', '30'))
+        url = '%s/apis/core.infrabox.net/v1alpha1/namespaces/%s/' % (self.args.api_server,
+                                                                     self.namespace)
+
+        # A changed pipeline invocation may change the state of its job
+        def _pipeline_changed(_):
+            if self.event_driven:
+                self.invocation_wakeup.set()
+
+        self.pipeline_informer = Informer(self.client, url + 'ibpipelineinvocations', resync_interval,
+                                          on_change=_pipeline_changed)
+
+        # A function invocation changes the state of the pipeline invocation it belongs to
+        def _function_changed(fi):
+            name = fi['metadata']['name']
+            for pi_name in self.pipeline_informer.names():
+                if name.startswith(pi_name + '-'):
+                    self.pipeline_informer.mark(pi_name)
+
+        function_informer = Informer(self.client, url + 'ibfunctioninvocations', resync_interval,
+                                     on_change=_function_changed)
+
+        # A pod changes the state of the function invocation it belongs to
+        def _pod_changed(pod):
+            name = pod['metadata'].get('labels', {}).get('function.infrabox.net/function-invocation-name', None)
+            if name:
+                function_informer.mark(name)
+
+        pod_informer = Informer(self.client,
+                                '%s/api/v1/namespaces/%s/pods?labelSelector=function.infrabox.net/function-invocation-name' % (self.args.api_server,
+                                                                                                                             self.namespace),
+                                resync_interval,
+                                on_change=_pod_changed)
+
+        self.pipeline_controller.informer = self.pipeline_informer
+        self.pipeline_controller.function_informer = function_informer
+        self.function_controller.informer = function_informer
+        self.function_controller.pod_informer = pod_informer
+
+        for i in (self.pipeline_informer, function_informer, pod_informer):
+            i.start()
 
     def handle_function_invocations(self):
         self.logger.info("handle function invocations")
@@ -556,70 +1388,36 @@ class Scheduler(object):
         self.pipeline_controller.handle()
 
     def kube_delete_job(self, job_id):
-        h = {'Authorization': 'Bearer %s' % self.args.token}
-
         url = '%s/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibpipelineinvocations/%s' % (self.args.api_server,
                                                                                              self.namespace,
                                                                                              job_id)
 
         try:
-            r = requests.get(url, headers=h, timeout=5)
+            r = self.client.get(url, timeout=5)
             job = r.json()
 
             if job['metadata'].get('deletionTimestamp', None):
                 # Already marked for deletion, don't delete again to not for an update in the controller
                 return
 
-            requests.delete(url, headers=h, timeout=5)
+            self.client.delete(url, timeout=5)
         except:
             pass
 
-    def kube_job(self, job_id, cpu, mem, services=None):
-        h = {'Authorization': 'Bearer %s' % self.args.token}
+    def project_credentials(self, project_id):
+        ''' Returns the git environment and private key for the jobs of a project '''
+        generation = None
+        if self.credentials:
+            credentials = self.credentials.get(project_id)
+            if credentials is not None:
+                return credentials
 
-        job_token = encode_job_token(job_id)
+            generation = self.credentials.generation
 
-        env = [{
-            'name': 'INFRABOX_JOB_ID',
-            'value': job_id
-        }, {
-            'name': 'INFRABOX_JOB_TOKEN',
-            'value': job_token
-        }, {
-            'name': 'INFRABOX_JOB_RESOURCES_LIMITS_MEMORY',
-            'value': str(mem)
-        }, {
-            'name': 'INFRABOX_JOB_RESOURCES_LIMITS_CPU',
-            'value': str(cpu)
-        }]
-
-        # Get ssh key for private repos
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT p.type, p.id
-            FROM project p
-            JOIN job j
-            ON j.project_id = p.id
-            WHERE j.id = %s
-        ''', [job_id])
-        result = cursor.fetchone()
-        cursor.close()
-
-        project_type = result[0]
-        project_id = result[1]
+        project_type, private_key, secrets = self.db.execute('project_credentials', [project_id], fetch=True)[0]
 
-        private_key = ''
+        env = []
         if project_type == 'github':
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                SELECT r.private_key
-                FROM repository r
-                WHERE r.project_id = %s
-            ''', [project_id])
-            result = cursor.fetchone()
-            cursor.close()
-            private_key = result[0]
-
             env += [{
                 'name': 'INFRABOX_GIT_PORT',
                 'value': '443'
@@ -638,21 +1436,39 @@ class Scheduler(object):
                 }]
 
                 private_key = key.read()
+        else:
+            private_key = ''
 
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT s.value
-            FROM secret s
-            JOIN sshkey k
-            ON k.secret_id = s.id
-            WHERE k.project_id = %s
-            AND s.project_id = %s
-        ''', [project_id, project_id])
-        result = cursor.fetchall()
-        cursor.close()
+        # An ssh key configured for the project overrides the others
+        for secret in secrets or []:
+            private_key = decrypt_secret(secret)
 
-        for r in result:
-            private_key = decrypt_secret(r[0])
+        credentials = (env, private_key or '')
+
+        if self.credentials:
+            self.credentials.put(project_id, credentials, generation)
+
+        return credentials
+
+    def kube_job(self, job_id, cpu, mem, project_id, services=None):
+        job_token = encode_job_token(job_id)
+
+        env = [{
+            'name': 'INFRABOX_JOB_ID',
+            'value': job_id
+        }, {
+            'name': 'INFRABOX_JOB_TOKEN',
+            'value': job_token
+        }, {
+            'name': 'INFRABOX_JOB_RESOURCES_LIMITS_MEMORY',
+            'value': str(mem)
+        }, {
+            'name': 'INFRABOX_JOB_RESOURCES_LIMITS_CPU',
+            'value': str(cpu)
+        }]
+
+        git_env, private_key = self.project_credentials(project_id)
+        env += git_env
 
         if private_key:
             env += [{
@@ -671,6 +1487,8 @@ class Scheduler(object):
                 s['metadata']['annotations']['infrabox.net/job-token'] = job_token
                 s['metadata']['annotations']['infrabox.net/root-url'] = root_url
 
+        cpu_request, memory_request = job_resource_requests(cpu, mem)
+
         job = {
             'apiVersion': 'core.infrabox.net/v1alpha1',
             'kind': 'IBPipelineInvocation',
@@ -688,8 +1506,8 @@ class Scheduler(object):
                                 'cpu': cpu
                             },
                             'requests': {
-                                'memory': '%sMi' % mem,
-                                'cpu': max(0.3, cpu / 2.0)
+                                'memory': '%sMi' % memory_request,
+                                'cpu': cpu_request
                             }
                         },
                         'env': env,
@@ -698,8 +1516,8 @@ class Scheduler(object):
             }
         }
 
-        r = requests.post(self.args.api_server + '/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibpipelineinvocations' % self.namespace,
-                          headers=h, json=job, timeout=10)
+        r = self.client.post(self.args.api_server + '/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibpipelineinvocations' % self.namespace,
+                             json=job, timeout=10)
 
         if r.status_code != 201:
             self.logger.warn(r.text)
@@ -708,73 +1526,78 @@ class Scheduler(object):
         return True
 
     def schedule_job(self, job_id, cpu, memory):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT definition FROM job j WHERE j.id = %s
-        ''', (job_id,))
-        j = cursor.fetchone()
-        cursor.close()
+        j = self.db.execute('job_definition', [job_id], fetch=True)[0]
 
         definition = j[0]
+        project_id = j[1]
 
         cpu -= 0.2
         self.logger.debug("Scheduling job to kubernetes")
 
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT nodes, cpu_capacity, memory_capacity FROM cluster WHERE name = %s
-        ''', (os.environ['INFRABOX_CLUSTER_NAME'],))
-        c = cursor.fetchone()
-        cursor.close()
+        c = self.db.execute('cluster_capacity', [os.environ['INFRABOX_CLUSTER_NAME']], fetch=True)[0]
 
         cpu_capacity = c[1] // c[0] - 1
         memory_capacity = c[2] // c[0] // 1024 - 1024  #MB
 
         if cpu > cpu_capacity or memory > memory_capacity:
             err_msg = "Insufficient resource, please check job definition, current limit is %s cpu, %s memory" % (cpu_capacity, memory_capacity)
-            cursor = self.conn.cursor()
-            cursor.execute("UPDATE job SET state = 'error', message = %s WHERE id = %s", [err_msg, job_id])
-            cursor.close()
+            self.db.execute('error_job', [err_msg, job_id])
             self.logger.info("Don't schedule job %s because insufficient resource." % job_id)
-            return
+            return False
 
         services = None
 
         if definition and 'services' in definition:
             services = definition['services']
 
-        if not self.kube_job(job_id, cpu, memory, services=services):
-            return
+        if not self.kube_job(job_id, cpu, memory, project_id, services=services):
+            return False
 
-        cursor = self.conn.cursor()
-        cursor.execute("UPDATE job SET state = 'scheduled' WHERE id = %s", [job_id])
-        cursor.close()
+        self.db.execute('scheduled_job', [job_id])
 
         self.logger.debug("Finished scheduling job")
         self.logger.debug("")
+        return True
 
-    def schedule(self):
-        # find jobs
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT j.id, j.type, j.dependencies, j.definition
-            FROM job j
-            WHERE j.state = 'queued' and cluster_name = %s
-            ORDER BY j.created_at ASC
-        ''', [os.environ['INFRABOX_CLUSTER_NAME']])
-        jobs = cursor.fetchall()
-        cursor.close()
+    def schedule(self, shards=None):
+        count = self.shards
+        if shards is None:
+            # all queued jobs of the cluster
+            count, shards = 1, [0]
+
+        # find jobs, their dependencies are already resolved by the query
+        jobs = self.db.execute('queued_jobs', [os.environ['INFRABOX_CLUSTER_NAME'], count, shards], fetch=True)
 
         if not jobs:
             # No queued job
             return
 
-        # check dependecies
+        # dependency errors and wait jobs are settled in one statement
+        resolved = {}
+        for j in jobs:
+            if j[4] == 'skipped':
+                resolved[j[0]] = 'skipped'
+            elif j[4] == 'runnable' and j[1] == 'wait':
+                resolved[j[0]] = 'finished'
+
+        if resolved:
+            self.logger.debug("Resolved queued jobs: %s", resolved)
+            self.db.execute('resolve_queued_jobs', [list(resolved.keys()), list(resolved.values())])
+
+        runnable = []
         for j in jobs:
             job_id = j[0]
             job_type = j[1]
             dependencies = j[2]
             definition = j[3]
+            status = j[4]
+
+            if status != 'runnable':
+                self.logger.debug("Job %s is %s, not scheduling it", job_id, status)
+                continue
+
+            if job_type == "wait":
+                continue
 
             limits = {}
             if definition:
@@ -787,86 +1610,217 @@ class Scheduler(object):
             self.logger.debug("Starting to schedule job: %s", job_id)
             self.logger.debug("Dependencies: %s", dependencies)
 
-            cursor = self.conn.cursor()
-            cursor.execute('''
-                SELECT id, state
-                FROM job
-                WHERE id IN (
-                    SELECT (deps->>'job-id')::uuid
-                    FROM job, jsonb_array_elements(job.dependencies) as deps
-                    WHERE id = %s
-                )
-            ''', (job_id,))
-            result = cursor.fetchall()
-            cursor.close()
+            # job id, cpu, memory, project id, queue wait, project name, weight
+            runnable.append((job_id, cpu, memory, j[5], j[6], j[7], j[8]))
 
-            self.logger.debug("Parent states: %s", result)
+        if self.fair_share:
+            runnable = self.fair_share_order(runnable)
+        elif self.admission:
+            runnable = self.admit(runnable)
 
-            # check if there's still some parent running
-            parents_running = False
-            for r in result:
-                parent_state = r[1]
-                if parent_state in ('running', 'scheduled', 'queued'):
-                    # dependencies not ready
-                    parents_running = True
-                    break
+        # The invocations are created in parallel
+        scheduled = run_concurrently(self.executor, lambda j: self.schedule_job(*j[:3]), runnable)
+
+        for j, ok in zip(runnable, scheduled):
+            if ok:
+                self.QUEUE_WAIT.labels(j[5]).observe(max(float(j[4] or 0), 0))
 
-            if parents_running:
-                self.logger.debug("A parent is still running, not scheduling job")
+    def _free_node_resources(self):
+        ''' Allocatable minus requested cpu (cores) and memory (MiB) per node '''
+        free = {}
+        for name, cpu, memory in self.nodes:
+            free[name] = [cpu, memory]
+
+        r = self.client.get(self.args.api_server + '/api/v1/pods',
+                            params={'fieldSelector': 'status.phase!=Succeeded,status.phase!=Failed'},
+                            timeout=10)
+
+        if r.status_code != 200:
+            raise APIException(r)
+
+        pending = []
+        jobs_with_pods = set()
+        for pod in r.json().get('items', None) or []:
+            name = pod['metadata'].get('labels', {}).get('function.infrabox.net/function-invocation-name', None)
+            if name:
+                # <job id>-<step name>
+                jobs_with_pods.add(name[:36])
+
+            cpu = 0
+            memory = 0
+            for c in pod['spec'].get('containers', []):
+                requests = c.get('resources', {}).get('requests', {})
+                cpu += parse_quantity(requests.get('cpu', 0))
+                memory += parse_quantity(requests.get('memory', 0)) / 2 ** 20
+
+            node_name = pod['spec'].get('nodeName', None)
+            if node_name:
+                if node_name in free:
+                    free[node_name][0] -= cpu
+                    free[node_name][1] -= memory
+            else:
+                pending.append((cpu, memory))
+
+        # Scheduled jobs without a pod yet were admitted in an earlier
+        # iteration and need their resources as well
+        for job_id, limits in self.db.execute('scheduled_job_limits', [os.environ['INFRABOX_CLUSTER_NAME']], fetch=True):
+            if job_id in jobs_with_pods:
                 continue
 
-            # check if conditions are met
-            skipped = False
-            for r in result:
-                on = None
-                parent_id = r[0]
-                parent_state = r[1]
-                for dep in dependencies:
-                    if dep['job-id'] == parent_id:
-                        on = dep['on']
-
-                assert on
-
-                self.logger.debug("Checking parent %s with state %s", parent_id, parent_state)
-                self.logger.debug("Condition is %s", on)
-
-                if parent_state not in on:
-                    self.logger.debug("Condition is not met, skipping job")
-                    skipped = True
-                    # dependency error, don't run this job_id
-                    cursor = self.conn.cursor()
-                    cursor.execute(
-                        "UPDATE job SET state = 'skipped' WHERE id = (%s)", (job_id,))
-                    cursor.close()
-                    break
+            limits = limits or {}
+            pending.append(job_resource_requests(limits.get('cpu', 1) - 0.2, limits.get('memory', 1024)))
+
+        # Pods which are still pending will take their share as well
+        for cpu, memory in sorted(pending, reverse=True):
+            self._place(free, cpu, memory)
+
+        return free
 
-            if skipped:
+    def _place(self, free, cpu, memory):
+        # Best fit: use the node with the least cpu left over
+        best = None
+        for name, (free_cpu, free_memory) in free.items():
+            if free_cpu < cpu or free_memory < memory:
                 continue
 
-            # If it's a wait job we are done here
-            if job_type == "wait":
-                self.logger.debug("Wait job, we are done")
-                cursor = self.conn.cursor()
-                cursor.execute('''
-                    UPDATE job SET state = 'finished', start_date = now(), end_date = now() WHERE id = %s;
-                ''', (job_id,))
-                cursor.close()
+            if best is None or free_cpu < free[best][0]:
+                best = name
+
+        if best is not None:
+            free[best][0] -= cpu
+            free[best][1] -= memory
+
+        return best
+
+    def _active_jobs_per_project(self):
+        active = {}
+        for r in self.db.execute('active_jobs_per_project', [os.environ['INFRABOX_CLUSTER_NAME']], fetch=True):
+            active[r[0]] = r[1]
+
+        return active
+
+    def _admission_order(self, runnable):
+        # Jobs of projects with the least active jobs go first, jobs of the
+        # same project in the order they were queued
+        active = self._active_jobs_per_project()
+
+        rank = {}
+        order = []
+        for position, j in enumerate(runnable):
+            project_id = j[3]
+            rank[project_id] = rank.get(project_id, active.get(project_id, 0)) + 1
+            order.append((rank[project_id], position, j))
+
+        return [o[2] for o in sorted(order)]
+
+    def _admission_check(self):
+        ''' Returns a function which reserves the resources of a job if it still fits into the cluster '''
+        free = self._free_node_resources()
+
+        def _fits(j):
+            job_id, cpu, memory = j[:3]
+            cpu_request, memory_request = job_resource_requests(cpu - 0.2, memory)
+
+            node = self._place(free, cpu_request, memory_request)
+            if node is None:
+                self.logger.debug("Not enough free resources for job %s, keeping it queued", job_id)
+                return False
+
+            self.logger.debug("Admitting job %s, expected on node %s", job_id, node)
+            return True
+
+        return _fits
+
+    def admit(self, runnable):
+        ''' Returns the jobs which fit into the free resources of the cluster right now '''
+        fits = self._admission_check()
+        admitted = [j for j in self._admission_order(runnable) if fits(j)]
+
+        self.ADMISSION_WAITING.set(len(runnable) - len(admitted))
+        return admitted
+
+    def fair_share_order(self, runnable):
+        ''' Returns the jobs to start now, picked by deficit round robin across the projects '''
+        queues = {}
+        weights = {}
+        for j in runnable:
+            queues.setdefault(j[3], []).append(j)
+            weights[j[3]] = max(j[6] or 1, 1)
+
+        active = self._active_jobs_per_project()
+
+        # Each project gets its weighted share of max_active_jobs, slots
+        # not used by a project are given to the others
+        share = None
+        slots = len(runnable)
+        if self.max_active_jobs > 0:
+            slots = self.max_active_jobs - sum(active.values())
+            projects = set(active.keys()) | set(queues.keys())
+            total_weight = sum(weights.get(p, 1) for p in projects)
+            share = dict((p, float(self.max_active_jobs) * weights.get(p, 1) / total_weight) for p in projects)
+
+        # An idle project does not save up a deficit
+        for project_id in list(self.deficits.keys()):
+            if project_id not in queues:
+                del self.deficits[project_id]
+
+        # Continue the round where the last iteration stopped
+        order = [p for p in self.round_robin if p in queues]
+        order += [p for p in queues if p not in order]
+
+        fits = self._admission_check() if self.admission else lambda j: True
+        released = []
+
+        for within_share in (True, False):
+            if within_share and share is None:
                 continue
 
-            self.schedule_job(job_id, cpu, memory)
+            progress = True
+            while slots > 0 and progress:
+                progress = False
+
+                for project_id in order:
+                    queue = queues[project_id]
+
+                    if within_share and active.get(project_id, 0) >= share[project_id]:
+                        continue
+
+                    if not queue:
+                        continue
+
+                    self.deficits[project_id] = self.deficits.get(project_id, 0) + weights[project_id]
+
+                    while queue and slots > 0 and self.deficits[project_id] >= 1:
+                        if within_share and active.get(project_id, 0) >= share[project_id]:
+                            break
+
+                        j = queue.pop(0)
+                        if not fits(j):
+                            # Stays queued, a smaller job of the project may still fit
+                            continue
+
+                        released.append(j)
+                        active[project_id] = active.get(project_id, 0) + 1
+                        self.deficits[project_id] -= 1
+                        slots -= 1
+                        progress = True
+
+                    if queue:
+                        # Only the unused part of one quantum is carried over
+                        self.deficits[project_id] = min(self.deficits[project_id], weights[project_id])
+                    else:
+                        self.deficits[project_id] = 0
+
+        self.round_robin = order[1:] + order[:1]
+
+        if self.admission or share is not None:
+            self.ADMISSION_WAITING.set(len(runnable) - len(released))
+
+        return released
 
     def handle_aborts(self):
         self.logger.info("handle aborts")
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT j.id, a.user_id
-            FROM abort a
-            JOIN job j
-                ON a.job_id = j.id
-        ''')
-
-        aborts = cursor.fetchall()
-        cursor.close()
+        aborts = self.db.execute('aborts', fetch=True)
 
         for abort in aborts:
             job_id = abort[0]
@@ -875,83 +1829,81 @@ class Scheduler(object):
             self.upload_console(job_id)
 
             if user_id:
-                cursor = self.conn.cursor()
-                cursor.execute("""
-                    SELECT username
-                    FROM "user"
-                    WHERE id = %s
-                """, [user_id])
-                user = cursor.fetchone()
-                cursor.close()
+                user = self.db.execute('username', [user_id], fetch=True)[0]
                 message = 'Aborted by %s' % user[0]
             else:
                 message = 'Aborted'
 
             # Update state
-            cursor = self.conn.cursor()
-            cursor.execute("""
-                UPDATE job
-                SET state = 'killed',
-                    end_date = current_timestamp,
-                    message = %s
-                WHERE id = %s AND state IN ('scheduled', 'running', 'queued');
-                DELETE FROM "abort" WHERE job_id = %s
-            """, [message, job_id, job_id])
-            cursor.close()
+            self.db.execute('kill_job', [message, job_id])
+            self.db.execute('delete_abort', [job_id])
+
+            if self.pipeline_informer:
+                # let handle_orphaned_jobs delete the invocation right away
+                self.pipeline_informer.mark(job_id)
 
     def handle_timeouts(self):
         self.logger.info("handle timeouts")
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            SELECT j.id FROM job j
-            WHERE j.start_date < (NOW() - (CASE
-                                           WHEN j.definition->>'timeout' is not null THEN (j.definition->>'timeout')::integer * INTERVAL '1' SECOND
-                                           ELSE INTERVAL '3600' SECOND
-                                           END
-                                          )
-                                 )
-            AND j.state = 'running'
-        ''')
-        aborts = cursor.fetchall()
-        cursor.close()
+        aborts = self.db.execute('timed_out_jobs', fetch=True)
 
         for abort in aborts:
             job_id = abort[0]
             self.upload_console(job_id)
 
             # Update state
-            cursor = self.conn.cursor()
-            cursor.execute("""
-                UPDATE job SET state = 'failure', end_date = current_timestamp, message = 'Aborted due to timeout'
-                WHERE id = %s and state = 'running' """, (job_id,))
-            cursor.close()
+            self.db.execute('timeout_job', [job_id])
 
-            # Delete the k8s resource so the pod receives SIGTERM and has
-            # terminationGracePeriodSeconds (60s) to run finalize_upload(),
-            # which uploads /infrabox/upload/archive. kube_delete_job is
-            # idempotent — safe if the resource is already being deleted.
-            self.kube_delete_job(job_id)
+        # Delete the k8s resource so the pod receives SIGTERM and has
+        # terminationGracePeriodSeconds (60s) to run finalize_upload(),
+        # which uploads /infrabox/upload/archive. kube_delete_job is
+        # idempotent — safe if the resource is already being deleted.
+        run_concurrently(self.executor, self.kube_delete_job, [a[0] for a in aborts])
 
     def upload_console(self, job_id):
+        # The upload to the storage happens without the lock, so the
+        # appends of other jobs in the same batch are not held up by it
+        stored = None
+        if self.storage:
+            try:
+                stored = self._store_console(job_id)
+            except Exception as e:
+                self.logger.warning("Could not store console of job %s, keeping it in the database: %s", job_id, e)
+
         cursor = self.conn.cursor()
         cursor.execute("begin")
         cursor.execute("SET LOCAL lock_timeout = '30s'")
         try:
-            cursor.execute("""
-                   SELECT output FROM console WHERE job_id = %s
-                   ORDER BY date FOR UPDATE
-               """, [job_id])
-            lines = cursor.fetchall()
+            # Blocks further appends to the output of the job until the
+            # chunks have been moved into the job
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", [job_id])
 
-            output = ""
-            for l in lines:
-                output += l[0]
+            if stored:
+                key, size, seq = stored
+                cursor.execute("SELECT max(seq) FROM console WHERE job_id = %s", [job_id])
 
-            if output:
+                if cursor.fetchone()[0] == seq:
+                    cursor.execute("""
+                        UPDATE job SET console = NULL, console_key = %s, console_size = %s WHERE id = %s
+                    """, [key, size, job_id])
+                else:
+                    # Output was appended after the upload, keep all of it in the database
+                    self.logger.info("Console of job %s changed while it was stored", job_id)
+                    self.storage.delete_console(key)
+                    stored = None
+
+            if not stored:
                 cursor.execute("""
-                               UPDATE job SET console = %s WHERE id = %s;
-                               DELETE FROM console WHERE job_id = %s;
-                           """, [output, job_id, job_id])
+                    UPDATE job SET console = c.output
+                    FROM (
+                        SELECT string_agg(output, '' ORDER BY seq) AS output
+                        FROM console
+                        WHERE job_id = %s
+                    ) c
+                    WHERE id = %s
+                    AND c.output <> '';
+                """, [job_id, job_id])
+
+            cursor.execute("DELETE FROM console WHERE job_id = %s", [job_id])
             cursor.execute("commit")
         except Exception as e:
             self.logger.error("upload console timeout for job: " + job_id)
@@ -960,6 +1912,46 @@ class Scheduler(object):
         finally:
             cursor.close()
 
+    def _store_console(self, job_id):
+        ''' Uploads the console output gzip compressed to the storage, returns the key,
+        the size and the last sequence number stored, None if there is no output '''
+        size = 0
+        seq = 0
+
+        cursor = self.conn.cursor()
+        try:
+            with tempfile.TemporaryFile() as f:
+                with gzip.GzipFile(fileobj=f, mode='wb') as z:
+                    while True:
+                        cursor.execute("""
+                            SELECT seq, output
+                            FROM console
+                            WHERE job_id = %s
+                            AND seq > %s
+                            ORDER BY seq
+                            LIMIT 1000
+                        """, [job_id, seq])
+                        rows = cursor.fetchall()
+
+                        if not rows:
+                            break
+
+                        for seq, output in rows:
+                            data = output.encode('utf-8')
+                            z.write(data)
+                            size += len(data)
+
+                if not size:
+                    return None
+
+                key = '%s.log.gz' % job_id
+                f.seek(0)
+                self.storage.upload_console(f, key)
+        finally:
+            cursor.close()
+
+        return key, size, seq
+
 
     def handle_inactive_cluster_queued_jobs(self):
         self.logger.info("handle inactive cluster queue")
@@ -1069,143 +2061,147 @@ class Scheduler(object):
     def handle_orphaned_jobs(self):
         self.logger.info("handle orphaned jobs")
 
-        h = {'Authorization': 'Bearer %s' % self.args.token}
-        r = requests.get(self.args.api_server + '/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibpipelineinvocations' % self.namespace,
-                         headers=h,
-                         timeout=10)
-        data = r.json()
+        if self.pipeline_informer:
+            items = self.pipeline_informer.changed('orphaned_jobs')
+        else:
+            r = self.client.get(self.args.api_server + '/apis/core.infrabox.net/v1alpha1/namespaces/%s/ibpipelineinvocations' % self.namespace,
+                                timeout=10)
+            data = r.json()
 
-        if 'items' not in data:
-            return
+            if 'items' not in data:
+                return
+
+            items = data['items']
 
-        for j in data['items']:
+        invocations = {}
+        for j in items:
             if 'metadata' not in j:
                 continue
 
-            metadata = j['metadata']
-            name = metadata['name']
-            job_id = name
+            try:
+                uuid.UUID(j['metadata']['name'])
+            except ValueError:
+                # not created by the scheduler
+                continue
 
-            cursor = self.conn.cursor()
-            cursor.execute('''SELECT state, message FROM job where id = %s''', (job_id,))
-            result = cursor.fetchall()
-            cursor.close()
+            invocations[j['metadata']['name']] = j
+
+        if not invocations:
+            return
+
+        jobs = {}
+        for r in self.db.execute('job_states', [list(invocations.keys())], fetch=True):
+            jobs[r[0]] = (r[1], r[2])
 
-            if not result:
+        updates = {}
+        finished = []
+        upload_jobs = []
+        delete_jobs = []
+
+        for job_id, j in invocations.items():
+            if job_id not in jobs:
                 self.logger.debug('Deleting orphaned job %s', job_id)
-                self.kube_delete_job(job_id)
+                delete_jobs.append(job_id)
                 continue
 
-            last_state = result[0][0]
-            last_message = result[0][1]
+            last_state, last_message = jobs[job_id]
             if last_state in ('killed', 'finished', 'error', 'failure', 'unstable'):
-                self.kube_delete_job(job_id)
+                delete_jobs.append(job_id)
+                continue
+
+            current_state, start_date, end_date, message, node_name, delete_job = \
+                self._invocation_state(j, last_state)
+
+            if last_state == current_state:
+                if message != last_message:
+                    updates[job_id] = [job_id, True, last_state, None, None, message, None]
+
                 continue
 
-            start_date = None
-            end_date = None
-            delete_job = False
-            current_state = last_state
-            message = None
-            node_name = None
+            if current_state == 'finished':
+                finished.append(job_id)
 
-            if j.get('status', None):
-                status = j['status']
-                s = status.get('state', "preparing")
-                message = status.get('message', None)
+            updates[job_id] = [job_id, False, current_state, start_date, end_date, message, node_name]
 
-                if s in ["preparing", "scheduling", "pending"] and last_state in ["queued", "scheduled"]:
-                    current_state = 'scheduled'
+            if delete_job:
+                upload_jobs.append(job_id)
 
-                if s in ["running", "finalizing"]:
-                    current_state = 'running'
+        if finished:
+            # Overwrite to unstable if tests failed
+            for r in self.db.execute('failed_test_runs', [finished], fetch=True):
+                updates[r[0]][2] = 'unstable'
 
-                if s == "terminated":
-                    current_state = 'error'
+        if updates:
+            self.db.execute_values('update_jobs', list(updates.values()))
 
-                    if 'stepStatuses' in status and status['stepStatuses']:
-                        stepStatus = status['stepStatuses'][-1]
-                        exit_code = stepStatus['state']['terminated']['exitCode']
+        for job_id in upload_jobs:
+            self.upload_console(job_id)
+            self.logger.debug('Deleting job %s', job_id)
 
-                        if exit_code == 0:
-                            current_state = 'finished'
-                        else:
-                            if exit_code == ERR_EXIT_FAILURE:
-                                current_state = 'failure'
-                            message = stepStatus['state']['terminated'].get('message', None)
+        run_concurrently(self.executor, self.kube_delete_job, delete_jobs + upload_jobs)
 
-                            if not message:
-                                message = stepStatus['state']['terminated'].get('reason', 'Unknown Error')
+    def _invocation_state(self, j, last_state):
+        start_date = None
+        end_date = None
+        delete_job = False
+        current_state = last_state
+        message = None
+        node_name = None
 
-                    if not message and current_state != 'finished':
-                        self.logger.error(json.dumps(status, indent=4))
+        if j.get('status', None):
+            status = j['status']
+            s = status.get('state', "preparing")
+            message = status.get('message', None)
 
-                    delete_job = True
+            if s in ["preparing", "scheduling", "pending"] and last_state in ["queued", "scheduled"]:
+                current_state = 'scheduled'
 
-                if message == 'Error':
-                    self.logger.error(json.dumps(status, indent=4))
+            if s in ["running", "finalizing"]:
+                current_state = 'running'
 
-                if s == "error":
-                    current_state = 'error'
-                    delete_job = True
-                    start_date = datetime.now()
-                    end_date = datetime.now()
+            if s == "terminated":
+                current_state = 'error'
 
                 if 'stepStatuses' in status and status['stepStatuses']:
                     stepStatus = status['stepStatuses'][-1]
-                    nn = stepStatus.get('nodeName', None)
+                    exit_code = stepStatus['state']['terminated']['exitCode']
 
-                    if nn:
-                        # don't overwrite existing node name with none
-                        node_name = nn
+                    if exit_code == 0:
+                        current_state = 'finished'
+                    else:
+                        if exit_code == ERR_EXIT_FAILURE:
+                            current_state = 'failure'
+                        message = stepStatus['state']['terminated'].get('message', None)
 
-                start_date = status.get('startTime', None)
-                end_date = status.get('completionTime', None)
+                        if not message:
+                            message = stepStatus['state']['terminated'].get('reason', 'Unknown Error')
 
-            if last_state == current_state:
+                if not message and current_state != 'finished':
+                    self.logger.error(json.dumps(status, indent=4))
 
-                if message != last_message:
-                    cursor = self.conn.cursor()
-                    cursor.execute("""
-                                    UPDATE job SET
-                                        message = %s
-                                    WHERE id = %s
-                                """, (message, job_id))
-                    cursor.close()
+                delete_job = True
 
-                continue
+            if message == 'Error':
+                self.logger.error(json.dumps(status, indent=4))
 
-            if current_state == 'finished':
-                # Overwrite to unstable if tests failed
-                cursor = self.conn.cursor()
-                cursor.execute("""
-                    SELECT count(*) as cnt
-                    FROM test_run
-                    WHERE job_id = %s
-                    AND state IN ('error', 'failure')
-                """, [job_id])
-                result = cursor.fetchone()
-                cursor.close()
+            if s == "error":
+                current_state = 'error'
+                delete_job = True
+                start_date = datetime.now()
+                end_date = datetime.now()
 
-                if result[0]:
-                    current_state = 'unstable'
+            if 'stepStatuses' in status and status['stepStatuses']:
+                stepStatus = status['stepStatuses'][-1]
+                nn = stepStatus.get('nodeName', None)
 
-            cursor = self.conn.cursor()
-            cursor.execute("""
-                UPDATE job SET
-                    state = %s,
-                    start_date = %s,
-                    end_date = %s,
-                    message = %s,
-                    node_name = %s
-                WHERE id = %s
-            """, (current_state, start_date, end_date, message, node_name, job_id))
-            cursor.close()
+                if nn:
+                    # don't overwrite existing node name with none
+                    node_name = nn
 
-            if delete_job:
-                self.upload_console(job_id)
-                self.logger.debug('Deleting job %s', job_id)
-                self.kube_delete_job(job_id)
+            start_date = status.get('startTime', None)
+            end_date = status.get('completionTime', None)
+
+        return current_state, start_date, end_date, message, node_name, delete_job
 
     def get_default_cluster(self):
         cursor = self.conn.cursor()
@@ -1256,16 +2252,28 @@ class Scheduler(object):
             labels = os.environ['INFRABOX_CLUSTER_LABELS'].split(',')
 
         root_url = os.environ['INFRABOX_ROOT_URL']
+        nodes, cpu, memory = self.refresh_nodes()
+
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            INSERT INTO cluster (name, labels, root_url, nodes, cpu_capacity, memory_capacity, active)
+            VALUES(%s, %s, %s, %s, %s, %s, true)
+            ON CONFLICT (name) DO UPDATE
+            SET last_update = NOW(), labels = %s, root_url = %s, nodes = %s, cpu_capacity = %s, memory_capacity = %s
+            WHERE cluster.name = %s """, [cluster_name, labels, root_url, nodes, cpu, memory, labels,
+                                          root_url, nodes, cpu, memory, cluster_name])
+        cursor.close()
 
-        h = {'Authorization': 'Bearer %s' % self.args.token}
-        r = requests.get(self.args.api_server + '/api/v1/nodes',
-                         headers=h,
-                         timeout=10)
+    def refresh_nodes(self):
+        ''' Keeps the schedulable nodes for the admission and returns the capacity of the cluster '''
+        r = self.client.get(self.args.api_server + '/api/v1/nodes',
+                            timeout=10)
         data = r.json()
 
         memory = 0
         cpu = 0
         nodes = 0
+        schedulable = []
 
         items = data.get('items', [])
 
@@ -1283,15 +2291,19 @@ class Scheduler(object):
             mem = mem.replace('Ki', '')
             memory += int(mem)
 
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            INSERT INTO cluster (name, labels, root_url, nodes, cpu_capacity, memory_capacity, active)
-            VALUES(%s, %s, %s, %s, %s, %s, true)
-            ON CONFLICT (name) DO UPDATE
-            SET last_update = NOW(), labels = %s, root_url = %s, nodes = %s, cpu_capacity = %s, memory_capacity = %s
-            WHERE cluster.name = %s """, [cluster_name, labels, root_url, nodes, cpu, memory, labels,
-                                          root_url, nodes, cpu, memory, cluster_name])
-        cursor.close()
+            ready = False
+            for c in i['status'].get('conditions', []):
+                if c['type'] == 'Ready' and c['status'] == 'True':
+                    ready = True
+
+            if ready and not i.get('spec', {}).get('unschedulable', False):
+                allocatable = i['status'].get('allocatable', i['status']['capacity'])
+                schedulable.append((metadata['name'],
+                                    parse_quantity(allocatable['cpu']),
+                                    parse_quantity(allocatable['memory']) / 2 ** 20))
+
+        self.nodes = schedulable
+        return nodes, cpu, memory
 
     def _inactive(self):
         cluster_name = os.environ['INFRABOX_CLUSTER_NAME']
@@ -1334,18 +2346,168 @@ class Scheduler(object):
 
         self.schedule()
 
+    def maintain_cluster(self):
+        self.update_cluster_state()
+        self.handle_cron_jobs()
+        self.handle_inactive_cluster_queued_jobs()
+
+        if os.environ['INFRABOX_HA_ENABLED'] == "true" or os.environ['INFRABOX_CLUSTER_NAME'] == 'master':
+            self.assign_cluster()
+
+    def schedule_shards(self):
+        shards = elect_shard_leaders(self.conn, self.service_name + '/schedule', self.shards, self.holder)
+        self.SHARDS_HELD.set(len(shards))
+
+        if not shards:
+            return
+
+        if self._inactive():
+            self.logger.info('Cluster set to inactive or disabled, not scheduling')
+            return
+
+        if self.heartbeat and os.environ.get('INFRABOX_DISABLE_LEADER_ELECTION', 'false') != 'true':
+            service_name = self.service_name + '/schedule'
+            self.heartbeat.leases = ['%s/replica/%s' % (service_name, self.holder)] + \
+                                    [shard_lease(service_name, shard) for shard in shards]
+
+        for shard in shards:
+            # The lease may have expired while the shards before were scheduled
+            if not renew_lease(self.conn, shard_lease(self.service_name + '/schedule', shard), self.holder):
+                self.logger.warning('Lost shard %s, not scheduling it', shard)
+                continue
+
+            self.schedule([shard])
+
+    def _fork(self):
+        ''' Returns a scheduler sharing the clients and informers, but with a database
+        connection and the state kept across iterations of its own '''
+        worker = copy.copy(self)
+        worker.db = SchedulerDB(self.db.persistent)
+        worker.conn = None
+        worker.wakeup = threading.Event()
+        worker.nodes = list(self.nodes)
+        worker.deficits = {}
+        worker.round_robin = []
+        worker.heartbeat = LeaseHeartbeat(self.holder)
+
+        worker.function_controller = copy.copy(self.function_controller)
+        worker.function_controller.functions = {}
+        worker.pipeline_controller = copy.copy(self.pipeline_controller)
+        worker.pipeline_controller.pipelines = {}
+        return worker
+
+    def _run_worker(self, name, duties, singleton):
+        self.logger.info("Starting %s worker", name)
+        lease = '%s/%s' % (self.service_name, name)
+
+        # The leases are renewed at least once per iteration, the heartbeat
+        # only covers the iteration itself
+        self.interval = min(self.interval, LeaseHeartbeat.INTERVAL)
+
+        while True:
+            self.conn = self.db.acquire()
+
+            try:
+                if not singleton or renew_lease(self.conn, lease, self.holder):
+                    leader_election = os.environ.get('INFRABOX_DISABLE_LEADER_ELECTION', 'false') != 'true'
+                    self.heartbeat.start([lease] if singleton and leader_election else [])
+
+                    try:
+                        for duty in duties:
+                            if self.heartbeat.lost:
+                                self.logger.warning("Lost the lease of the %s worker, stopping the iteration", name)
+                                break
+
+                            try:
+                                getattr(self, duty)()
+                            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                                raise
+                            except Exception as e:
+                                self.logger.exception(e)
+                    finally:
+                        self.heartbeat.stop()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                self.logger.exception(e)
+                self.db.invalidate(broken=True)
+
+            self.db.release()
+
+            self._wait()
+
+    def _start_worker(self, name, duties, singleton=True):
+        def _run():
+            try:
+                self._run_worker(name, duties, singleton)
+            except Exception as e:
+                self.logger.exception(e)
+            finally:
+                # Let kubernetes restart the scheduler instead of running without the worker
+                os._exit(1)
+
+        thread = threading.Thread(target=_run, name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run_workers(self):
+        ''' Runs the duties as concurrent workers, so a slow one does not delay the others.
+
+        Each of the cluster, aborts and invocations workers runs on the replica
+        holding its lease. Queued jobs are split into shards by their project
+        and every replica schedules the shards it holds the lease of.
+        '''
+        self.logger.info("Starting scheduler with %s shards", self.shards)
+
+        invocations = self._fork()
+        self.invocation_wakeup = invocations.wakeup
+
+        # The scheduling worker is woken up by the job update notifications
+        scheduling = self._fork()
+        scheduling.wakeup = self.wakeup
+
+        threads = [
+            self._fork()._start_worker('cluster', ['maintain_cluster']),
+            self._fork()._start_worker('aborts', ['handle_aborts', 'handle_timeouts']),
+            invocations._start_worker('invocations', ['handle_orphaned_jobs',
+                                                      'handle_function_invocations',
+                                                      'handle_pipeline_invocations']),
+            scheduling._start_worker('schedule', ['schedule_shards'], singleton=False),
+        ]
+
+        for thread in threads:
+            thread.join()
+
     def run(self):
+        if self.shards > 0:
+            self.run_workers()
+            return
+
         self.logger.info("Starting scheduler")
 
         while True:
-            conn = connect_db()
-            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            self.conn = self.db.acquire()
 
-            self.conn = conn
-            self.handle()
-            self.conn.close()
+            try:
+                self.handle()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                # Connection got lost in the middle of an iteration,
+                # it will be re-established in the next one
+                self.logger.exception(e)
+                self.db.invalidate(broken=True)
+
+            self.db.release()
 
-            time.sleep(1)
+            self._wait()
+
+    def _wait(self):
+        if self.wakeup.wait(self.interval):
+            # Coalesce a burst of notifications into a single iteration
+            time.sleep(self.DEBOUNCE)
+            self.WAKEUPS.labels('event').inc()
+        else:
+            self.WAKEUPS.labels('interval').inc()
+
+        self.wakeup.clear()
 
 def main():
     # Arguments
@@ -1371,6 +2533,9 @@ def main():
 
     os.environ['REQUESTS_CA_BUNDLE'] = '/var/run/secrets/kubernetes.io/serviceaccount/ca.crt'
 
+    if os.environ.get('INFRABOX_MONITORING_ENABLED', 'false') == 'true':
+        start_http_server(int(os.environ.get('INFRABOX_PORT', 8080)))
+
     scheduler = Scheduler(args)
     scheduler.run()
 